@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""Script to run Kruskal-Wallis tests of coreceptor score (x4.pct) by haplotype for every participant and every grouping of haplotype sites
+in one batch, in place of running kw_test_and_haplotype_plots.R once per participant and pair of positions.
+Haplotype groups are named by their amino acid at each site (e.g. 304K_320I); every combination of those sites is tested
+(304 alone, 320 alone, 304 and 320 together). Each participant's scores are ranked once and the ranks are reused for every grouping,
+the H statistic of every grouping comes from sums of ranks per group. Output is one table with H (corrected for ties), p-value,
+effect size (eta squared, as rstatix's kruskal_effsize) and p-values adjusted for testing every grouping of every participant"""
+
+import os
+import re
+import sys
+import math
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline1', 'scripts'))
+from file_utils import atomic_writer
+
+
+# haplotype group names are site and amino acid pairs separated by _, e.g. 304K_320I
+SITE_PATTERN = re.compile(r'(\d+)([^\d_]+)')
+
+# multiple testing corrections
+CORRECTIONS = ['fdr', 'bonferroni']
+
+
+def main():
+    # get command line arguments
+    args = get_args()
+
+    # test every grouping of every participant
+    results = [kruskal_wallis_participant(get_participant_id(file), pd.read_csv(file), args.group, args.score) for file in args.infiles]
+    results_df = pd.concat(results, ignore_index = True)
+
+    # adjust p-values for every test of the batch
+    results_df['p_adj'] = adjust_p_values(results_df['p_value'].to_numpy(), args.correction)
+
+    # save table of every test
+    with atomic_writer(args.outfile) as outfile:
+        results_df.to_csv(outfile, index = False)
+
+
+def get_args():
+    """Get command line arguments"""
+    parser = argparse.ArgumentParser(description='Kruskal-Wallis tests of coreceptor score by every grouping of haplotype sites, for every participant')
+
+    parser.add_argument('-i', '--infiles', nargs = '+', type = str, dest = 'infiles', required = True, help = 'Files of haplotype group and score of every sequence, one per participant ([id]_kw_test_data_V3.csv)')
+
+    parser.add_argument('-o', '--outfile', type = str, dest = 'outfile', default = 'kw_test_results.csv', help = 'File to write the table of every test')
+
+    parser.add_argument('-g', '--group', type = str, dest = 'group', default = 'group', help = 'Column of haplotype groups')
+
+    parser.add_argument('-s', '--score', type = str, dest = 'score', default = 'x4.pct', help = 'Column of scores')
+
+    parser.add_argument('-c', '--correction', type = str, dest = 'correction', default = 'fdr', choices = CORRECTIONS, help = 'Multiple testing correction of p-values')
+
+    args = parser.parse_args()
+    return args
+
+
+def get_participant_id(filename):
+    """Function to get the participant ID from a file name, the part of the name before the first _"""
+
+    return os.path.basename(filename).split('_')[0]
+
+
+def parse_haplotypes(groups):
+    """Function to split haplotype group names into sites and amino acids;
+    returns (sites, matrix of amino acids with one row per group name and one column per site)"""
+
+    parsed = [dict(SITE_PATTERN.findall(group)) for group in groups]
+
+    # sites in order of position, every group name has to name the same sites
+    sites = sorted({site for haplotype in parsed for site in haplotype}, key = int)
+    for group, haplotype in zip(groups, parsed):
+        if sorted(haplotype, key = int) != sites:
+            raise ValueError(f"Haplotype group '{group}' does not have an amino acid for every site ({', '.join(sites)})")
+
+    return sites, np.array([[haplotype[site] for site in sites] for haplotype in parsed], dtype = object)
+
+
+def rank_scores(scores):
+    """Function to rank scores from 1, tied scores get the average of their ranks; returns (ranks, tie correction factor)"""
+
+    values, inverse, counts = np.unique(scores, return_inverse = True, return_counts = True)
+
+    # average rank of each distinct value
+    upper = np.cumsum(counts)
+    average = upper - (counts - 1) / 2
+
+    n = len(scores)
+    ties = 1 - (counts ** 3 - counts).sum() / (n ** 3 - n) if n > 1 else 1.0
+
+    return average[inverse], ties
+
+
+def get_groupings(sites, haplotypes):
+    """Function to get every grouping of sequences by a combination of haplotype sites;
+    returns a list of (sites of grouping, group code of every sequence, number of groups)"""
+
+    groupings = []
+
+    for size in range(1, len(sites) + 1):
+        for columns in itertools.combinations(range(len(sites)), size):
+
+            # sequences with the same amino acids at these sites are in the same group
+            keys = ['_'.join(site + aa for site, aa in zip([sites[c] for c in columns], row)) for row in haplotypes[:, list(columns)]]
+            names, codes = np.unique(keys, return_inverse = True)
+
+            groupings.append(('_'.join(sites[c] for c in columns), codes, len(names)))
+
+    return groupings
+
+
+def kruskal_wallis(ranks, ties, groupings):
+    """Function to compute the Kruskal-Wallis H statistic (corrected for ties) of every grouping of the same ranks at once;
+    group codes of all groupings are offset so one bincount gives the rank sum and size of every group of every grouping"""
+
+    n = len(ranks)
+
+    offsets = np.concatenate([[0], np.cumsum([n_groups for sites, codes, n_groups in groupings])])
+    codes = np.concatenate([codes + offset for (sites, codes, n_groups), offset in zip(groupings, offsets)])
+
+    rank_sums = np.bincount(codes, weights = np.tile(ranks, len(groupings)), minlength = offsets[-1])
+    sizes = np.bincount(codes, minlength = offsets[-1])
+
+    # sum of squared rank sum over size of each grouping's groups
+    grouping_of_group = np.repeat(np.arange(len(groupings)), np.diff(offsets))
+    between = np.bincount(grouping_of_group, weights = rank_sums ** 2 / sizes, minlength = len(groupings))
+
+    H = 12 / (n * (n + 1)) * between - 3 * (n + 1)
+
+    # all scores tied gives no information
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(ties > 0, H / ties, np.nan)
+
+
+def chi2_sf(x, df):
+    """Function to get the survival function (upper tail probability) of the chi squared distribution with integer df degrees of freedom at x"""
+
+    if not np.isfinite(x) or df < 1:
+        return np.nan
+
+    half = x / 2
+
+    # even degrees of freedom: Poisson sum, odd: complementary error function plus a series
+    if df % 2 == 0:
+        terms = [half ** i / math.factorial(i) for i in range(df // 2)]
+        return min(1.0, math.exp(-half) * sum(terms))
+
+    terms = [half ** (i - 0.5) / math.gamma(i + 0.5) for i in range(1, (df - 1) // 2 + 1)]
+    return min(1.0, math.erfc(math.sqrt(half)) + math.exp(-half) * sum(terms))
+
+
+def adjust_p_values(p_values, correction='fdr'):
+    """Function to adjust p-values for multiple testing, with Benjamini-Hochberg (fdr) or Bonferroni; NaN p-values are left out"""
+
+    adjusted = np.full(len(p_values), np.nan)
+    tested = ~np.isnan(p_values)
+    p = p_values[tested]
+    n = len(p)
+
+    if correction == 'bonferroni':
+        adjusted[tested] = np.minimum(p * n, 1)
+        return adjusted
+
+    order = np.argsort(p)
+    ranked = p[order] * n / np.arange(1, n + 1)
+
+    # adjusted p-values cannot decrease with rank, and are at most 1
+    ranked = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+
+    values = np.empty(n)
+    values[order] = ranked
+    adjusted[tested] = values
+
+    return adjusted
+
+
+def kruskal_wallis_participant(id, data_df, group='group', score='x4.pct'):
+    """Function to run a Kruskal-Wallis test of score by every grouping of haplotype sites for one participant;
+    returns a table with participant, sites, n, groups, H, df, p_value and eta2 of every grouping"""
+
+    data_df = data_df.dropna(subset = [group, score])
+
+    # rank scores once for every grouping
+    ranks, ties = rank_scores(data_df[score].to_numpy(dtype = float))
+
+    sites, haplotypes = parse_haplotypes(data_df[group].astype(str).tolist())
+    groupings = get_groupings(sites, haplotypes)
+
+    H = kruskal_wallis(ranks, ties, groupings) if groupings else np.array([])
+
+    n = len(ranks)
+    k = np.array([n_groups for sites, codes, n_groups in groupings], dtype = int)
+
+    # a grouping with a single group cannot be tested
+    p_values = [chi2_sf(h, groups - 1) if groups > 1 else np.nan for h, groups in zip(H, k)]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        eta2 = np.where((k > 1) & (n > k), (H - k + 1) / (n - k), np.nan)
+
+    return pd.DataFrame({'participant': id,
+                         'sites': [sites for sites, codes, n_groups in groupings],
+                         'n': n,
+                         'groups': k,
+                         'H': np.where(k > 1, H, np.nan),
+                         'df': k - 1,
+                         'p_value': p_values,
+                         'eta2': eta2})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""Catalog of the files under a cohort directory, so each script finds its inputs without listing directories again.
+The catalog ([root]/.catalog.json) keeps the name, size and modification time of every file in every directory under root,
+and is refreshed incrementally: only directories whose modification time changed (files added, removed or replaced) are listed again,
+the files of other directories are only checked for a new size or modification time (files rewritten or appended to in place).
+Files are also sorted by participant into roles (alignment, translated alignment, FUBAR json/simple table,
+counting-method screen table, position mapping, annotation, Tajima's D midpoints), and participants with more than one file for a role are reported"""
+
+import os
+import re
+import sys
+import json
+from file_utils import atomic_writer, strip_compression_suffix
+
+
+# name of the catalog file kept in the root directory
+CATALOG_FILE = '.catalog.json'
+
+# file name patterns of each role, the participant ID is the part of the name before the role's suffix
+# (alignment file names are [id]_rev2miss.aln or [id].[anything].aln)
+ROLE_PATTERNS = {'alignment': r'(?P<id>[^.]+?)(_rev2miss)?(\.[^/]*)?\.aln',
+                 'translated': r'(?P<id>[^.]+?)(_rev2miss)?(\.[^/]*)?\.aln\.translated',
+                 'fubar_json': r'(?P<id>[^.]+?)(_rev2miss)?\..*FUBAR\.json',
+                 'fubar_simple': r'(?P<id>[^.]+?)(_rev2miss)?\..*FUBAR_simple\.txt',
+                 'fubar_table': r'(?P<id>[^.]+?)(_rev2miss)?\..*FUBAR_simple\.npz',
+                 'screen_simple': r'(?P<id>[^.]+?)(_rev2miss)?\..*NG_simple\.txt',
+                 'screen_table': r'(?P<id>[^.]+?)(_rev2miss)?\..*NG_simple\.npz',
+                 'position_mapping': r'(?P<id>.+)_position_mappings\.csv',
+                 'annotation': r'(?P<id>.+)_consensus_annotations\.csv'}
+
+# file holding the significant Tajima's D midpoints of every participant ({id: [midpoints]})
+MIDPOINTS_FILE = 'sig_midpoints.json'
+
+
+class Catalog:
+    """Files under a root directory, with the participant files of each role"""
+
+    def __init__(self, root):
+        """Loads the catalog of root, if one has been saved, and refreshes it"""
+
+        self.root = root
+        self.path = f'{root}/{CATALOG_FILE}'
+
+        # catalog holds, for every directory (relative to root), its modification time, files ({name: [size, mtime]}) and subdirectories
+        try:
+            with open(self.path, 'r') as infile:
+                self.directories = json.load(infile)['directories']
+        except (OSError, ValueError, KeyError):
+            self.directories = {}
+
+        self.refresh()
+
+    def refresh(self):
+        """Lists every directory that changed since the catalog was last refreshed, then sorts files into roles"""
+
+        directories = {}
+        todo = ['.']
+
+        while todo:
+            directory = todo.pop()
+            mtime = os.stat(f'{self.root}/{directory}').st_mtime_ns
+
+            entry = self.directories.get(directory)
+
+            # files edited in place do not change the directory's modification time, check each one
+            if entry is not None and entry['mtime'] == mtime:
+                entry = self.update_files(directory, entry)
+
+            # list the directory again only if something in it was added, removed or replaced
+            if entry is None or entry['mtime'] != mtime:
+                entry = self.list_directory(directory, mtime)
+
+            directories[directory] = entry
+            todo += [os.path.normpath(f'{directory}/{d}') for d in entry['dirs']]
+
+        self.directories = directories
+        self.participants = self.get_participants()
+
+    def list_directory(self, directory, mtime):
+        """Lists the files (with size and modification time) and subdirectories of a directory under root"""
+
+        entry = {'mtime': mtime, 'files': {}, 'dirs': []}
+
+        with os.scandir(f'{self.root}/{directory}') as scan:
+            for item in scan:
+                # hidden files are manifests, catalogs and partially written outputs
+                if item.name.startswith('.'):
+                    continue
+                if item.is_dir():
+                    entry['dirs'].append(item.name)
+                else:
+                    stat = item.stat()
+                    entry['files'][item.name] = [stat.st_size, stat.st_mtime_ns]
+
+        return entry
+
+    def update_files(self, directory, entry):
+        """Updates the size and modification time of every file of an unchanged directory;
+        returns the updated entry, or None if a file has gone so the directory has to be listed again"""
+
+        files = {}
+
+        for name in entry['files']:
+            try:
+                stat = os.stat(f'{self.root}/{directory}/{name}')
+            except FileNotFoundError:
+                return None
+            files[name] = [stat.st_size, stat.st_mtime_ns]
+
+        return dict(entry, files = files)
+
+    def get_participants(self):
+        """Sorts the files of every directory into {id: {role: [paths]}}"""
+
+        patterns = {role: re.compile(pattern) for role, pattern in ROLE_PATTERNS.items()}
+        participants = {}
+
+        for directory in sorted(self.directories):
+            for name in sorted(self.directories[directory]['files']):
+
+                path = os.path.normpath(f'{directory}/{name}')
+
+                # every participant in the midpoints file
+                if name == MIDPOINTS_FILE:
+                    with open(f'{self.root}/{path}', 'r') as infile:
+                        for id in json.load(infile):
+                            participants.setdefault(id, {}).setdefault('midpoints', []).append(path)
+                    continue
+
+                for role, pattern in patterns.items():
+                    match = pattern.fullmatch(strip_compression_suffix(name))
+                    if match:
+                        participants.setdefault(match.group('id'), {}).setdefault(role, []).append(path)
+                        break
+
+        return participants
+
+    def save(self):
+        """Writes the catalog to [root]/.catalog.json, replacing the old catalog only once it is fully written"""
+
+        with atomic_writer(self.path) as outfile:
+            json.dump({'directories': self.directories}, outfile)
+
+    def list_files(self, suffix='', directory='.'):
+        """Returns the (sorted) names of the files in a directory under root whose name, without a .gz/.bz2 suffix, ends with suffix"""
+
+        files = self.directories[os.path.normpath(directory)]['files']
+
+        return [name for name in sorted(files) if strip_compression_suffix(name).endswith(suffix)]
+
+    def file_info(self, path):
+        """Returns [size, mtime] of a file, path relative to root"""
+
+        directory, name = os.path.split(os.path.normpath(path))
+
+        return self.directories[directory or '.']['files'][name]
+
+    def ids(self, role):
+        """Returns the sorted IDs of participants with a file for role"""
+
+        return sorted(id for id, roles in self.participants.items() if role in roles)
+
+    def find(self, role, id):
+        """Returns the path (including root) of a participant's file for role, the first one if there are several,
+        or None if there is none"""
+
+        paths = self.participants.get(id, {}).get(role)
+
+        return f'{self.root}/{paths[0]}' if paths else None
+
+    def ambiguous(self):
+        """Returns (id, role, paths) for every participant with more than one file for a role"""
+
+        return [(id, role, paths) for id, roles in sorted(self.participants.items()) for role, paths in roles.items() if len(paths) > 1]
+
+
+def get_alignment_id(filename):
+    """Returns the participant ID of an alignment or translated alignment file name, as the catalog finds it
+    (e.g. 520_1 from 520_1_rev2miss.aln.translated.gz, cell2_bc10xx from cell2_bc10xx.aln.translated);
+    other names keep everything before the first '.'"""
+
+    name = strip_compression_suffix(os.path.basename(filename))
+
+    for role in ['translated', 'alignment']:
+        match = re.fullmatch(ROLE_PATTERNS[role], name)
+        if match:
+            return match.group('id')
+
+    return name.split('.')[0]
+
+
+def open_catalog(root):
+    """Loads, refreshes and saves the catalog of root, reporting participants with more than one file for a role"""
+
+    catalog = Catalog(root)
+    catalog.save()
+
+    for id, role, paths in catalog.ambiguous():
+        print(f'Warning: {len(paths)} {role} files match {id} in {root}, using {paths[0]} ({", ".join(paths[1:])} ignored)', file = sys.stderr)
+
+    return catalog
@@ -2,48 +2,140 @@
 
 """Program to create consensus sequences for every protein alignment file in directory, outputs a file containing all consensus sequences for experiment"""
 
-import os
 import argparse
 import numpy as np
 import pandas as pd
-import argparse
 import shutil
+import contextlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from catalog import open_catalog
+from file_utils import atomic_writer, iter_fasta, open_text, strip_compression_suffix
+from manifest import Manifest
+from translate_fasta import translate_sequences
+
+
+# amino acid options, in the row order of the count matrix
+AMINO_ACIDS = ['a', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'k', 'l', 'm', 'n', 'p', 'q', 'r', 's', 't', 'v', 'w', 'y', 'x', '-']
 
+# amino acid options in sorted order, used to spell out ties
+SORTED_ORDER = np.argsort(AMINO_ACIDS, kind = 'stable')
+SORTED_AMINO_ACIDS = np.array(AMINO_ACIDS)[SORTED_ORDER]
+
+# marker values in the encoded alignment for unexpected characters and for positions past the end of a sequence
+INVALID = 254
+PADDING = 255
+
+# lookup table from a raw character to its row in the count matrix, upper and lower case map to the same row
+AA_LOOKUP = np.full(256, INVALID, dtype = np.uint8)
+AA_LOOKUP[PADDING] = PADDING
+for ind, aa in enumerate(AMINO_ACIDS):
+    AA_LOOKUP[ord(aa)] = ind
+    AA_LOOKUP[ord(aa.upper())] = ind
 
 
 def main():
     # get command line arguments
     args = get_args()
     
-    # load in alignment files as list
-    aln_files = [f for f in os.listdir(args.directory) if f.endswith('_rev2miss.aln.translated')]
+    # nucleotide alignments are translated on the fly, otherwise read the translated alignments
+    suffix = '_rev2miss.aln' if args.nucleotide else '_rev2miss.aln.translated'
+    
+    # create consensus for every participant, write combined consensus file
+    run_consensus(args.directory, suffix, args.outfile, args.jobs, args.chunk_size, 
+                  nucleotide = args.nucleotide, write_translated = args.write_translated, alignment_consensus = args.alignment_consensus, force = args.force)
 
+
+def run_consensus(directory, suffix, outfile, jobs=1, chunk_size=1000, nucleotide=False, write_translated=False, alignment_consensus=True, force=False):
+    """Creates consensus sequences for every alignment file in directory ending with suffix, across jobs processes,
+    then writes all consensus sequences to outfile once, sorted by individual ID; participants whose alignment and settings
+    have not changed since the last run are taken from the manifest unless force is set"""
+    
+    # load in alignment files as list (plain, gzip or bz2 compressed)
+    aln_files = open_catalog(directory).list_files(suffix)
+    
+    # load record of participants already processed
+    manifest = Manifest(directory, 'consensus', force = force)
+    params = {'suffix': suffix, 'nucleotide': nucleotide, 'write_translated': write_translated, 'alignment_consensus': alignment_consensus}
     
-    # for each file in the list
+    # split participants into those that are up to date and those that need (re)processing
+    results = []
+    tasks = []
     for file in aln_files:
+        individual_id = strip_compression_suffix(file).replace(suffix, '')
+        if manifest.is_current(individual_id, [f'{directory}/{file}'], params):
+            results.append((individual_id, manifest.result(individual_id)))
+        else:
+            tasks.append((directory, file, suffix, chunk_size, nucleotide, write_translated, alignment_consensus))
+    
+    # fan participants out to a process pool, or run in this process for a single job
+    if jobs > 1 and tasks:
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            new_results = list(executor.map(create_consensus_for_file, *zip(*tasks)))
+    else:
+        new_results = [create_consensus_for_file(*task) for task in tasks]
+    
+    # record newly processed participants and the outputs they wrote
+    for (individual_id, consensus, outputs), task in zip(new_results, tasks):
+        manifest.record(individual_id, [f'{directory}/{task[1]}'], params, outputs, result = consensus)
+        results.append((individual_id, consensus))
+    manifest.save()
+    
+    # write combined consensus file in one go, replaces any previous run instead of appending to it
+    with atomic_writer(f'{directory}/{outfile}') as outfile2:
+        for individual_id, consensus in sorted(results):
+            outfile2.write(f'\n>{individual_id} Consensus Sequence\n')
+            outfile2.write(consensus)
+
+
+def create_consensus_for_file(directory, file, suffix, chunk_size, nucleotide=False, write_translated=False, alignment_consensus=True):
+    """Creates the consensus sequence for one participant's alignment file and (optionally) writes a copy of the translated alignment 
+    with the consensus appended; nucleotide alignments are translated chunk by chunk and counted in memory, the translated alignment
+    is only written to disk if write_translated is set
+    @input: directory, alignment file name, alignment file suffix, number of sequences per chunk, whether the alignment is nucleotide,
+    whether to write the translated alignment, whether to write the alignment + consensus copy
+    @return: tuple of (individual ID, consensus sequence, list of files written)"""
+    
+    individual_id = strip_compression_suffix(file).replace(suffix, '')
+    
+    # name of the translated alignment, the alignment + consensus copy is named after it
+    translated_file = f'{directory}/{individual_id}{suffix}' + ('.translated' if nucleotide else '')
+    
+    written = []
+    
+    with contextlib.ExitStack() as stack:
         
-        individual_id = file.replace('_rev2miss.aln.translated', '')
-        
-        # get list of sequences
-        sequences = get_sequences_from_file(f'{args.directory}/{file}')
+        # optional outputs
+        outputs = []
+        if nucleotide and write_translated:
+            outputs.append(stack.enter_context(atomic_writer(translated_file)))
+            written.append(translated_file)
+        if alignment_consensus:
+            outfile1 = stack.enter_context(atomic_writer(f'{translated_file}.consensus'))
+            written.append(f'{translated_file}.consensus')
+            
+            # translated sequences are written to the copy as they go, a protein alignment is copied as is
+            if nucleotide:
+                outputs.append(outfile1)
+            else:
+                with open_text(f'{directory}/{file}') as infile:
+                    shutil.copyfileobj(infile, outfile1)
         
-        # get amino acid frequency counts
-        counts = get_counts_matrix(sequences)
+        # get amino acid frequency counts, reading (and translating) the alignment in chunks
+        if nucleotide:
+            counts = get_counts_matrix_from_chunks(get_translated_chunks_from_file(f'{directory}/{file}', chunk_size, outputs), file)
+        else:
+            counts = get_counts_matrix_from_file(f'{directory}/{file}', chunk_size)
         
         # reconstruct sequence from count matrix
-        most_common = counts[counts == counts.max(axis=0)]
-        consensus = most_common.apply(counts_to_sequence, axis=0)
+        consensus = ''.join(get_consensus(counts))
 
-        # make copy of alignment file
-        shutil.copyfile(f'{args.directory}/{individual_id}_rev2miss.aln.translated', f'{args.directory}/{individual_id}_rev2miss.aln.translated.consensus')
-        
         # write consensus sequence to copied file
-        with open(f'{args.directory}/{individual_id}_rev2miss.aln.translated.consensus', 'a') as outfile1:
+        if alignment_consensus:
             outfile1.write(f'>{individual_id} Consensus Sequence\n')
-            outfile1.write(''.join(consensus))
-        with open(f'{args.directory}/{args.outfile}', 'a') as outfile2:
-            outfile2.write(f'\n>{individual_id} Consensus Sequence\n')
-            outfile2.write(''.join(consensus))
+            outfile1.write(consensus)
+    
+    return individual_id, consensus, written
 
 
 def get_args():
@@ -54,48 +146,183 @@ def get_args():
     
     parser.add_argument('-d', '--directory', dest='directory', help='Directory to read alignment files')
     
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int, default=1000, help='Number of sequences to read and count at a time')
+    
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help='Number of participants to process in parallel')
+    
+    parser.add_argument('-n', '--nucleotide', dest='nucleotide', action='store_true', help='Read nucleotide alignments (*_rev2miss.aln) and translate them in memory')
+    
+    parser.add_argument('--write-translated', dest='write_translated', action='store_true', help='With --nucleotide, also write each translated alignment to disk')
+    
+    parser.add_argument('--no-alignment-consensus', dest='alignment_consensus', action='store_false', help='Do not write the copy of each alignment with its consensus appended')
+    
+    parser.add_argument('-f', '--force', dest='force', action='store_true', help='Reprocess every participant, even if its alignment has not changed since the last run')
+    
     args = parser.parse_args()
     
     return args
     
     
 def get_counts_matrix(sequences):
-    """From a list of DNA sequences, creates a matrix counting amino acid frequencies at each position of a DNA sequence;
+    """From a list of protein sequences, creates a matrix counting amino acid frequencies at each position of the alignment
     @input: list of sequences from MSA
     @return: amino acid frequency matrix at each position"""
     
-    # initialize a matrix of zeros with length = sequence length
-    count_matrix = np.zeros([22, len(sequences[0])], dtype = int)
+    # encode every sequence as a row of amino acid indices
+    encoded = encode_sequences(sequences, len(sequences[0]))
     
-    # create a dataframe from zeros matrix with amino acid options as indices
-    counts = pd.DataFrame(count_matrix, index = ['a', 'c', 'd', 'e', 'f', 'g', 'h', 
-    'i', 'k', 'l', 'm', 'n', 'p', 'q', 'r', 's', 't', 'v', 'w', 'y', 'x', '-'])
+    # count every amino acid at every position in one batch
+    count_matrix = count_encoded_sequences(encoded)
     
-    # for each sequence from MSA
-    for seq in sequences:
-        
-        # look at each amino acid in sequence
-        for ind, aa in enumerate(seq):
-            
-            # add 1 to counts matrix for observed amino acid
-            counts[ind][aa] += 1
+    # create a dataframe from count matrix with amino acid options as indices
+    counts = pd.DataFrame(count_matrix, index = AMINO_ACIDS)
             
     return counts
+
+
+def encode_sequences(sequences, length):
+    """From a list of protein sequences, creates a uint8 matrix of amino acid indices (rows are sequences, columns are positions);
+    positions past the end of a shorter sequence are filled with PADDING and are not counted
+    @input: list of sequences from MSA, alignment length
+    @return: encoded alignment matrix"""
+    
+    # initialize a matrix filled with padding
+    raw = np.full([len(sequences), length], PADDING, dtype = np.uint8)
+    
+    # put the raw characters of each sequence into its row
+    for row, seq in enumerate(sequences):
+        
+        # sequences longer than the alignment have no column to be counted in
+        if len(seq) > length:
+            raise ValueError(f'Sequence {row + 1} is longer than the alignment ({len(seq)} > {length})')
+        
+        raw[row, :len(seq)] = np.frombuffer(seq.encode('ascii'), dtype = np.uint8)
+    
+    # translate raw characters to amino acid indices, padding stays padding
+    encoded = AA_LOOKUP[raw]
+    
+    # any character that is not one of the amino acid options is an error
+    invalid = encoded == INVALID
+    if invalid.any():
+        bad = [chr(c) for c in np.unique(raw[invalid])]
+        raise ValueError(f'Unexpected characters in alignment: {bad}')
     
+    return encoded
+
+
+def count_encoded_sequences(encoded):
+    """From an encoded alignment matrix, counts every amino acid option at every position with a single bincount
+    @input: encoded alignment matrix
+    @return: numpy matrix of counts, amino acid options x positions"""
     
+    n_aa = len(AMINO_ACIDS)
+    length = encoded.shape[1]
+    
+    # give every (position, amino acid) pair its own bin, padding is dropped
+    bins = encoded.astype(np.int64) + np.arange(length, dtype = np.int64) * n_aa
+    bins = bins[encoded != PADDING]
+    
+    # count every bin at once, reshape to positions x amino acids
+    counts = np.bincount(bins, minlength = length * n_aa).reshape(length, n_aa)
+    
+    return counts.T
+    
+    
+def get_counts_matrix_from_file(aln_file, chunk_size=1000):
+    """From a MSA file, creates the amino acid frequency matrix by reading and counting chunk_size sequences at a time,
+    so memory depends on the alignment length rather than the number of sequences
+    @input: name of alignment file (may be gzip or bz2 compressed), number of sequences per chunk
+    @return: amino acid frequency matrix at each position"""
+    
+    return get_counts_matrix_from_chunks(get_sequence_chunks_from_file(aln_file, chunk_size), aln_file)
+
+
+def get_counts_matrix_from_chunks(chunks, name):
+    """From chunks of protein sequences, creates the amino acid frequency matrix by folding each chunk into a running count matrix
+    @input: iterable of lists of sequences, name of the alignment for error messages
+    @return: amino acid frequency matrix at each position"""
+    
+    count_matrix = None
+    
+    for chunk in chunks:
+        
+        # the first sequence sets the alignment length
+        if count_matrix is None:
+            length = len(chunk[0])
+            count_matrix = np.zeros([len(AMINO_ACIDS), length], dtype = np.int64)
+        
+        # fold the chunk into the running count matrix
+        count_matrix += count_encoded_sequences(encode_sequences(chunk, length))
+    
+    if count_matrix is None:
+        raise ValueError(f'No sequences found in {name}')
+    
+    # create a dataframe from count matrix with amino acid options as indices
+    counts = pd.DataFrame(count_matrix, index = AMINO_ACIDS)
+    
+    return counts
+
+
+def get_translated_chunks_from_file(aln_file, chunk_size, outputs=()):
+    """From a nucleotide MSA file, reads and translates chunk_size sequences at a time, writing each translated chunk to every open output file
+    @input: name of nucleotide alignment file (may be gzip or bz2 compressed), number of sequences per chunk, open files to write translated sequences to
+    @return: generator of lists of protein sequences"""
+    
+    records = iter_fasta(aln_file)
+    
+    while True:
+        
+        # get the next chunk of records, keep just the ID from each header like the translation script does
+        chunk = [(header.split()[0], seq) for header, seq in itertools.islice(records, chunk_size)]
+        if not chunk:
+            break
+        
+        ids, seqs = zip(*chunk)
+        
+        # translate the whole chunk at once
+        translated = translate_sequences(list(seqs), ids)
+        
+        # write header and translated sequence to every output
+        for output in outputs:
+            output.writelines(f'>{id}\n{seq}\n' for id, seq in zip(ids, translated))
+        
+        yield translated
+
+
+def get_sequence_chunks_from_file(aln_file, chunk_size):
+    """From a MSA file, reads lists of at most chunk_size sequences
+    @input: name of alignment file (may be gzip or bz2 compressed), number of sequences per chunk
+    @return: generator of lists of lower case sequences"""
+    
+    chunk = []
+    
+    for header, seq in iter_fasta(aln_file):
+        
+        chunk.append(seq.lower())
+        
+        # hand back a full chunk and start the next one
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    
+    # hand back the last partial chunk
+    if chunk:
+        yield chunk
+
+
 def get_sequences_from_file(aln_file):
     """From a MSA file, creates a list of sequences
-    @input: name of alignment file
-    @return: list of DNA sequences"""
+    @input: name of alignment file (may be gzip or bz2 compressed)
+    @return: list of protein sequences"""
     
     # open file
-    with open(aln_file, 'r') as aln_file:
+    with open_text(aln_file) as aln_file:
         
         # initialize list of sequences for file
         sequences = []
         
         # read each line of file
-        for line in aln_file.readlines():
+        for line in aln_file:
             
             # skip header lines
             if line.startswith('>'):
@@ -108,10 +335,25 @@ def get_sequences_from_file(aln_file):
         return sequences
 
 
-def counts_to_sequence(pos):
-    top_aa = pos.dropna().index
-    key = ''.join(sorted(top_aa))
-    return key
+def get_consensus(counts):
+    """From an amino acid frequency matrix, gets the most common amino acid at each position;
+    ties are reported as every tied amino acid in sorted order (e.g. 'ak')
+    @input: amino acid frequency matrix (dataframe or numpy matrix, amino acid options x positions)
+    @return: list of consensus characters, one per position"""
+    
+    counts = np.asarray(counts)
+    
+    # find every amino acid with the highest count at each position
+    most_common = counts == counts.max(axis=0)
+    
+    # most positions have a single top amino acid, take it directly
+    consensus = SORTED_AMINO_ACIDS[np.argmax(most_common[SORTED_ORDER], axis=0)].tolist()
+    
+    # join tied amino acids in sorted order
+    for pos in np.flatnonzero(most_common.sum(axis=0) > 1):
+        consensus[pos] = ''.join(SORTED_AMINO_ACIDS[most_common[SORTED_ORDER, pos]])
+    
+    return consensus
 
 
 if __name__ == "__main__":
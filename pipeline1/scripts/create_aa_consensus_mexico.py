@@ -1,49 +1,158 @@
 #!/usr/bin/env python3
 
-"""Program to create consensus sequences for every protein alignment file in directory, outputs a file containing all consensus sequences for experiment"""
+"""Program to create consensus sequences for every protein alignment file in directory, outputs a file containing all consensus sequences for experiment;
+with --codon, consensus sequences are instead built from the most frequent codon at each position of every nucleotide alignment (*.aln) and translated"""
 
-import os
 import argparse
+import itertools
 import numpy as np
-import pandas as pd
-import argparse
-import shutil
-
+from concurrent.futures import ProcessPoolExecutor
+from catalog import open_catalog
+from create_aa_consensus import run_consensus
+from file_utils import atomic_writer, iter_fasta, strip_compression_suffix
+from manifest import Manifest
+from translate_fasta import translate_sequences
 
 
 def main():
     # get command line arguments
     args = get_args()
     
-    # load in alignment files as list
-    aln_files = [f for f in os.listdir(args.directory) if f.endswith('.aln.translated')]
+    # create consensus for every participant, write combined consensus file
+    if args.codon:
+        run_codon_consensus(args.directory, args.outfile, args.jobs, args.chunk_size, args.write_nucleotide, args.force)
+    else:
+        run_consensus(args.directory, '.aln.translated', args.outfile, args.jobs, args.chunk_size, force = args.force)
+
+
+def run_codon_consensus(directory, outfile, jobs=1, chunk_size=1000, write_nucleotide=False, force=False):
+    """Creates codon consensus sequences for every nucleotide alignment file (*.aln) in directory across jobs processes, translates them,
+    and writes all translated consensus sequences to outfile once, in file name order; alignments that have not changed since the 
+    last run are taken from the manifest unless force is set"""
+    
+    # load in alignment files as list (plain, gzip or bz2 compressed)
+    aln_files = open_catalog(directory).list_files('.aln')
+    
+    # load record of alignments already processed
+    manifest = Manifest(directory, 'codon_consensus', force = force)
+    params = {'write_nucleotide': write_nucleotide}
+    outputs = {file: [f'{directory}/{strip_compression_suffix(file)}.consensus', f'{directory}/{strip_compression_suffix(file)}.consensus.unaligned'] if write_nucleotide else []
+               for file in aln_files}
+    
+    # one task per alignment that changed
+    tasks = [(directory, file, chunk_size, write_nucleotide) for file in aln_files 
+             if not manifest.is_current(file, [f'{directory}/{file}'], params, outputs[file])]
+    
+    # fan participants out to a process pool, or run in this process for a single job
+    if jobs > 1 and tasks:
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            new_results = list(executor.map(create_codon_consensus_for_file, *zip(*tasks)))
+    else:
+        new_results = [create_codon_consensus_for_file(*task) for task in tasks]
+    
+    # record newly processed alignments
+    for result, task in zip(new_results, tasks):
+        manifest.record(task[1], [f'{directory}/{task[1]}'], params, outputs[task[1]], result = list(result))
+    manifest.save()
+    
+    # write translated consensus sequences in one go, in file name order
+    with atomic_writer(f'{directory}/{outfile}') as out:
+        for file in aln_files:
+            individual_id, protein = manifest.result(file)
+            out.write(f'>{individual_id}\n{protein}\n')
+
 
+def create_codon_consensus_for_file(directory, file, chunk_size, write_nucleotide=False):
+    """Creates the codon consensus sequence for one participant's nucleotide alignment and translates it;
+    optionally writes the nucleotide consensus to <file>.consensus (with gap codons) and <file>.consensus.unaligned (without)
+    @input: directory, alignment file name, number of sequences per chunk, whether to write the nucleotide consensus files
+    @return: tuple of (individual ID, translated consensus sequence)"""
+    
+    # individual ID is the file name up to the first '.'
+    individual_id = file.split('.')[0]
     
-    # for each file in the list
-    for file in aln_files:
+    # get most frequent codon at each position
+    codons = get_codon_consensus_from_file(f'{directory}/{file}', chunk_size)
+    
+    if write_nucleotide:
+        aln_file = f'{directory}/{strip_compression_suffix(file)}'
+        with atomic_writer(f'{aln_file}.consensus') as aligned, atomic_writer(f'{aln_file}.consensus.unaligned') as unaligned:
+            aligned.write(f'>{individual_id} Consensus Sequence\n{"".join(codons)}\n')
+            unaligned.write(f'>{individual_id} Consensus Sequence\n{"".join(c for c in codons if c != "---")}\n')
+    
+    # translate consensus directly
+    protein = translate_sequences([''.join(codons)], [individual_id])[0]
+    
+    return individual_id, protein
+
+
+def get_codon_consensus_from_file(aln_file, chunk_size=1000):
+    """From a nucleotide MSA file, finds the most frequent codon at each position, reading chunk_size sequences at a time;
+    ties go to the alphabetically last codon and codons are compared as written (case sensitive), like get_consensus_by_codon_mexico.pl
+    @input: name of alignment file (may be gzip or bz2 compressed), number of sequences per chunk
+    @return: list of consensus codons, one per position"""
+    
+    # sorted array of every packed codon seen so far, and count matrix (positions x codons seen)
+    vocab = np.zeros(0, dtype = np.uint32)
+    counts = np.zeros([0, 0], dtype = np.int64)
+    
+    records = iter_fasta(aln_file)
+    
+    while True:
         
-        individual_id = file.replace('.aln.translated', '')
+        # get the next chunk of sequences
+        chunk = [seq for header, seq in itertools.islice(records, chunk_size)]
+        if not chunk:
+            break
         
-        # get list of sequences
-        sequences = get_sequences_from_file(f'{args.directory}/{file}')
+        # pack every codon of the chunk into one integer, 0 where a sequence has ended
+        packed = pack_codons(chunk)
         
-        # get amino acid frequency counts
-        counts = get_counts_matrix(sequences)
+        # grow the count matrix to cover longer sequences and newly seen codons
+        observed = np.unique(packed[packed != 0])
+        new_vocab = np.union1d(vocab, observed)
+        new_counts = np.zeros([max(counts.shape[0], packed.shape[1]), len(new_vocab)], dtype = np.int64)
+        new_counts[:counts.shape[0], np.searchsorted(new_vocab, vocab)] = counts
+        vocab, counts = new_vocab, new_counts
         
-        # reconstruct sequence from count matrix
-        most_common = counts[counts == counts.max(axis=0)]
-        consensus = most_common.apply(counts_to_sequence, axis=0)
+        # count every (position, codon) pair of the chunk at once
+        position = np.broadcast_to(np.arange(packed.shape[1]), packed.shape)[packed != 0]
+        codon = np.searchsorted(vocab, packed[packed != 0])
+        counts += np.bincount(position * len(vocab) + codon, minlength = counts.size).reshape(counts.shape)
+    
+    if not len(vocab):
+        raise ValueError(f'No sequences found in {aln_file}')
+    
+    # highest count wins, ties go to the last (alphabetically greatest) codon
+    best = len(vocab) - 1 - np.argmax(counts[:, ::-1], axis = 1)
+    
+    return [unpack_codon(c) for c in vocab[best]]
 
-        # make copy of alignment file
-        shutil.copyfile(f'{args.directory}/{individual_id}.aln.translated', f'{args.directory}/{individual_id}.aln.translated.consensus')
-        
-        # write consensus sequence to copied file
-        with open(f'{args.directory}/{individual_id}.aln.translated.consensus', 'a') as outfile1:
-            outfile1.write(f'>{individual_id} Consensus Sequence\n')
-            outfile1.write(''.join(consensus))
-        with open(f'{args.directory}/{args.outfile}', 'a') as outfile2:
-            outfile2.write(f'\n>{individual_id} Consensus Sequence\n')
-            outfile2.write(''.join(consensus))
+
+def pack_codons(sequences):
+    """From a list of nucleotide sequences, creates a matrix with each codon packed into one integer (first base in the highest byte),
+    so integer order is the same as alphabetical order of the codons; missing bases past the end of a sequence are 0
+    @input: list of sequences
+    @return: packed codon matrix (sequences x codons)"""
+    
+    # number of codons, counting a trailing partial codon
+    n_codons = -(-max(len(seq) for seq in sequences) // 3)
+    
+    # put the raw characters of each sequence into its row
+    raw = np.zeros([len(sequences), n_codons * 3], dtype = np.uint8)
+    for row, seq in enumerate(sequences):
+        raw[row, :len(seq)] = np.frombuffer(seq.encode('ascii'), dtype = np.uint8)
+    
+    # pack each codon's three characters into one integer
+    raw = raw.reshape(len(sequences), n_codons, 3).astype(np.uint32)
+    
+    return (raw[:, :, 0] << 16) | (raw[:, :, 1] << 8) | raw[:, :, 2]
+
+
+def unpack_codon(packed):
+    """Turns a packed codon back into its characters"""
+    
+    return bytes([int(packed) >> 16, (int(packed) >> 8) & 255, int(packed) & 255]).rstrip(b'\x00').decode('ascii')
 
 
 def get_args():
@@ -54,66 +163,21 @@ def get_args():
     
     parser.add_argument('-d', '--directory', dest='directory', help='Directory to read alignment files')
     
-    args = parser.parse_args()
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int, default=1000, help='Number of sequences to read and count at a time')
     
-    return args
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help='Number of participants to process in parallel')
     
+    parser.add_argument('--codon', dest='codon', action='store_true', help='Build translated codon consensus sequences from the nucleotide alignments (*.aln)')
     
-def get_counts_matrix(sequences):
-    """From a list of DNA sequences, creates a matrix counting amino acid frequencies at each position of a DNA sequence;
-    @input: list of sequences from MSA
-    @return: amino acid frequency matrix at each position"""
+    parser.add_argument('--write-nucleotide', dest='write_nucleotide', action='store_true', help='With --codon, also write each nucleotide consensus to <alignment>.consensus and <alignment>.consensus.unaligned')
     
-    # initialize a matrix of zeros with length = sequence length
-    count_matrix = np.zeros([22, len(sequences[0])], dtype = int)
+    parser.add_argument('-f', '--force', dest='force', action='store_true', help='Reprocess every participant, even if its alignment has not changed since the last run')
+    
+    args = parser.parse_args()
+    
+    return args
     
-    # create a dataframe from zeros matrix with amino acid options as indices
-    counts = pd.DataFrame(count_matrix, index = ['a', 'c', 'd', 'e', 'f', 'g', 'h', 
-    'i', 'k', 'l', 'm', 'n', 'p', 'q', 'r', 's', 't', 'v', 'w', 'y', 'x', '-'])
     
-    # for each sequence from MSA
-    for seq in sequences:
-        
-        # look at each amino acid in sequence
-        for ind, aa in enumerate(seq):
-            
-            # add 1 to counts matrix for observed amino acid
-            counts[ind][aa] += 1
-            
-    return counts
-    
-    
-def get_sequences_from_file(aln_file):
-    """From a MSA file, creates a list of sequences
-    @input: name of alignment file
-    @return: list of DNA sequences"""
-    
-    # open file
-    with open(aln_file, 'r') as aln_file:
-        
-        # initialize list of sequences for file
-        sequences = []
-        
-        # read each line of file
-        for line in aln_file.readlines():
-            
-            # skip header lines
-            if line.startswith('>'):
-                continue
-            
-            # append sequences to sequence list
-            else: 
-                sequences.append(line.lower().strip())
-        
-        return sequences
-
-
-def counts_to_sequence(pos):
-    top_aa = pos.dropna().index
-    key = ''.join(sorted(top_aa))
-    return key
-
-
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""Helper functions shared by the pipeline1 scripts for reading (optionally compressed) sequence files and writing outputs atomically"""
+
+import bz2
+import contextlib
+import gzip
+import os
+import tempfile
+
+
+# suffixes of compressed files that can be read transparently
+COMPRESSION_SUFFIXES = ['.gz', '.bz2']
+
+
+def open_text(filename):
+    """Opens a text file for reading, transparently decompressing gzip or bz2 files
+    @input: name of file
+    @return: open text file handle"""
+
+    # look at the first bytes of the file to see if it is compressed
+    with open(filename, 'rb') as handle:
+        magic = handle.read(3)
+
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(filename, 'rt')
+
+    if magic == b'BZh':
+        return bz2.open(filename, 'rt')
+
+    return open(filename, 'r')
+
+
+def strip_compression_suffix(filename):
+    """Removes a .gz or .bz2 suffix from a file name, if it has one"""
+
+    for suffix in COMPRESSION_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+
+    return filename
+
+
+def iter_fasta(filename):
+    """Reads a fasta file one record at a time, so only one sequence is held in memory
+    @input: name of fasta file (may be gzip or bz2 compressed)
+    @return: generator of (header, sequence) tuples, header without the '>'"""
+
+    with open_text(filename) as seqfile:
+
+        header = None
+        lines = []
+
+        for line in seqfile:
+
+            line = line.strip()
+
+            # header line starts a new record, hand back the previous one
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(lines)
+                header = line[1:]
+                lines = []
+
+            # sequence lines (possibly wrapped) belong to the current record
+            elif line:
+                lines.append(line)
+
+        # hand back the last record
+        if header is not None:
+            yield header, ''.join(lines)
+
+
+@contextlib.contextmanager
+def atomic_writer(filename, mode='w'):
+    """Opens a temporary file next to filename for writing and renames it over filename once writing finishes,
+    so readers never see a partially written file and a failed run leaves the old file in place
+    @input: name of file to write, file mode ('w' or 'wb')
+    @return: context manager giving the open temporary file"""
+
+    directory = os.path.dirname(os.path.abspath(filename))
+
+    # temporary file in the same directory, so the rename stays on one filesystem
+    fd, tmp_name = tempfile.mkstemp(dir = directory, prefix = f'.{os.path.basename(filename)}.', suffix = '.tmp')
+    os.chmod(tmp_name, 0o644)
+
+    try:
+        with os.fdopen(fd, mode) as handle:
+            yield handle
+        os.replace(tmp_name, filename)
+
+    except BaseException:
+        # clean up the temporary file, leave the old output untouched
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
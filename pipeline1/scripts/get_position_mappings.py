@@ -6,10 +6,27 @@ showing codon position mappings for HXB2, the aligned consensus, and the origina
 
 Run with 'python3 get_seq_pos_mappings_from_alignments.py -c [file with consensus seqs] -a [file of consensus seqs aligned to HXB2]' '''
 
+import json
 import argparse
 import numpy as np
 import pandas as pd
-from Bio import SeqIO
+from file_utils import atomic_writer, iter_fasta
+from manifest import Manifest, text_digest
+
+
+# characters counted as amino acids, anything else (e.g. '-') is a gap
+AMINO_ACIDS = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y','X', 'B', 'Z', 'J']
+
+# lookup table from a raw (upper case) character to whether it is an amino acid
+IS_AMINO_ACID = np.zeros(256, dtype = bool)
+IS_AMINO_ACID[[ord(aa) for aa in AMINO_ACIDS]] = True
+
+# column names of the position mappings, and the value used for gaps in the binary index
+MAPPING_COLUMNS = ['HXB2 Position', 'Consensus Aligned to HXB2 Position', 'Original Consensus Position']
+GAP = -1
+
+# the same columns as R names them in the consensus annotations (spaces become dots)
+ANNOTATION_COLUMNS = [column.replace(' ', '.') for column in MAPPING_COLUMNS]
 
 
 def main():
@@ -25,6 +42,12 @@ def main():
     # remove hxb2 from dict, get aligned hxb2 sequence as object
     hxb2_aln_seq = cons_aln_with_hxb2_dict.pop('MH758564.1')
     
+    # position mappings for every individual, to be stored together in the binary index
+    mappings = {}
+    
+    # load record of mapping files already written
+    manifest = Manifest(args.directory, 'position_mappings', force = args.force)
+    
     # for each individual identifier
     for id in og_cons_dict.keys():
         
@@ -34,9 +57,21 @@ def main():
         
         # get pandas dataframe that has position mappings
         pos_mapping_df = create_pos_mapping_df(hxb2_aln_seq, aln_con_seq, og_con_seq)
+        mappings[id] = pos_mapping_df
         
-        # save that mapping to a file for later use in R
-        pos_mapping_df.to_csv(f'{args.directory}/{id}_position_mappings.csv')
+        # save that mapping to a file for later use in R, unless the sequences it comes from have not changed
+        if args.csv:
+            outputs = [f'{args.directory}/{id}_position_mappings.csv']
+            params = {'sequences': text_digest('\n'.join([hxb2_aln_seq, aln_con_seq, og_con_seq]))}
+            if not manifest.is_current(id, [], params, outputs):
+                with atomic_writer(outputs[0]) as outfile:
+                    pos_mapping_df.to_csv(outfile)
+                manifest.record(id, [], params, outputs)
+    
+    manifest.save()
+    
+    # save all mappings for the cohort as one binary index
+    write_position_index(args.index or f'{args.directory}/position_index', mappings)
         
    
 def get_args():
@@ -53,53 +88,38 @@ def get_args():
     
     parser.add_argument('-d', '--dir', type = str, dest = 'directory', help = 'Directory to write position mapping files')
     
+    parser.add_argument('-i', '--index', type = str, dest = 'index', help = 'Path (without extension) of the binary position index, default [directory]/position_index')
+    
+    parser.add_argument('--csv', action = argparse.BooleanOptionalAction, dest = 'csv', default = True, help = 'Export one position mapping CSV per individual')
+    
+    parser.add_argument('-f', '--force', action = 'store_true', dest = 'force', help = 'Rewrite every mapping file, even if its sequences have not changed since the last run')
+    
     args = parser.parse_args() 
     return args
     
     
 def get_sequence_dict_from_file(filename):
-    '''Function to open fasta file and create dictionary with format {header: sequence....}'''
-   
-    # open file
-    with open(filename, 'r') as seqfile:
-        
-        # get dictionary
-        seq_dict = SeqIO.to_dict(SeqIO.parse(seqfile, "fasta"))
-        
-        return seq_dict
+    '''Function to open fasta file and create dictionary with format {header: sequence....}, header is the sequence ID (up to the first space)'''
+    
+    # get dictionary
+    seq_dict = {header.split()[0]: seq for header, seq in iter_fasta(filename)}
+    
+    return seq_dict
         
 
 def get_seq_positions(seq):
-    '''Function to iterate through a protein sequence (that may contain gaps) and create an array
+    '''Function to take a protein sequence (that may contain gaps) and create an array
     that maps index position (of the array) to protein position of the sequence if it did not have gaps'''
     
-    # remove newline characters from sequence, uppercase sequence
-    seq = seq.upper()
-    
-    # initialize amino acid list
-    amino_acids = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y','X', 'B', 'Z', 'J']
-    
-    # initialize position counter
-    pos_count = 0
-    
-    # create an array of length seq, all zeros
-    seq_pos = np.zeros(len(seq))
-    
-    # for each position in sequence,
-    for ind, aa in enumerate(seq):
-       
-        # if position is an amino acid,
-        if aa in amino_acids:
-            
-            # add to count,
-            pos_count += 1 
-            
-            # put new count into array
-            seq_pos[ind] = pos_count
-        
-        else:
-            # position is a gap ('-'), put NaN into array
-            seq_pos[ind] = 'NaN'
+    # uppercase sequence, get characters as an array
+    seq = np.frombuffer(str(seq).upper().encode('ascii'), dtype = np.uint8)
+    
+    # mark positions that are amino acids
+    is_aa = IS_AMINO_ACID[seq]
+    
+    # count amino acids up to and including each position, gaps ('-') are NaN
+    seq_pos = np.cumsum(is_aa).astype(float)
+    seq_pos[~is_aa] = np.nan
     
     # returns array of sequence positions
     return seq_pos
@@ -120,7 +140,7 @@ def create_pos_mapping_df(hxb2_seq, aln_con_seq, og_con_seq):
     length = len(max(l, key = len))
    
     # creating a list of index and column names 
-    index_values = ['HXB2 Position', 'Consensus Aligned to HXB2 Position', 'Original Consensus Position'] 
+    index_values = MAPPING_COLUMNS
     # use the length value created earlier
     column_values = range(1, length + 1)  
   
@@ -131,6 +151,54 @@ def create_pos_mapping_df(hxb2_seq, aln_con_seq, og_con_seq):
     
     # returns finished dataframe
     return pos_mapping_df
+
+
+def write_position_index(prefix, mappings):
+    '''Function to save the position mappings of every individual as one binary index: [prefix].npy holds an int32 matrix 
+    (rows are positions of all individuals one after the other, columns are MAPPING_COLUMNS, gaps are GAP), 
+    [prefix].json holds the column names, gap value and the [start, stop) rows of each individual'''
+    
+    # stack every individual's mapping, gaps become the sentinel value
+    ids = list(mappings.keys())
+    matrix = np.concatenate([mappings[id].to_numpy() for id in ids]) if ids else np.zeros([0, len(MAPPING_COLUMNS)])
+    matrix = np.where(np.isnan(matrix), GAP, matrix).astype(np.int32)
+    
+    # rows of each individual
+    stops = np.cumsum([len(mappings[id]) for id in ids]).tolist()
+    starts = [0] + stops[:-1]
+    
+    meta = {'columns': MAPPING_COLUMNS, 
+            'gap': GAP, 
+            'participants': {id: [start, stop] for id, start, stop in zip(ids, starts, stops)}}
+    
+    with atomic_writer(f'{prefix}.npy', 'wb') as outfile:
+        np.save(outfile, matrix)
+    with atomic_writer(f'{prefix}.json') as outfile:
+        json.dump(meta, outfile, indent = 1)
+
+
+def load_position_index(prefix, mmap_mode = 'r'):
+    '''Function to open a binary position index written by write_position_index without reading it all into memory;
+    returns a dictionary with format {id: int32 matrix of positions....}, each matrix is a memory-mapped view
+    (row i is alignment column i + 1, columns are MAPPING_COLUMNS, gaps are GAP)'''
+    
+    # open matrix as memory map
+    matrix = np.load(f'{prefix}.npy', mmap_mode = mmap_mode)
+    
+    # get rows of each individual
+    with open(f'{prefix}.json', 'r') as infile:
+        meta = json.load(infile)
+    
+    return {id: matrix[start:stop] for id, (start, stop) in meta['participants'].items()}
+
+
+def get_position_frame(positions):
+    '''Function to turn one individual's matrix of positions from load_position_index into a dataframe with the position columns
+    of the consensus annotations (ANNOTATION_COLUMNS, gaps as NaN, index from 0 like the csv as read by pandas), so it can be used for liftover'''
+    
+    positions = np.asarray(positions, dtype = float)
+    
+    return pd.DataFrame(np.where(positions == GAP, np.nan, positions), columns = ANNOTATION_COLUMNS)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""Manifest of what each pipeline stage has already produced, so reruns only redo participants whose inputs or parameters changed.
+Each stage keeps its own manifest file in the directory it works on ([directory]/.manifest_[stage].json) recording, per participant,
+a content hash of every input file, the parameters used and the outputs written"""
+
+import os
+import json
+import hashlib
+from file_utils import atomic_writer
+
+
+def text_digest(text):
+    """Returns the sha256 hex digest of a string"""
+
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class Manifest:
+    """Record of the inputs, parameters and outputs of every participant processed by one pipeline stage in one directory"""
+
+    def __init__(self, directory, stage, force=False):
+        """Loads the stage's manifest from directory; with force, every participant is treated as out of date"""
+
+        self.path = f'{directory}/.manifest_{stage}.json'
+        self.force = force
+
+        # manifest holds a hash cache for input files and one entry per participant
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as infile:
+                self.data = json.load(infile)
+        else:
+            self.data = {'files': {}, 'entries': {}}
+
+    def file_digest(self, filename):
+        """Returns the sha256 hex digest of a file's contents; files whose size and modification time have not changed
+        since they were last hashed are not read again"""
+
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+
+        # reuse the cached hash if the file looks unchanged
+        cached = self.data['files'].get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        # hash file in blocks
+        digest = hashlib.sha256()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                digest.update(block)
+
+        self.data['files'][path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+        return digest.hexdigest()
+
+    def signature(self, inputs, params=None):
+        """Returns the signature of a set of input files and parameters, as stored in the manifest"""
+
+        return {'inputs': {os.path.basename(f): self.file_digest(f) for f in inputs},
+                'params': params or {}}
+
+    def is_current(self, key, inputs, params=None, outputs=()):
+        """Checks whether participant key was last processed with the same input file contents and parameters,
+        and every output it recorded, and every output expected now (outputs), exists"""
+
+        if self.force:
+            return False
+
+        entry = self.data['entries'].get(key)
+        if entry is None:
+            return False
+
+        # compare against a json round trip, so tuples and lists compare equal
+        signature = json.loads(json.dumps(self.signature(inputs, params)))
+
+        # outputs expected now may differ from those recorded (e.g. renamed), both have to exist
+        return entry['signature'] == signature and all(os.path.exists(f) for f in set(entry['outputs']) | set(outputs))
+
+    def record(self, key, inputs, params=None, outputs=(), result=None):
+        """Records that participant key has been processed; result is any json-serializable value to hand back on later runs"""
+
+        self.data['entries'][key] = {'signature': self.signature(inputs, params),
+                                     'outputs': list(outputs),
+                                     'result': result}
+
+    def result(self, key):
+        """Returns the result recorded for participant key"""
+
+        return self.data['entries'][key]['result']
+
+    def save(self):
+        """Writes the manifest back to disk"""
+
+        with atomic_writer(self.path) as outfile:
+            json.dump(self.data, outfile, indent = 1)
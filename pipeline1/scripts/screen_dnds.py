@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""Script to estimate dN and dS at every codon site of every participant alignment with a counting method (Nei-Gojobori),
+as a quick pre-screen to decide which participants and regions are worth a full HyPhy FUBAR run.
+Every sequence is compared to the participant's codon consensus: synonymous and nonsynonymous sites and differences are summed
+over the sequences at each codon site and Jukes-Cantor corrected. Output is [alignment].NG_simple.txt (and .npz), with the same
+layout as the FUBAR _simple.txt files (P(dS<dN) is NaN, the method gives no posterior), so create_dNdS_tables.py can read them"""
+
+import argparse
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from catalog import open_catalog
+from file_utils import iter_fasta, strip_compression_suffix
+from manifest import Manifest
+from simplify_fubar_data import write_site_table
+from translate_fasta import GENETIC_CODE, NUCLEOTIDE_MASKS, N_VALUES, get_codon_indices
+
+
+# sense codons get an index from 0 to 63 (bases in ACGT order), anything else (gaps, ambiguous bases, stop codons) is INVALID
+BASES = 'ACGT'
+CODONS = [''.join(codon) for codon in itertools.product(BASES, repeat = 3)]
+INVALID = -1
+
+# suffix added to the alignment file name for the output tables
+OUTPUT_SUFFIX = '.NG'
+
+
+def build_sense_lookup():
+    """Builds a lookup table from a packed codon index (see translate_fasta.get_codon_indices) to a sense codon index, INVALID otherwise"""
+
+    lookup = np.full(N_VALUES ** 3, INVALID, dtype = np.int8)
+
+    for ind, codon in enumerate(CODONS):
+        if GENETIC_CODE[codon] != '*':
+            m0, m1, m2 = (NUCLEOTIDE_MASKS[base] for base in codon)
+            lookup[(m0 * N_VALUES + m1) * N_VALUES + m2] = ind
+
+    return lookup
+
+
+def count_sites(codon):
+    """Counts the synonymous sites of a codon: the fraction of single base changes at each position that keep the amino acid,
+    summed over the three positions (changes to a stop codon count as nonsynonymous); returns (synonymous, nonsynonymous) sites"""
+
+    synonymous = 0
+    for pos in range(3):
+        for base in BASES:
+            if base != codon[pos]:
+                mutant = codon[:pos] + base + codon[pos + 1:]
+                synonymous += GENETIC_CODE[mutant] == GENETIC_CODE[codon]
+
+    return synonymous / 3, 3 - synonymous / 3
+
+
+def count_differences(codon1, codon2):
+    """Counts the synonymous and nonsynonymous differences between two sense codons, averaged over every order of changing
+    the differing positions one at a time, leaving out paths through a stop codon; returns (synonymous, nonsynonymous) differences"""
+
+    positions = [pos for pos in range(3) if codon1[pos] != codon2[pos]]
+
+    paths = 0
+    synonymous = 0
+    nonsynonymous = 0
+
+    for order in itertools.permutations(positions):
+
+        codon = codon1
+        path_synonymous = 0
+        path_nonsynonymous = 0
+
+        for pos in order:
+            mutant = codon[:pos] + codon2[pos] + codon[pos + 1:]
+            if GENETIC_CODE[mutant] == '*':
+                break
+            if GENETIC_CODE[mutant] == GENETIC_CODE[codon]:
+                path_synonymous += 1
+            else:
+                path_nonsynonymous += 1
+            codon = mutant
+        else:
+            paths += 1
+            synonymous += path_synonymous
+            nonsynonymous += path_nonsynonymous
+
+    if not paths:
+        return 0.0, float(len(positions))
+
+    return synonymous / paths, nonsynonymous / paths
+
+
+def build_tables():
+    """Builds the synonymous/nonsynonymous site counts of every sense codon (64) and difference counts of every pair of codons (64x64),
+    entries for stop codons are 0"""
+
+    sites = np.zeros((2, len(CODONS)))
+    differences = np.zeros((2, len(CODONS), len(CODONS)))
+
+    sense = [ind for ind, codon in enumerate(CODONS) if GENETIC_CODE[codon] != '*']
+
+    for ind in sense:
+        sites[:, ind] = count_sites(CODONS[ind])
+
+    for ind1, ind2 in itertools.product(sense, repeat = 2):
+        differences[:, ind1, ind2] = count_differences(CODONS[ind1], CODONS[ind2])
+
+    return sites, differences
+
+
+# lookup tables of sense codons, sites and differences
+SENSE_LOOKUP = build_sense_lookup()
+SITES, DIFFERENCES = build_tables()
+
+
+def main():
+    # get command line arguments
+    args = get_args()
+
+    # alignment files in directory
+    aln_files = open_catalog(args.directory).list_files(args.suffix)
+
+    # load record of alignments already screened
+    manifest = Manifest(args.directory, 'screen_dnds', force = args.force)
+
+    # inputs and outputs of each alignment file
+    prefixes = {file: f'{args.directory}/{strip_compression_suffix(file)}{OUTPUT_SUFFIX}' for file in aln_files}
+    inputs = {file: [f'{args.directory}/{file}'] for file in aln_files}
+    outputs = {file: [f'{prefixes[file]}_simple.txt', f'{prefixes[file]}_simple.npz'] for file in aln_files}
+
+    # skip files that have not changed since they were last screened
+    todo = [file for file in aln_files if not manifest.is_current(file, inputs[file], outputs = outputs[file])]
+
+    # screen files in a process pool, or in this process for a single job
+    if args.jobs > 1 and todo:
+        with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+            list(executor.map(screen_file, [inputs[file][0] for file in todo], [prefixes[file] for file in todo]))
+    else:
+        for file in todo:
+            screen_file(inputs[file][0], prefixes[file])
+
+    # record screened files
+    for file in todo:
+        manifest.record(file, inputs[file], outputs = outputs[file])
+    manifest.save()
+
+
+def get_args():
+    """Get command line arguments"""
+    parser = argparse.ArgumentParser(description='Estimate site-level dN and dS of every alignment with the Nei-Gojobori counting method')
+
+    parser.add_argument('-d', '--dir', type = str, dest = 'directory', help = 'Directory to read nucleotide alignment files')
+
+    parser.add_argument('-s', '--suffix', type = str, dest = 'suffix', default = '_rev2miss.aln', help = 'Suffix of alignment files')
+
+    parser.add_argument('-j', '--jobs', type = int, dest = 'jobs', default = 1, help = 'Number of alignment files to process in parallel')
+
+    parser.add_argument('-f', '--force', action = 'store_true', dest = 'force', help = 'Reprocess every file, even if it has not changed since the last run')
+
+    args = parser.parse_args()
+    return args
+
+
+def read_codons(filename):
+    """Reads a nucleotide alignment as a matrix of sense codon indices (rows are sequences, columns are codon sites),
+    INVALID for codons with gaps, ambiguous bases or stop codons"""
+
+    sequences = [sequence for header, sequence in iter_fasta(filename)]
+    if not sequences:
+        return np.zeros((0, 0), dtype = np.int8)
+
+    return SENSE_LOOKUP[get_codon_indices(sequences, max(len(sequence) for sequence in sequences))]
+
+
+def get_consensus_codons(codons):
+    """Gets the most common sense codon of every codon site (the lowest codon index on ties), INVALID where no sequence has one"""
+
+    counts = np.stack([(codons == ind).sum(axis = 0) for ind in range(len(CODONS))])
+    consensus = counts.argmax(axis = 0).astype(np.int8)
+
+    return np.where(counts.max(axis = 0) > 0, consensus, INVALID)
+
+
+def jukes_cantor(p):
+    """Jukes-Cantor corrected distance of proportions of differences p, NaN where p >= 0.75"""
+
+    p = np.asarray(p, dtype = float)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        distance = -0.75 * np.log(1 - 4 * p / 3)
+
+    # adding 0.0 turns -0.0 (no differences) into 0.0
+    return np.where(p < 0.75, distance + 0.0, np.nan)
+
+
+def estimate_sites(codons):
+    """Estimates dS and dN of every codon site of a codon matrix (from read_codons) against the consensus codon of each site;
+    sites without a synonymous (nonsynonymous) site have dS (dN) NaN; returns (dS, dN) arrays"""
+
+    consensus = get_consensus_codons(codons)
+
+    # compare every sense codon to its site's consensus codon
+    valid = (codons != INVALID) & (consensus != INVALID)
+    reference = np.broadcast_to(consensus, codons.shape)
+    codons = np.where(valid, codons, 0)
+    reference = np.where(valid, reference, 0)
+
+    # sites are the average of the two codons' sites, sum sites and differences over sequences
+    sites = np.where(valid, (SITES[:, codons] + SITES[:, reference]) / 2, 0).sum(axis = 1)
+    differences = np.where(valid, DIFFERENCES[:, reference, codons], 0).sum(axis = 1)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        proportions = np.where(sites > 0, differences / sites, np.nan)
+
+    dS, dN = jukes_cantor(proportions)
+
+    return dS, dN
+
+
+def screen_file(infile, prefix):
+    """Estimates dS and dN of every codon site of one alignment file, writes the site tables [prefix]_simple.txt and .npz"""
+
+    dS, dN = estimate_sites(read_codons(infile))
+
+    write_site_table(prefix, dS.tolist(), dN.tolist(), [np.nan] * len(dS))
+
+
+if __name__ == "__main__":
+    main()
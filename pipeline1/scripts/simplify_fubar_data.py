@@ -1,28 +1,57 @@
 #!/usr/bin/python3
 
 """Script that takes FUBAR data as input and outputs a text file containing descriptive headers and
-all numeric data associated with codon site, dS, dN, and P(dS<dN)"""
+all numeric data associated with codon site, dS, dN, and P(dS<dN), along with the same columns as a binary table (_simple.npz).
+Json files may be gzip or bz2 compressed (outputs are named after the uncompressed name). dN/dS is written as inf at sites with dS 0
+and dN above 0, and as nan where both are 0 (the original script stopped with a division by zero at such sites)"""
 
-import os
+import re
 import json
 import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from catalog import open_catalog
+from file_utils import atomic_writer, open_text, strip_compression_suffix
+from manifest import Manifest
+
+
+# headers of the text output, and the matching array names in the binary table
+HEADERS = ['site', 'dS', 'dN', 'P(dS<dN)', 'dN/dS']
+COLUMNS = ['site', 'dS', 'dN', 'prob', 'dNdS']
+
+# path to the rows of MLE estimates inside the FUBAR json, as patterns to find one after the other when streaming
+MLE_PATH = [r'"MLE"\s*:', r'"content"\s*:', r'"0"\s*:\s*\[']
 
 
 def main():
     # get command line arguments
     args = get_args()
    
-    # gets json files from directory into list
-    json_files = [f for f in os.listdir(args.directory) if f.endswith('.json')]
+    # gets json files (compressed or not) from directory into list (hidden files such as the manifest are not FUBAR output)
+    json_files = open_catalog(args.directory).list_files('.json')
     
-    # for each json file in list
-    for file in json_files:
-        
-        # open file and load data
-        json_data = load_json_data(f'{args.directory}/{file}')
-        
-        # write relevant data to new file
-        write_data_to_file(file, args.directory, json_data)
+    # load record of json files already simplified
+    manifest = Manifest(args.directory, 'simplify_fubar', force = args.force)
+    
+    # inputs and outputs of each json file
+    inputs = {file: [f'{args.directory}/{file}'] for file in json_files}
+    outputs = {file: [f'{args.directory}/{strip_compression_suffix(file).replace(".json", suffix)}' for suffix in ['_simple.txt', '_simple.npz']] for file in json_files}
+    
+    # skip files that have not changed since they were last simplified
+    todo = [file for file in json_files if not manifest.is_current(file, inputs[file], outputs = outputs[file])]
+    
+    # simplify files in a process pool, or in this process for a single job
+    if args.jobs > 1 and todo:
+        with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+            list(executor.map(simplify_file, todo, [args.directory] * len(todo), [args.stream] * len(todo)))
+    else:
+        for file in todo:
+            simplify_file(file, args.directory, args.stream)
+    
+    # record simplified files
+    for file in todo:
+        manifest.record(file, inputs[file], outputs = outputs[file])
+    manifest.save()
 
 
 def get_args():
@@ -34,15 +63,21 @@ def get_args():
     dest = 'directory', 
     help = 'Directory to read json files')
     
+    parser.add_argument('-f', '--force', action = 'store_true', dest = 'force', help = 'Reprocess every file, even if it has not changed since the last run')
+    
+    parser.add_argument('-j', '--jobs', type = int, dest = 'jobs', default = 1, help = 'Number of json files to process in parallel')
+    
+    parser.add_argument('-s', '--stream', action = 'store_true', dest = 'stream', help = 'Parse the MLE rows out of each json file incrementally instead of loading the whole file')
+    
     args = parser.parse_args() 
     return args
     
     
 def load_json_data(filename):
-    """Loads data from json file"""
+    """Loads data from json file (may be gzip or bz2 compressed)"""
     
     # open json file
-    json_file = open(filename)
+    json_file = open_text(filename)
     
     # load json data into object
     json_data = json.load(json_file)
@@ -53,41 +88,131 @@ def load_json_data(filename):
     return json_data
 
 
-def write_data_to_file(filename, out_directory, json_data):
-    """Simplifies json data and outputs to text file"""
+def iter_mle_rows(filename, block_size=1 << 16):
+    """Reads the rows of MLE estimates (json_data['MLE']['content']['0']) from a FUBAR json file one at a time,
+    without loading the rest of the file (grid, posteriors, trees), so memory stays flat for very long alignments
+    @input: name of json file (may be gzip or bz2 compressed), number of characters to read at a time
+    @return: generator of rows (lists of numbers)"""
     
-    # get headers as object
-    headers = ['site', 'dS', 'dN', 'P(dS<dN)', 'dN/dS']
+    decoder = json.JSONDecoder()
+    
+    with open_text(filename) as json_file:
+        
+        buffer = ''
+        
+        # find the start of the rows, throwing away everything before it
+        for pattern in MLE_PATH:
+            regex = re.compile(pattern)
+            while True:
+                match = regex.search(buffer)
+                if match:
+                    buffer = buffer[match.end():]
+                    break
+                block = json_file.read(block_size)
+                if not block:
+                    raise ValueError(f'No MLE content found in {filename}')
+                # keep the end of the old buffer in case the pattern is split between blocks
+                buffer = buffer[-64:] + block
+        
+        pos = 0
+        
+        while True:
+            
+            # skip whitespace and commas between rows, reading more of the file if needed
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                block = json_file.read(block_size)
+                if not block:
+                    raise ValueError(f'MLE content ends early in {filename}')
+                buffer, pos = buffer[pos:] + block, 0
+                continue
+            
+            # end of the rows
+            if buffer[pos] == ']':
+                return
+            
+            # decode the next row, reading more of the file if the row is cut off
+            try:
+                row, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                block = json_file.read(block_size)
+                if not block:
+                    raise
+                buffer, pos = buffer[pos:] + block, 0
+                continue
+            
+            yield row
+            
+            # drop rows already handed back
+            if pos > block_size:
+                buffer, pos = buffer[pos:], 0
+
+
+def simplify_file(filename, directory, stream=False):
+    """Reads the MLE estimates of one FUBAR json file and writes the simplified text and binary tables"""
     
     # get all numeric data as object
-    data = json_data['MLE']['content']['0']
+    if stream:
+        data = iter_mle_rows(f'{directory}/{filename}')
+    else:
+        data = load_json_data(f'{directory}/{filename}')['MLE']['content']['0']
+    
+    # get dS, dN, and P(dS<dN) as they are written in the json
+    dS, dN, prob = [], [], []
+    for row in data:
+        dS.append(row[0])
+        dN.append(row[1])
+        prob.append(row[4])
+    
+    # write relevant data to new files
+    write_site_table(f'{directory}/{strip_compression_suffix(filename).replace(".json", "")}', dS, dN, prob)
+
+
+def compute_dn_ds(dS, dN):
+    """Computes dN/dS for arrays of dS and dN; where dS is 0, dN/dS is inf (or NaN if dN is also 0) instead of an error"""
+    
+    dS = np.asarray(dS, dtype = float)
+    dN = np.asarray(dN, dtype = float)
     
-    # get output file name
-    newfile = filename.replace('.json', '_simple.txt')
+    # divide where dS is not 0, fill the rest
+    dN_dS = np.where(dN > 0, np.inf, np.nan)
+    np.divide(dN, dS, out = dN_dS, where = dS != 0)
+    
+    return dN_dS
+
 
-    # initialize a counter for codon position
-    counter = 1
+def write_site_table(prefix, dS, dN, prob):
+    """Writes per-site dS, dN, P(dS<dN) and dN/dS to [prefix]_simple.txt (tab-delimited, numbers written as given)
+    and [prefix]_simple.npz (one array per column, see COLUMNS); dN/dS is inf where dS is 0 and dN is not, nan where both are 0
+    @input: output path without suffix, lists of dS, dN and P(dS<dN) values for codon sites 1, 2, ..."""
     
-    # initialize tab character to use in f-string
-    tab = '\t'
+    # get dN/dS for every site at once
+    dN_dS = compute_dn_ds(dS, dN)
     
-    # open output file
-    with open(f'{out_directory}/{newfile}', 'a') as outfile:
+    # codon positions
+    sites = np.arange(1, len(dS) + 1, dtype = np.int32)
+    
+    # open output file, replacing any previous output
+    with atomic_writer(f'{prefix}_simple.txt') as outfile:
 
         # write headers to file, tab-delimited
-        outfile.write('\t'.join(str(header) for header in headers))
+        outfile.write('\t'.join(HEADERS))
         outfile.write('\n')
 
-        # for each row of data,
-        for row in data:
-            # get dN/dS
-            dN_dS = row[1] / row[0]
-            # get a subset that is dS, dN, and P(dS<dN)
-            dat = [row[0], row[1], row[4], dN_dS]
-            # write codon position and associated data to file, tab-delimited
-            outfile.write(f"{counter}\t{tab.join(map(str, dat))}\n")
-            # step counter
-            counter += 1
+        # write codon position and associated data to file, tab-delimited
+        outfile.writelines(f'{site}\t{a}\t{b}\t{c}\t{d}\n' for site, a, b, c, d in zip(sites.tolist(), dS, dN, prob, dN_dS.tolist()))
+    
+    # write the same columns as a binary table
+    with atomic_writer(f'{prefix}_simple.npz', 'wb') as outfile:
+        np.savez(outfile, **dict(zip(COLUMNS, [sites, np.asarray(dS, dtype = float), np.asarray(dN, dtype = float), np.asarray(prob, dtype = float), dN_dS])))
+
+
+def load_site_table(filename):
+    """Loads a binary site table written by write_site_table as a dictionary of arrays (see COLUMNS)"""
+    
+    with np.load(filename) as table:
+        return {column: table[column] for column in COLUMNS}
 
 
 if __name__ == "__main__":
@@ -3,71 +3,230 @@
 
 import os
 import argparse
-from Bio.Seq import Seq
-from Bio import SeqIO
-from Bio.Alphabet import Gapped
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from catalog import open_catalog
+from file_utils import atomic_writer, iter_fasta, strip_compression_suffix
+from manifest import Manifest
 
 
+# standard genetic code, codons in TCAG order
+BASES = 'TCAG'
+AMINO_ACIDS = 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+GENETIC_CODE = {''.join(codon): aa for codon, aa in zip(itertools.product(BASES, repeat = 3), AMINO_ACIDS)}
+
+# IUPAC nucleotide codes as bit masks (A=1, C=2, G=4, T=8), a gap is 0; X means any base like N,
+# but gets its own value because Biopython refuses to translate it when the codon could also be a stop
+NUCLEOTIDE_MASKS = {'A': 1, 'C': 2, 'G': 4, 'T': 8, 'U': 8, 'R': 5, 'Y': 10, 'S': 6, 'W': 9, 'K': 12, 'M': 3,
+                    'B': 14, 'D': 13, 'H': 11, 'V': 7, 'N': 15, 'X': 16, '-': 0}
+
+# marker for characters that are not nucleotides, and number of possible values per codon position
+INVALID_NUCLEOTIDE = 17
+N_VALUES = 18
+
+# marker in the codon table for codons that cannot be translated (partial gaps, invalid characters)
+INVALID_CODON = 0
+
 
 def main():
-    
+
     # get command line arguments
     args = get_args()
-    
-    # read fasta file names into list
-    aln_files = [f for f in os.listdir(args.directory) if f.endswith('_rev2miss.aln')]
-    
-    for file in aln_files:
-        
-        # read in sequences
-        seqs = get_sequence_dict_from_file(f'{args.directory}/{file}')
-        
-        # get individual ID from file name
-        individual_id = file.replace('_rev2miss.aln', '')
-        
-        outfile = f'{args.directory}/{individual_id}_rev2miss.aln.translated'
-        
-        # write translated sequences to outfile
-        write_translated_seqs_to_file(outfile, seqs)
+
+    # translate every alignment file, write each to <file>.translated
+    run_translation(args.directory, '_rev2miss.aln', args.jobs, args.validate, args.force)
 
 
 def get_args():
     """Get command line arguments"""
     parser = argparse.ArgumentParser(description='Translate fasta files to protein sequence')
-    
+
     parser.add_argument('-d', '--dir',
-    type = str, 
-    dest = 'directory', 
+    type = str,
+    dest = 'directory',
     help = 'Directory to read alignment files')
-    
-    args = parser.parse_args() 
+
+    parser.add_argument('-j', '--jobs', type = int, dest = 'jobs', default = 1, help = 'Number of alignment files to translate in parallel')
+
+    parser.add_argument('--validate', action = 'store_true', dest = 'validate', help = 'Check every translation against Biopython (slow, requires Biopython)')
+
+    parser.add_argument('-f', '--force', action = 'store_true', dest = 'force', help = 'Translate every file, even if it has not changed since the last run')
+
+    args = parser.parse_args()
     return args
-    
-
-def get_sequence_dict_from_file(filename):
-    '''Function to open fasta file and create dictionary with format {header: sequence....}'''
-    
-    # open file
-    with open(filename, 'r') as seqfile:
-        
-        # get dictionary
-        seq_dict = SeqIO.to_dict(SeqIO.parse(seqfile, "fasta"))
-        
-        return seq_dict
-        
-
-def write_translated_seqs_to_file(outfile, sequence_dict):
-    
-    # open file
-    with open(outfile, 'a') as outfile:
-        
-        for header, seq in sequence_dict.items():
-            # translate sequence
-            seq = seq.translate(gap = '-')
+
+
+def build_codon_table():
+    """Builds a lookup table from a codon index (see get_codon_indices) to its translated amino acid, following Biopython's rules:
+    '---' translates to a gap, ambiguous codons translate to their amino acid if every possible codon agrees, to B (D/N), Z (E/Q),
+    J (I/L) or X otherwise (including a mix of stop and amino acid codons), and to '*' if every possible codon is a stop codon"""
+
+    # every mask value expanded to the bases it stands for
+    mask_bases = {mask: [b for b, bit in zip('ACGT', (1, 2, 4, 8)) if mask & bit] for mask in range(1, 16)}
+    mask_bases[NUCLEOTIDE_MASKS['X']] = mask_bases[NUCLEOTIDE_MASKS['N']]
+
+    # initialize table, everything is untranslatable until set
+    table = np.full(N_VALUES ** 3, INVALID_CODON, dtype = np.uint8)
+
+    # a codon that is all gap translates to a gap
+    table[0] = ord('-')
+
+    # go through every combination of non-gap nucleotide masks
+    for m0, m1, m2 in itertools.product(range(1, 17), repeat = 3):
+
+        # get every amino acid the (possibly ambiguous) codon can translate to
+        aas = {GENETIC_CODE[''.join(codon)] for codon in itertools.product(mask_bases[m0], mask_bases[m1], mask_bases[m2])}
+
+        if len(aas) == 1:
+            aa = aas.pop()
+        elif '*' in aas and NUCLEOTIDE_MASKS['X'] in (m0, m1, m2):
+            # Biopython cannot translate a possible stop codon spelled with X
+            continue
+        elif aas <= {'D', 'N'}:
+            aa = 'B'
+        elif aas <= {'E', 'Q'}:
+            aa = 'Z'
+        elif aas <= {'I', 'L'}:
+            aa = 'J'
+        else:
+            aa = 'X'
+
+        table[(m0 * N_VALUES + m1) * N_VALUES + m2] = ord(aa)
+
+    return table
+
+
+# lookup table from a raw character to its nucleotide mask, upper and lower case map to the same mask
+NUCLEOTIDE_LOOKUP = np.full(256, INVALID_NUCLEOTIDE, dtype = np.uint8)
+for nt, mask in NUCLEOTIDE_MASKS.items():
+    NUCLEOTIDE_LOOKUP[ord(nt)] = mask
+    NUCLEOTIDE_LOOKUP[ord(nt.lower())] = mask
+
+# lookup table from a codon index to its amino acid
+CODON_TABLE = build_codon_table()
+
+
+def get_codon_indices(sequences, length):
+    """From a list of aligned nucleotide sequences, creates a matrix of codon indices (rows are sequences, columns are codons);
+    sequences shorter than length are padded with gaps, a trailing partial codon is dropped like Biopython does
+    @input: list of nucleotide sequences, alignment length in nucleotides
+    @return: codon index matrix"""
+
+    n_codons = length // 3
+
+    # initialize a matrix of gaps, put the raw characters of each sequence into its row
+    raw = np.full([len(sequences), n_codons * 3], ord('-'), dtype = np.uint8)
+    for row, seq in enumerate(sequences):
+        seq = seq[:n_codons * 3]
+        raw[row, :len(seq)] = np.frombuffer(seq.encode('ascii'), dtype = np.uint8)
+
+    # translate characters to nucleotide masks, then pack each codon's three masks into one index
+    masks = NUCLEOTIDE_LOOKUP[raw].reshape(len(sequences), n_codons, 3).astype(np.uint16)
+    codons = (masks[:, :, 0] * N_VALUES + masks[:, :, 1]) * N_VALUES + masks[:, :, 2]
+
+    return codons
+
+
+def translate_sequences(sequences, ids=None):
+    """Translates a list of aligned nucleotide sequences to protein all at once through the codon lookup table
+    @input: list of nucleotide sequences, optional list of sequence IDs for error messages
+    @return: list of protein sequences (upper case, gaps as '-')"""
+
+    if not sequences:
+        return []
+
+    lengths = [len(seq) for seq in sequences]
+
+    # translate the whole alignment through the lookup table
+    translated = CODON_TABLE[get_codon_indices(sequences, max(lengths))]
+
+    # any untranslatable codon within a sequence's own length is an error
+    own_codons = np.arange(translated.shape[1]) < (np.array(lengths) // 3)[:, None]
+    bad = np.argwhere((translated == INVALID_CODON) & own_codons)
+    if len(bad):
+        row, col = bad[0]
+        name = ids[row] if ids is not None else f'sequence {row + 1}'
+        raise ValueError(f"Codon '{sequences[row][col * 3:col * 3 + 3]}' at codon {col + 1} of {name} cannot be translated")
+
+    # cut each row back to its own number of codons
+    return [row[:length // 3].tobytes().decode('ascii') for row, length in zip(translated, lengths)]
+
+
+def translate_file(infile, outfile, chunk_size=1000, validate=False):
+    """Translates every sequence of a fasta file chunk_size sequences at a time and writes them to outfile
+    @input: nucleotide fasta file, output protein fasta file, number of sequences per chunk, whether to check against Biopython"""
+
+    seen = set()
+
+    with atomic_writer(outfile) as out:
+
+        records = iter_fasta(infile)
+
+        while True:
+
+            # get the next chunk of records, keep just the ID from each header like Biopython does
+            chunk = [(header.split()[0], seq) for header, seq in itertools.islice(records, chunk_size)]
+            if not chunk:
+                break
+
+            ids, seqs = zip(*chunk)
+
+            # IDs become fasta headers, they have to be unique
+            for id in ids:
+                if id in seen:
+                    raise ValueError(f"Duplicate sequence ID '{id}' in {infile}")
+                seen.add(id)
+
+            # translate sequences
+            translated = translate_sequences(list(seqs), ids)
+
+            if validate:
+                validate_translations(seqs, translated, ids)
+
             # write header and translated sequence to file
-            outfile.write(f'>{header}\n{seq.seq}\n')
-            
+            out.writelines(f'>{id}\n{seq}\n' for id, seq in zip(ids, translated))
+
+
+def validate_translations(sequences, translated, ids):
+    """Checks translations against Biopython's Seq.translate, raises an error on the first difference"""
+
+    from Bio.Seq import Seq
+
+    for id, seq, protein in zip(ids, sequences, translated):
+        expected = str(Seq(seq).translate(gap = '-'))
+        if expected != protein:
+            raise ValueError(f'Translation of {id} differs from Biopython:\n{protein}\n{expected}')
+
+
+def run_translation(directory, suffix, jobs=1, validate=False, force=False):
+    """Translates every fasta file in directory ending with suffix (optionally gzip/bz2 compressed) to <file>.translated, across jobs processes;
+    files that have not changed since they were last translated are skipped unless force is set"""
+
+    # read fasta file names into list
+    aln_files = open_catalog(directory).list_files(suffix)
+
+    # load record of files already translated
+    manifest = Manifest(directory, 'translate', force = force)
+
+    # one task per alignment file that changed
+    infiles = [f'{directory}/{file}' for file in aln_files]
+    outfiles = [f'{directory}/{strip_compression_suffix(file)}.translated' for file in aln_files]
+    todo = [(infile, outfile) for infile, outfile in zip(infiles, outfiles) if not manifest.is_current(os.path.basename(infile), [infile], outputs = [outfile])]
+
+    # fan files out to a process pool, or run in this process for a single job
+    if jobs > 1 and todo:
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            list(executor.map(translate_file, *zip(*todo), [1000] * len(todo), [validate] * len(todo)))
+    else:
+        for infile, outfile in todo:
+            translate_file(infile, outfile, validate = validate)
+
+    # record translated files
+    for infile, outfile in todo:
+        manifest.record(os.path.basename(infile), [infile], outputs = [outfile])
+    manifest.save()
+
 
 if __name__ == "__main__":
     main()
-
@@ -1,11 +1,8 @@
 #!/usr/bin/env python
 """Script to translate nucleotide sequences in fasta file to protein and write to outfile"""
 
-import os
 import argparse
-from Bio.Seq import Seq
-from Bio import SeqIO
-from Bio.Alphabet import Gapped
+from translate_fasta import run_translation
 
 
 
@@ -14,21 +11,8 @@ def main():
     # get command line arguments
     args = get_args()
     
-    # read fasta file names into list
-    aln_files = [f for f in os.listdir(args.directory) if f.endswith('.consensus')]
-    
-    for file in aln_files:
-        
-        # read in sequences
-        seqs = get_sequence_dict_from_file(f'{args.directory}/{file}')
-        
-        # get individual ID from file name
-        individual_id = file.replace('.aln.consensus', '')
-        
-        outfile = f'{args.directory}/{file}.translated'
-        
-        # write translated sequences to outfile
-        write_translated_seqs_to_file(outfile, seqs)
+    # translate every consensus file, write each to <file>.translated
+    run_translation(args.directory, '.consensus', args.jobs, args.validate, args.force)
 
 
 def get_args():
@@ -40,32 +24,14 @@ def get_args():
     dest = 'directory', 
     help = 'Directory to read alignment files')
     
-    args = parser.parse_args() 
-    return args
+    parser.add_argument('-j', '--jobs', type = int, dest = 'jobs', default = 1, help = 'Number of files to translate in parallel')
     
-
-def get_sequence_dict_from_file(filename):
-    '''Function to open fasta file and create dictionary with format {header: sequence....}'''
+    parser.add_argument('--validate', action = 'store_true', dest = 'validate', help = 'Check every translation against Biopython (slow, requires Biopython)')
     
-    # open file
-    with open(filename, 'r') as seqfile:
-        
-        # get dictionary
-        seq_dict = SeqIO.to_dict(SeqIO.parse(seqfile, "fasta"))
-        
-        return seq_dict
-        
-
-def write_translated_seqs_to_file(outfile, sequence_dict):
+    parser.add_argument('-f', '--force', action = 'store_true', dest = 'force', help = 'Translate every file, even if it has not changed since the last run')
     
-    # open file
-    with open(outfile, 'a') as outfile:
-        
-        for header, seq in sequence_dict.items():
-            # translate sequence
-            seq = seq.translate(gap = '-')
-            # write header and translated sequence to file
-            outfile.write(f'>{header}\n{seq.seq}\n')
+    args = parser.parse_args() 
+    return args
             
 
 if __name__ == "__main__":
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""Script to compute Tajima's D on sliding windows of every participant's nucleotide alignment, in place of DnaSP,
+and write the midpoints of every window with D greater than or equal to a threshold to a json file with format
+{participant ID: [midpoints...]} (the file get_significant_midpoints.R writes from the DnaSP workbooks).
+
+Columns with a gap or an ambiguous base in any sequence are left out (complete deletion, as DnaSP does by default), and windows
+are counted over the columns that are kept: every window holds the given number of kept sites and windows step over kept sites,
+so a gappy region does not give windows with fewer sites (all windows use the same n and the same number of sites).
+The number of segregating sites and the average number of pairwise differences of each column are counted once,
+then summed over every window with prefix sums. The start, stop and midpoint of windows are reported in alignment
+(nucleotide) positions, starting from 1: start and stop are the first and last kept column of the window"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline1', 'scripts'))
+from catalog import open_catalog
+from file_utils import atomic_writer, iter_fasta
+
+
+# lookup table from a raw character to its base (A, C, G, T as 0 to 3), gaps, ambiguous bases and anything else are 4
+MISSING = 4
+BASE_LOOKUP = np.full(256, MISSING, dtype = np.uint8)
+for ind, bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+    for base in bases:
+        BASE_LOOKUP[ord(base)] = ind
+
+# columns of the table of every window
+WINDOW_COLUMNS = ['id', 'start', 'stop', 'midpoint', 'sites', 'S', 'pi', 'D']
+
+
+def main():
+    # get command line arguments
+    args = get_args()
+
+    # alignment of every participant, from every directory
+    tasks = []
+    for directory in args.directories:
+        catalog = open_catalog(directory)
+        for id in catalog.ids('alignment'):
+            tasks.append((id, catalog.find('alignment', id), args.window, args.step))
+
+    # compute Tajimas D windows of every participant, across a process pool for more than one job
+    if args.jobs > 1 and tasks:
+        with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+            results = list(executor.map(compute_participant_windows, *zip(*tasks)))
+    else:
+        results = [compute_participant_windows(*task) for task in tasks]
+
+    windows_df = pd.concat(results, ignore_index = True) if results else pd.DataFrame(columns = WINDOW_COLUMNS)
+
+    # save every window, if asked for
+    if args.windows:
+        with atomic_writer(args.windows) as outfile:
+            windows_df.to_csv(outfile, index = False)
+
+    # save midpoints where Tajimas D >= threshold for each participant
+    with atomic_writer(args.outfile) as outfile:
+        json.dump(get_sig_midpoints(windows_df, [task[0] for task in tasks], args.threshold), outfile)
+
+
+def get_args():
+    """Get command line arguments"""
+    parser = argparse.ArgumentParser(description="Compute sliding window Tajima's D of every participant's alignment and save the significant midpoints")
+
+    parser.add_argument('-d', '--dir', nargs = '+', type = str, dest = 'directories', required = True, help = 'Directories to read nucleotide alignment files')
+
+    parser.add_argument('-w', '--window', type = int, dest = 'window', default = 100, help = 'Window length in kept nucleotide sites (columns without gaps or ambiguous bases)')
+
+    parser.add_argument('-s', '--step', type = int, dest = 'step', default = 25, help = 'Step between windows in kept nucleotide sites')
+
+    parser.add_argument('-t', '--threshold', type = float, dest = 'threshold', default = 1.5, help = "Windows with Tajima's D greater than or equal to threshold are significant")
+
+    parser.add_argument('-o', '--outfile', type = str, dest = 'outfile', default = 'results/sig_midpoints.json', help = 'File to write significant midpoints')
+
+    parser.add_argument('--windows', type = str, dest = 'windows', help = 'File to write every window (id, start, stop, midpoint, sites, S, pi, D) as csv')
+
+    parser.add_argument('-j', '--jobs', type = int, dest = 'jobs', default = 1, help = 'Number of participants to process in parallel')
+
+    args = parser.parse_args()
+    return args
+
+
+def read_alignment(filename):
+    """Function to read a nucleotide alignment as a matrix of bases (sequences as rows, A, C, G, T as 0 to 3, anything else 4);
+    sequences shorter than the longest are padded with missing bases"""
+
+    sequences = [np.frombuffer(sequence.encode(), dtype = np.uint8) for header, sequence in iter_fasta(filename)]
+
+    length = max((len(sequence) for sequence in sequences), default = 0)
+    bases = np.full((len(sequences), length), MISSING, dtype = np.uint8)
+    for row, sequence in enumerate(sequences):
+        bases[row, :len(sequence)] = BASE_LOOKUP[sequence]
+
+    return bases
+
+
+def get_column_statistics(bases):
+    """Function to count, for every column of an alignment, whether it is used (no missing bases), whether it is a segregating site
+    and its average number of pairwise differences; returns (used, segregating, pairwise) arrays"""
+
+    n = bases.shape[0]
+
+    # count of each base in every column
+    counts = np.stack([(bases == base).sum(axis = 0) for base in range(4)])
+
+    used = counts.sum(axis = 0) == n
+    segregating = used & (counts.max(axis = 0) < n)
+
+    # pairs of sequences that differ at a column, over all pairs of sequences
+    pairs = n * (n - 1) / 2
+    differences = (n * n - (counts.astype(float) ** 2).sum(axis = 0)) / 2
+    pairwise = np.where(used, differences / pairs, 0) if pairs else np.zeros(bases.shape[1])
+
+    return used, segregating, pairwise
+
+
+def tajimas_d(n, S, pi):
+    """Function to compute Tajima's D for n sequences from arrays of segregating sites (S) and average pairwise differences (pi);
+    D is NaN where it is undefined (no segregating sites, fewer than 3 sequences)"""
+
+    if n < 3:
+        return np.full(len(S), np.nan)
+
+    i = np.arange(1, n)
+    a1 = (1 / i).sum()
+    a2 = (1 / i ** 2).sum()
+    b1 = (n + 1) / (3 * (n - 1))
+    b2 = 2 * (n * n + n + 3) / (9 * n * (n - 1))
+    c1 = b1 - 1 / a1
+    c2 = b2 - (n + 2) / (a1 * n) + a2 / a1 ** 2
+    e1 = c1 / a1
+    e2 = c2 / (a1 ** 2 + a2)
+
+    S = np.asarray(S, dtype = float)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        D = (pi - S / a1) / np.sqrt(e1 * S + e2 * S * (S - 1))
+
+    return np.where(S > 0, D, np.nan)
+
+
+def compute_windows(bases, window=100, step=25):
+    """Function to compute Tajima's D on every window of an alignment matrix (from read_alignment), windows and steps counted in
+    kept columns (no missing bases); returns a dataframe with the start, stop and midpoint (alignment positions from 1),
+    the number of sites used, the number of segregating sites (S), the average number of pairwise differences (pi) and D of every window"""
+
+    n = bases.shape[0]
+    used, segregating, pairwise = get_column_statistics(bases)
+
+    # alignment positions (from 0) of the kept columns, windows are over these
+    positions = np.flatnonzero(used)
+
+    # prefix sums over kept columns, so every window is the difference of two entries
+    segregating_sums = np.concatenate([[0], np.cumsum(segregating[positions])])
+    pairwise_sums = np.concatenate([[0], np.cumsum(pairwise[positions])])
+
+    starts = np.arange(0, max(len(positions) - window, -1) + 1, step)
+    stops = starts + window
+
+    S = segregating_sums[stops] - segregating_sums[starts]
+    pi = pairwise_sums[stops] - pairwise_sums[starts]
+
+    # first and last kept column of every window, as alignment positions from 1
+    first = positions[starts] + 1
+    last = positions[stops - 1] + 1 if len(starts) else first
+
+    return pd.DataFrame({'start': first,
+                         'stop': last,
+                         'midpoint': (first + last) // 2,
+                         'sites': stops - starts,
+                         'S': S,
+                         'pi': pi,
+                         'D': tajimas_d(n, S, pi)})
+
+
+def compute_participant_windows(id, filename, window=100, step=25):
+    """Function to compute Tajima's D windows of one participant's alignment, returns the windows with the participant's ID"""
+
+    windows_df = compute_windows(read_alignment(filename), window, step)
+    windows_df.insert(0, 'id', id)
+
+    return windows_df
+
+
+def get_sig_midpoints(windows_df, ids, threshold=1.5):
+    """Function to get the midpoints of windows with D >= threshold for every participant in ids,
+    returns a dictionary with format {id: [midpoints]} (an empty list for participants without any)"""
+
+    sig_df = windows_df[windows_df['D'] >= threshold]
+    midpoints = sig_df.groupby('id')['midpoint'].apply(list).to_dict()
+
+    return {id: [int(midpoint) for midpoint in midpoints.get(id, [])] for id in ids}
+
+
+if __name__ == "__main__":
+    main()
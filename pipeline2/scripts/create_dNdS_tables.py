@@ -3,40 +3,85 @@
 """Script to output files showing shared codon positions where positive selection is occurring
 for a given set of participants at annotation sites with Tajima's D >= 1.5. There will be four output files
 per annotation: *_dNdS.csv and *_probability.csv (comma separated text files for making heatmaps), 
-*_dNdS_table.png, *_probability_table.png (image files for viewing tables)"""
+*_dNdS_table.png, *_probability_table.png (image files for viewing tables, or lightweight .html tables with --format html).
+With --screen, the counting-method estimates of screen_dnds.py are read instead of FUBAR and every output goes under results/screen/
+(only dN/dS tables, the counting method gives no P(dS<dN)), so a screen never replaces the results of FUBAR runs"""
 
 import os
-import re
+import sys
 import json
+import argparse
 import pandas as pd
 import numpy as np
-import math
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from selection_store import write_selection_store
+from table_images import TABLE_FORMATS, render_tables
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline1', 'scripts'))
+from catalog import open_catalog
+
+
+# values read from the FUBAR results of every participant
+SELECTION_VALUES = ['dS', 'dN', 'P(dS<dN)', 'dN/dS']
+
+# columns of the consensus annotations holding annotation regions
+REGION_COLUMNS = ['Regions1', 'Regions2', 'Regions3']
 
 
 def main():
     
-    # get filenames as list for every consensus_annotations file
-    files = [file for file in os.listdir('data/') if file.endswith('consensus_annotations.csv')]
+    # get command line arguments
+    args = get_args()
     
-    # use filenames to get individual IDs
-    ids = [f.replace('_consensus_annotations.csv', '') for f in files]
+    # get catalog of every participant's files in the data directory (paths it returns start with data/)
+    catalog = open_catalog('data')
     
-    # from list of IDs, call the function to create a dataframe
-    dNdS_df = create_selection_df(ids)
-    prob_df = create_selection_df(ids)
+    # get individual IDs of every participant with a consensus_annotations file
+    ids = catalog.ids('annotation')
     
-    # for every ID, call function to fill in respective dataframe column
-    for id in ids:
-        dNdS_df = fill_selection_df(dNdS_df, id, dir='data', value='dN/dS')
-        prob_df = fill_selection_df(prob_df, id, dir='data', value='P(dS<dN)')
+    # load significant Tajimas D midpoints of every participant
+    sig_midpoints_dict = read_sig_midpoints()
+    
+    # site tables from FUBAR, or from the counting-method screen (screen_dnds.py) in triage mode, with its own results directory
+    site_role = 'screen_simple' if args.screen else 'fubar_simple'
+    results_dir = 'results/screen' if args.screen else 'results'
+    for directory in ['tables', 'plots']:
+        os.makedirs(f'{results_dir}/{directory}', exist_ok = True)
+    
+    # values to save, the screen has no posterior probabilities (P(dS<dN) is all NaN)
+    saved_values = ['dS', 'dN', 'dN/dS'] if args.screen else SELECTION_VALUES
+    
+    # process every participant on its own, across a process pool for more than one job
+    tasks = [(id, catalog.find('annotation', id), catalog.find(site_role, id), sig_midpoints_dict.get(id)) for id in ids]
+    if args.jobs > 1 and tasks:
+        with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+            results = list(executor.map(process_participant, *zip(*tasks)))
+    else:
+        results = [process_participant(*task) for task in tasks]
+    
+    # combine participants into one long table of FUBAR results, and the Tajimas D window annotations of each participant
+    selection_data = combine_selection_data([selection for selection, windows in results])
+    participant_windows = {id: windows for id, (selection, windows) in zip(ids, results)}
+    
+    # get one table per value, HXB2 positions of every participant as rows and participant IDs as columns
+    hxb2_axis = get_hxb2_axis(selection_data)
+    tables = {value: pivot_selection_data(selection_data, ids, value=value, hxb2_axis=hxb2_axis) for value in SELECTION_VALUES}
+    dNdS_df = tables['dN/dS']
+    prob_df = tables['P(dS<dN)']
     
     # save entire selection_df as csv
-    dNdS_df.to_csv('results/tables/pos_selection_sites_dNdS.csv')
-    prob_df.to_csv('results/tables/pos_selection_sites_probability.csv')
+    dNdS_df.to_csv(f'{results_dir}/tables/pos_selection_sites_dNdS.csv')
+    if not args.screen:
+        prob_df.to_csv(f'{results_dir}/tables/pos_selection_sites_probability.csv')
         
     # get dictionary of significant annotations and their positions
-    sig_annotations = get_sig_annotations(dir='data')
+    sig_annotations = get_sig_annotations(catalog, sig_midpoints_dict, participant_windows)
+    
+    # save every value for the whole cohort, with annotations as row ranges, as a binary store
+    write_selection_store(args.store or f'{results_dir}/selection_store', {value: tables[value] for value in saved_values}, sig_annotations)
+    
+    # tables to save as images, (table, annotation, suffix)
+    image_tables = []
     
     # go through ranges where significant annotation
     for annotation in sig_annotations.keys():
@@ -50,170 +95,240 @@ def main():
         annotation_save = annotation.replace('/', '_')
         
         # save as csv
-        dNdS_table.to_csv(f'results/tables/{annotation_save}_dNdS.csv')
-        prob_table.to_csv(f'results/tables/{annotation_save}_probability.csv')
+        dNdS_table.to_csv(f'{results_dir}/tables/{annotation_save}_dNdS.csv')
+        if not args.screen:
+            prob_table.to_csv(f'{results_dir}/tables/{annotation_save}_probability.csv')
         
         if not dNdS_table.empty:
-            # TODO: CHANGE WHERE IMAGES SAVED
-            # save as table image
-            dataframe_to_table_image(dNdS_table, annotation, suffix='_dNdS')
-            dataframe_to_table_image(prob_table, annotation, suffix='_probability')
+            # save as table image (rendered into [results]/plots below)
+            image_tables.append((dNdS_table, annotation, '_dNdS'))
+            if not args.screen:
+                image_tables.append((prob_table, annotation, '_probability'))
+    
+    # render table images in parallel, skipping tables that have not changed
+    render_tables(image_tables, f'{results_dir}/plots', args.formats, args.jobs, args.force)
+
 
+def get_args():
+    """Get command line arguments"""
+    parser = argparse.ArgumentParser(description='Create dN/dS and P(dS<dN) tables for annotations with a significant Tajimas D')
     
-def create_selection_df(ids):
-    """Function for creating an empty dataframe for a set of IDs"""
-        
-    # create an empty dataframe with participant IDs as columns
-    selection_df = pd.DataFrame(columns = ids)
+    parser.add_argument('-j', '--jobs', type = int, dest = 'jobs', default = 1, help = 'Number of participants to process and table images to render in parallel')
     
-    return selection_df
+    parser.add_argument('--format', nargs = '+', dest = 'formats', default = ['png'], choices = TABLE_FORMATS, help = 'Formats to render tables to, html scales to many participant columns')
     
+    parser.add_argument('-f', '--force', action = 'store_true', dest = 'force', help = 'Render every table, even if it has not changed since it was last rendered')
+    
+    parser.add_argument('--screen', action = 'store_true', dest = 'screen', help = 'Read the counting-method site tables (NG_simple.txt from screen_dnds.py) instead of the FUBAR ones, to triage participants before running FUBAR; outputs go to results/screen/ and leave out P(dS<dN)')
+    
+    parser.add_argument('-s', '--store', type = str, dest = 'store', help = 'Directory to save the binary store of every value for the whole cohort (default results/selection_store, or results/screen/selection_store with --screen)')
+    
+    args = parser.parse_args() 
+    return args
+
+    
+def read_consensus_annotations(catalog, id):
+    """Function to read the consensus annotations file of a participant (index starts from 0)"""
+    
+    return pd.read_csv(catalog.find('annotation', id))
 
-def fill_selection_df(selection_df, id, dir, value):
-    """Function to fill table with specified value for significant codons (their HXB2 reference codon equivalent) for a given participant"""
+
+def read_sig_midpoints():
+    """Function to read the significant Tajimas D midpoints of every participant, returns a dictionary with format {id: [midpoints]}"""
+    
+    with open('results/sig_midpoints.json', 'r') as json_file:
+        # load json file into dictionary
+        return json.load(json_file)
+
+
+def process_participant(id, annotation_file, fubar_file, midpoints=None):
+    """Function to do everything for one participant that does not depend on other participants: reads the consensus annotations
+    and FUBAR results once, places every FUBAR site on HXB2, and finds the annotations of every significant Tajimas D window;
+    returns (long table of FUBAR results, window annotations from get_participant_windows or None without midpoints)"""
     
     # open the consensus annotations file associated with the ID
-    consensus_annotations = pd.read_csv(f'{dir}/{id}_consensus_annotations.csv')
+    consensus_annotations = pd.read_csv(annotation_file)
+    
+    # Read the fubar file of the ID
+    if fubar_file is None:
+        raise FileNotFoundError(f'No _simple.txt site table for {id}')
+    fubar_data = pd.read_table(fubar_file)
+    
+    selection_data = get_participant_selection(id, consensus_annotations, fubar_data)
+    windows = get_participant_windows(consensus_annotations, midpoints) if midpoints is not None else None
+    
+    return selection_data, windows
+
+
+def combine_selection_data(selection_data):
+    """Function to combine the long tables of every participant into one long table
+    (columns participant, HXB2 Position, site, dS, dN, P(dS<dN), dN/dS)"""
+    
+    if not selection_data:
+        return pd.DataFrame(columns = ['participant', 'HXB2 Position', 'site'] + SELECTION_VALUES)
+    
+    return pd.concat(selection_data, ignore_index = True)
+
+
+def get_participant_selection(id, consensus_annotations, fubar_data):
+    """Function to get the FUBAR results of a participant with the HXB2 codon position of every site, as a long table with one row per site"""
     
     # change index to start from 1
-    consensus_annotations.index = consensus_annotations.index + 1
+    consensus_annotations = consensus_annotations.set_axis(consensus_annotations.index + 1)
+    
+    # Get the associated hxb2 codon position of every site at once
+    hxb2_positions = liftover_sites(fubar_data['site'].to_numpy(), consensus_annotations)
+    
+    selection_data = pd.DataFrame({'participant': id, 'HXB2 Position': hxb2_positions, 'site': fubar_data['site'].to_numpy()})
+    for value in SELECTION_VALUES:
+        selection_data[value] = fubar_data[value].to_numpy()
     
-    # Create a regular expression pattern to match the fubar file name
-    pattern = rf'{id}.*\.FUBAR_simple\.txt'
+    return selection_data
 
-    # Get the list of files in the directory that match the pattern
-    files = [file for file in os.listdir(dir) if re.match(pattern, file)]
 
-    # Read the first matching file
-    fubar_data = pd.read_table(os.path.join(dir, files[0]))
+def get_hxb2_axis(selection_data):
+    """Function to get the sorted union of the HXB2 codon positions of every participant (float64)"""
+    
+    return np.unique(selection_data['HXB2 Position'].to_numpy(dtype = float))
 
-    # Get the codon sites as a list
-    sites = fubar_data['site'].tolist()
 
-    for site in sites:
-        # Get index where aligned consensus matches site
-        site_index, og_consensus_decimal = get_site_index(site, consensus_annotations)
+def pivot_selection_data(selection_data, ids, value, hxb2_axis=None):
+    """Function to get a table of one value (a column of the long table from combine_selection_data) for every participant,
+    HXB2 codon positions as rows (sorted) and participant IDs as columns; where sites of a participant share an HXB2 position, the last one is kept"""
+    
+    # rows are every HXB2 position found in any participant
+    if hxb2_axis is None:
+        hxb2_axis = get_hxb2_axis(selection_data)
+    
+    # row and column of every site
+    rows = np.searchsorted(hxb2_axis, selection_data['HXB2 Position'].to_numpy(dtype = float))
+    cols = pd.Index(ids).get_indexer(selection_data['participant'])
+    
+    # keep the last site at each cell (first in reverse order)
+    cells = rows * len(ids) + cols
+    _, last = np.unique(cells[::-1], return_index = True)
+    last = len(cells) - 1 - last
+    
+    # fill a preallocated matrix, cells without a site are NaN
+    matrix = np.full([len(hxb2_axis), len(ids)], np.nan)
+    matrix[rows[last], cols[last]] = selection_data[value].to_numpy(dtype = float)[last]
+    
+    return pd.DataFrame(matrix, index = hxb2_axis, columns = ids)
 
-        # Get the associated hxb2 codon position
-        hxb2_pos = get_hxb2_position(site_index, og_consensus_decimal, consensus_annotations)
 
-        # Add value to correct hxb2 position and participant ID of selection dataframe
-        val = fubar_data.loc[fubar_data['site'] == site, value].values[0]
-        selection_df.at[hxb2_pos, id] = val
+def get_nearest_valid(valid, positions):
+    """Function takes as input a boolean array marking 'real' (not gap) rows and an array of row positions;
+    outputs the nearest lower/left and upper/right real row positions (-1 where there is no lower one, len(valid) where there is no upper one)"""
+    
+    # sorted row positions that are real, with -1 and len(valid) at the ends for positions without a real row on one side
+    valid_positions = np.concatenate([[-1], np.flatnonzero(valid), [len(valid)]])
+    
+    # look up the real rows on either side of every position at once
+    lower = valid_positions[np.searchsorted(valid_positions, positions, side = 'right') - 1]
+    upper = valid_positions[np.searchsorted(valid_positions, positions, side = 'left')]
+    
+    return lower, upper
 
-    return selection_df.sort_index()
+
+def get_row_positions(labels, consensus_annotations):
+    """Function to turn index labels of consensus_annotations into row positions, raising a KeyError for labels not in the index"""
+    
+    positions = consensus_annotations.index.get_indexer(np.asarray(labels))
+    
+    if (positions < 0).any():
+        raise KeyError(np.asarray(labels)[positions < 0][0])
+    
+    return positions
 
 
-def get_site_index(site, consensus_annotations):
-    """Function takes as input a sequence site, checks what codon is at that site in the original consensus,
-    and outputs the index where that codon is located in the aligned consensus. If the position in the original consensus is a gap,
+def get_site_indices(sites, consensus_annotations):
+    """Function takes as input an array of sequence sites, checks what codon is at each site in the original consensus,
+    and outputs the indices where those codons are located in the aligned consensus. Where the position in the original consensus is a gap,
     function will output the index of the left/lower 'real' codon and a decimal to represent what position the gap is between the left and right
-    'real' consensus codons."""
+    'real' consensus codons (-0.5 for a gap at the beginning, measured from the first 'real' codon, and 0.5 for a gap at the end)."""
     
-    # see what original consensus codon is located at the site
-    og_consensus_pos = consensus_annotations.at[site, 'Original.Consensus.Position']
+    og_consensus = consensus_annotations['Original.Consensus.Position'].to_numpy(dtype = float)
+    aln_consensus = consensus_annotations['Consensus.Aligned.to.HXB2.Position'].to_numpy(dtype = float)
+    labels = consensus_annotations.index.to_numpy()
     
+    # row of each site
+    rows = get_row_positions(sites, consensus_annotations)
     
-    # original consensus position is a gap
-    if np.isnan(og_consensus_pos):
-        
-        # find the nearest lower, upper index where Original Consensus contains a 'real' codon
-        nearest = (consensus_annotations.loc[:site, 'Original.Consensus.Position'].last_valid_index(), 
-                   consensus_annotations.loc[site:, 'Original.Consensus.Position'].first_valid_index())
-        
-        lower = nearest[0]
-        upper = nearest[1]
-        
-        
-        if lower is None:
-            # significant site in gap at beginning
-            # set decimal to -0.5
-            og_consensus_decimal =  -0.5
-            
-        
-        elif upper is None:
-            # significant site in gap at end
-            # set decimal to 0.5
-            og_consensus_decimal =  0.5
-            
-                    
-        else:
-            # this is the decimal between the two 'real' codons that our significant site is located at
-            og_consensus_decimal = ((upper - lower) - (upper - site)) / (upper - lower)
+    # find the nearest lower, upper rows where Original Consensus contains a 'real' codon
+    og_valid = ~np.isnan(og_consensus)
+    lower, upper = get_nearest_valid(og_valid, rows)
+    has_lower = lower >= 0
+    has_upper = upper < len(og_consensus)
     
-        
-        # take the left/lower real codon as the original consensus position
-        og_consensus_pos = consensus_annotations.at[lower, 'Original.Consensus.Position']
+    # this is the decimal between the two 'real' codons that each site is located at (0 if it is a 'real' codon),
+    # -0.5 for a gap at the beginning, 0.5 for a gap at the end
+    span = np.maximum(upper - lower, 1)
+    og_consensus_decimal = np.where(og_valid[rows], 0.0, 
+                                    np.where(~has_lower, -0.5, 
+                                             np.where(~has_upper, 0.5, (rows - lower) / span)))
     
-        # get the index where the original consensus codon exists in the aligned consensus
-        site_index = consensus_annotations.index[consensus_annotations['Consensus.Aligned.to.HXB2.Position'] == og_consensus_pos][0]
+    # take the left/lower real codon as the original consensus position (the right/upper one for a gap at the beginning)
+    og_consensus_pos = og_consensus[np.where(has_lower, lower, np.minimum(upper, len(og_consensus) - 1))]
     
+    # get the index where the original consensus codon exists in the aligned consensus (aligned positions are increasing)
+    aln_rows = np.flatnonzero(~np.isnan(aln_consensus))
+    found = np.searchsorted(aln_consensus[aln_rows], og_consensus_pos)
+    found = np.minimum(found, max(len(aln_rows) - 1, 0))
+    if not len(aln_rows) or (aln_consensus[aln_rows[found]] != og_consensus_pos).any():
+        raise IndexError('Original consensus position not found in the aligned consensus')
     
-    else:
-        # original consensus position is not a gap
-        # set decimal to 0
-        og_consensus_decimal = 0
-        
-        # get the index position where the codon exists in the aligned consensus
-        site_index = consensus_annotations.index[consensus_annotations['Consensus.Aligned.to.HXB2.Position'] == og_consensus_pos][0]
+    site_indices = labels[aln_rows[found]]
     
-    return site_index, og_consensus_decimal
+    return site_indices, og_consensus_decimal
     
     
-def get_hxb2_position(site_index, og_consensus_decimal, consensus_annotations):
-    """Function to get the HXB2 codon position where significant dN/dS was found;
-    if position is a gap, make position a decimal between the nearest 'real' codons""" 
+def get_hxb2_positions(site_indices, og_consensus_decimals, consensus_annotations):
+    """Function to get the HXB2 codon positions for an array of site indices (and their decimals from get_site_indices);
+    where the position is a gap, make position a decimal between the nearest 'real' codons""" 
     
-    # get hxb2 position from the site index
-    hxb2_pos = consensus_annotations.at[site_index, 'HXB2.Position']
+    hxb2 = consensus_annotations['HXB2.Position'].to_numpy(dtype = float)
     
-    # hxb2_pos is a gap
-    if np.isnan(hxb2_pos):
-        
-        # find the nearest upper, lower index where HXB2.Position contains a 'real' codon
-        nearest = (consensus_annotations.loc[:site_index, 'HXB2.Position'].last_valid_index(), 
-                   consensus_annotations.loc[site_index:, 'HXB2.Position'].first_valid_index())
-                   
-        lower = nearest[0]
-        upper = nearest[1]
-        
-        
-        if lower is None:
-            # significant codon is before hxb2 start
-            # subtract 0.5 from the right/upper 'real' codon to get hxb2 position
-            hxb2_pos = consensus_annotations.at[upper, 'HXB2.Position'] - 0.5
-            
-        elif upper is None:
-            # significant codon occurs after hxb2 end
-            # add 0.5 to the left/lower 'real' hxb2 codon to get hxb2 position
-            hxb2_pos = consensus_annotations.at[lower, 'HXB2.Position'] + 0.5
-                    
-        else:
-            # this is the decimal between the two 'real' codons that our significant site is located at
-            hxb2_decimal = ((upper - lower) - (upper - site_index)) / (upper - lower)
-            
-            # add the decimal to the left/lower 'real' hxb2 codon to get hxb2 position
-            hxb2_pos = consensus_annotations.at[lower, 'HXB2.Position'] + hxb2_decimal
-            
-        
-        # return hxb2_pos
-        return hxb2_pos
-        
+    # rows of each site index
+    rows = get_row_positions(site_indices, consensus_annotations)
     
-    else:
-        # return hxb2 position if it is not a gap
-        # add consensus fraction to the position
-        return hxb2_pos + og_consensus_decimal
+    # find the nearest lower, upper rows where HXB2.Position contains a 'real' codon
+    hxb2_valid = ~np.isnan(hxb2)
+    lower, upper = get_nearest_valid(hxb2_valid, rows)
+    has_lower = lower >= 0
+    has_upper = upper < len(hxb2)
+    
+    lower_pos = hxb2[np.maximum(lower, 0)]
+    upper_pos = hxb2[np.minimum(upper, len(hxb2) - 1)]
+    
+    # this is the decimal between the two 'real' codons that a gap is located at
+    span = np.maximum(upper - lower, 1)
+    hxb2_decimal = (rows - lower) / span
+    
+    # hxb2 position if it is not a gap, plus the consensus fraction;
+    # otherwise the right/upper 'real' codon - 0.5 before hxb2 start, the left/lower 'real' codon + 0.5 after hxb2 end,
+    # or the left/lower 'real' codon plus the decimal in between
+    hxb2_positions = np.where(hxb2_valid[rows], hxb2[rows] + np.asarray(og_consensus_decimals, dtype = float),
+                              np.where(~has_lower, upper_pos - 0.5,
+                                       np.where(~has_upper, lower_pos + 0.5, lower_pos + hxb2_decimal)))
+    
+    return hxb2_positions
+
+
+def liftover_sites(sites, consensus_annotations):
+    """Function to get the (possibly fractional) HXB2 codon positions for an array of sequence sites in one call"""
+    
+    site_indices, og_consensus_decimals = get_site_indices(sites, consensus_annotations)
+    
+    return get_hxb2_positions(site_indices, og_consensus_decimals, consensus_annotations)
         
         
-def get_sig_annotations(dir):
+def get_sig_annotations(catalog, sig_midpoints_dict, participant_windows=None):
     """Function to get dictionary of annotation and its HXB2 start/stop codon position when the region had a significant Tajima's D;
-    input is the selection dataframe, returns a dictionary with format {annotation: [start, stop]}"""
-    
-    with open('results/sig_midpoints.json', 'r') as json_file:
-        # load json file into dictionary
-        sig_midpoints_dict = json.load(json_file)
+    input is the catalog of participant files, the midpoints of every participant and any window annotations already found
+    ({id: result of get_participant_windows}), returns a dictionary with format {annotation: [start, stop]}"""
     
+    if participant_windows is None:
+        participant_windows = {}
     
     # initialize dictionary to hold annotation and positions
     sig_annotations_dict = {}
@@ -221,98 +336,134 @@ def get_sig_annotations(dir):
 
     for id in sig_midpoints_dict.keys():
         
-        # open the consensus annotations file for the ID
-        consensus_annotations = pd.read_csv(f'{dir}/{id}_consensus_annotations.csv')
+        # get the annotations of the participant's Tajimas D windows, reading its consensus annotations if they have not been read yet
+        windows = participant_windows.get(id)
+        if windows is None:
+            windows = get_participant_windows(read_consensus_annotations(catalog, id), sig_midpoints_dict[id])
         
-        for midpoint in sig_midpoints_dict[id]:
-            
-            # get codon position of midpoint by dividing by 3, rounding down to nearest whole number
-            midpoint = midpoint // 3
-            
-            # get midpoint +- 17 to get the whole Tajimas D window
-            D_start = max(1, midpoint - 17)  # if less than 0, set to 1
-            D_stop = midpoint + 17
-            
-            # get indices where Tajimas D window is located in the aligned consensus
-            D_start_idx, start_decimal = get_site_index(D_start, consensus_annotations)
-            D_stop_idx, stop_decimal = get_site_index(D_stop, consensus_annotations)
-            D_start_idx = math.floor(D_start_idx + start_decimal)
-            D_stop_idx = math.ceil(D_stop_idx + stop_decimal)
-            
-            # subset dataframe to just show annotation regions associated with significant Tajimas D window
-            ann_df = consensus_annotations.loc[D_start_idx: D_stop_idx, ['Regions1', 'Regions2', 'Regions3']]
-            
-            # initialize list to hold annotations associated with Tajimas D range
-            annotations = []
-            
-            # get real annotations in Regions1, 2, and 3 as a list of lists
-            for region in ann_df:
-                annotations.append(ann_df[region].unique().tolist())
-            
-            # flatten list, remove NAs
-            annotations = [a for lis in annotations for a in lis if not pd.isnull(a)]
-            
-            
-            # for each annotation
+        if windows is None:
+            continue
+        
+        # for each annotation associated with each Tajimas D window
+        for annotations in windows['annotations']:
             for annotation in annotations:
                 
-                if annotation in sig_annotations_dict.keys():
-                    # if annotation already in dict, move to next annotation
-                    continue
-                
-                else:
-                    # get positions of annotation as values
-                    ann_pos = consensus_annotations.loc[consensus_annotations['Regions1'].isin([annotation]) | consensus_annotations['Regions2'].isin([annotation]) | consensus_annotations['Regions3'].isin([annotation]), 'HXB2.Position'].tolist()
-                    
+                if annotation not in sig_annotations_dict:
                     # add to dictionary with format {annotation: [start position, stop position]}
-                    sig_annotations_dict[annotation] = [int(ann_pos[0]), int(ann_pos[-1])]
+                    sig_annotations_dict[annotation] = [int(hxb2) for hxb2 in windows['spans'][annotation]]
         
+        
+        # check significant annotations to handle edge cases (beginning/end of hxb2)
+        for annotation in sig_annotations_dict.keys():
             
-            # check significant annotations to handle edge cases (beginning/end of hxb2)
-            for annotation in sig_annotations_dict.keys():
+            if sig_annotations_dict[annotation][0] == 1:
+                # change annotation region to start from 0 if it is beginning of sequence (i.e signal peptide will start at 0)
+                sig_annotations_dict[annotation][0] = 0
+    
+            if sig_annotations_dict[annotation][1] == windows['last_hxb2']:
+                # change annotation region to end at the end of consensus sequence if it is the end of hxb2 sequence
+                sig_annotations_dict[annotation][1] = windows['length']
                 
-                if sig_annotations_dict[annotation][0] == 1:
-                    # change annotation region to start from 0 if it is beginning of sequence (i.e signal peptide will start at 0)
-                    sig_annotations_dict[annotation][0] = 0
-        
-                if sig_annotations_dict[annotation][1] == consensus_annotations.at[consensus_annotations.loc[:, 'HXB2.Position'].last_valid_index(), 'HXB2.Position']:
-                    # change annotation region to end at the end of consensus sequence if it is the end of hxb2 sequence
-                    sig_annotations_dict[annotation][1] = len(consensus_annotations['Original.Consensus.Position'])
-                    
     
     # return dictionary of annotations and ranges
     return sig_annotations_dict   
 
 
-def dataframe_to_table_image(table_df, annotation, suffix):
-    """Function takes as input a dictonary of annotations and their start/stop codon positions;
-    creates a subset of the selection dataframe and saves subset as a table image"""
+def get_participant_windows(consensus_annotations, midpoints):
+    """Function to find the annotations of every significant Tajimas D window of a participant (midpoint +- 17 codons);
+    returns None without midpoints, otherwise a dictionary with 'annotations' (list of annotations of every window, in midpoint order),
+    'spans' ({annotation: [first HXB2 position, last HXB2 position]} of those annotations), 'last_hxb2' and 'length' (see build_annotation_index)"""
+    
+    # get codon position of midpoints by dividing by 3, rounding down to nearest whole number
+    midpoints = np.array(midpoints, dtype = int) // 3
     
-    # create a table from dataframe
-    fig, ax = plt.subplots(figsize=(45, 20))  # Adjust the figure size as needed
-    ax.axis('off')  # Remove axis
-    ax.set_title(annotation)
-   
-    # replace NaN cells in table with whitespace
-    table_df = table_df.replace(np.NaN, '')
+    if not len(midpoints):
+        return None
     
-    table = pd.plotting.table(ax, table_df, loc='center', cellLoc='center')
+    # get index of annotation regions
+    annotation_index = build_annotation_index(consensus_annotations)
+    
+    # get midpoint +- 17 to get the whole Tajimas D window
+    D_starts = np.maximum(1, midpoints - 17)  # if less than 0, set to 1
+    D_stops = midpoints + 17
+    
+    # get indices where every Tajimas D window is located in the aligned consensus
+    D_start_idxs, start_decimals = get_site_indices(D_starts, consensus_annotations)
+    D_stop_idxs, stop_decimals = get_site_indices(D_stops, consensus_annotations)
+    D_start_idxs = np.floor(D_start_idxs + start_decimals).astype(int)
+    D_stop_idxs = np.ceil(D_stop_idxs + stop_decimals).astype(int)
+    
+    # annotations of every window
+    annotations = [get_window_annotations(annotation_index, D_start_idx, D_stop_idx) for D_start_idx, D_stop_idx in zip(D_start_idxs.tolist(), D_stop_idxs.tolist())]
+    
+    return {'annotations': annotations, 
+            'spans': {annotation: annotation_index['spans'][annotation] for window in annotations for annotation in window},
+            'last_hxb2': annotation_index['last_hxb2'],
+            'length': annotation_index['length']}
 
-    # Adjust the font size of the table
-    table.auto_set_font_size(False)
-    table.set_fontsize(8)  # Adjust the font size as needed
 
-    # Adjust the cell size
-    table.scale(1.5, 2)  # Increase the cell size by a factor of 1.5 (adjust as needed)
+def build_annotation_index(consensus_annotations):
+    """Function to index the annotation regions of a participant's consensus annotations; returns a dictionary with
+    'runs' ({region column: (start rows, stop rows, annotations)} for every run of consecutive rows with the same annotation, in row order),
+    'spans' ({annotation: [first HXB2 position, last HXB2 position]} over every row with the annotation in any region column),
+    'last_hxb2' (last real HXB2 position) and 'length' (number of rows)"""
+    
+    hxb2 = consensus_annotations['HXB2.Position'].to_numpy(dtype = float)
+    
+    runs = {}
+    first_rows = {}
+    last_rows = {}
+    
+    for region in REGION_COLUMNS:
+        
+        labels = consensus_annotations[region].to_numpy(dtype = object)
+        annotated = ~pd.isnull(labels)
+        
+        # a run starts where a row is annotated and differs from the row before it
+        changed = np.ones(len(labels), dtype = bool)
+        changed[1:] = (labels[1:] != labels[:-1]) | ~annotated[:-1]
+        starts = np.flatnonzero(annotated & changed)
+        
+        # a run stops where the next row is not annotated or differs
+        changed = np.ones(len(labels), dtype = bool)
+        changed[:-1] = (labels[:-1] != labels[1:]) | ~annotated[1:]
+        stops = np.flatnonzero(annotated & changed)
+        
+        runs[region] = (starts, stops, labels[starts])
+        
+        # first and last row of every annotation
+        for start, stop, label in zip(starts.tolist(), stops.tolist(), labels[starts]):
+            first_rows[label] = min(first_rows.get(label, start), start)
+            last_rows[label] = max(last_rows.get(label, stop), stop)
+    
+    spans = {label: [hxb2[first_rows[label]], hxb2[last_rows[label]]] for label in first_rows}
+    
+    valid = np.flatnonzero(~np.isnan(hxb2))
+    last_hxb2 = hxb2[valid[-1]] if len(valid) else np.nan
+    
+    return {'runs': runs, 'spans': spans, 'last_hxb2': last_hxb2, 'length': len(hxb2)}
 
-    # replace / characters from annotation name before saving
-    annotation = annotation.replace('/', '_')
 
-    plt.show()
-    plt.savefig(f'results/plots/{annotation}{suffix}_table.png', bbox_inches = "tight")
-    plt.close()
+def get_window_annotations(annotation_index, start, stop):
+    """Function to get the annotations in rows start to stop (inclusive) from an annotation index,
+    in order of Regions1, Regions2, Regions3 and then of first row in the window, without repeats within a region column"""
     
+    annotations = []
     
+    for region in REGION_COLUMNS:
+        
+        starts, stops, labels = annotation_index['runs'][region]
+        
+        # runs overlapping the window
+        first = np.searchsorted(stops, start, side = 'left')
+        last = np.searchsorted(starts, stop, side = 'right')
+        
+        # unique annotations in the order they appear
+        annotations += list(dict.fromkeys(labels[first:last].tolist()))
+    
+    return annotations
+
+
 if __name__ == "__main__":
     main()
 
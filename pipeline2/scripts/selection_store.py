@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Functions to save the cohort selection tables of create_dNdS_tables.py as a binary columnar store, and to load parts of it.
+The store is a directory holding hxb2.npy (sorted HXB2 codon positions, the rows of every table), one float64 matrix per value
+(rows are HXB2 positions, columns are participants, stored column by column so loading a few participants only reads their columns)
+and meta.json (participants, values and their files, and the [start, stop) rows of every significant annotation, so annotation
+tables are references into the full tables rather than copies). Matrices are opened as memory maps, nothing is parsed from text"""
+
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline1', 'scripts'))
+from file_utils import atomic_writer
+
+
+# file name of each value's matrix in the store
+VALUE_FILES = {'dS': 'dS.npy', 'dN': 'dN.npy', 'P(dS<dN)': 'prob.npy', 'dN/dS': 'dNdS.npy'}
+
+
+def write_selection_store(directory, tables, annotations=None):
+    """Function to save tables ({value: dataframe}, all with the same HXB2 positions as rows and participant IDs as columns)
+    to a store in directory, with the row ranges of annotations ({annotation: [start, stop]} HXB2 positions, inclusive)"""
+
+    os.makedirs(directory, exist_ok = True)
+
+    # remove the meta data of an earlier store first, so readers never pair it with half-written matrices
+    if os.path.exists(f'{directory}/meta.json'):
+        os.remove(f'{directory}/meta.json')
+
+    first = next(iter(tables.values()))
+    hxb2_axis = first.index.to_numpy(dtype = float)
+
+    # rows of each annotation, the same rows as selecting index >= start and index <= stop
+    ranges = {annotation: [int(np.searchsorted(hxb2_axis, start, side = 'left')), int(np.searchsorted(hxb2_axis, stop, side = 'right'))]
+              for annotation, (start, stop) in (annotations or {}).items()}
+
+    # one matrix per value, column by column
+    for value, table_df in tables.items():
+        with atomic_writer(f'{directory}/{VALUE_FILES[value]}', 'wb') as outfile:
+            np.save(outfile, np.asfortranarray(table_df.to_numpy(dtype = float)))
+
+    with atomic_writer(f'{directory}/hxb2.npy', 'wb') as outfile:
+        np.save(outfile, hxb2_axis)
+
+    # meta data is written last, so a store is only complete once it exists
+    meta = {'participants': [str(id) for id in first.columns],
+            'values': {value: VALUE_FILES[value] for value in tables},
+            'rows': len(hxb2_axis),
+            'annotations': ranges}
+
+    with atomic_writer(f'{directory}/meta.json') as outfile:
+        json.dump(meta, outfile, indent = 1)
+
+
+def read_store_meta(directory):
+    """Function to read the meta data of a store (participants, values, rows, annotation row ranges),
+    failing if the store is missing or was not completely written"""
+
+    if not os.path.exists(f'{directory}/meta.json'):
+        raise FileNotFoundError(f'No complete selection store in {directory} (meta.json is missing, the store is being written or its writing failed)')
+
+    with open(f'{directory}/meta.json', 'r') as infile:
+        return json.load(infile)
+
+
+def load_selection_table(directory, value, participants=None, rows=None, annotation=None, meta=None):
+    """Function to load a table of one value from a store, HXB2 positions as rows and participant IDs as columns;
+    only the participants given (default all) and the rows given ([start, stop), default all) or the rows of an annotation are read"""
+
+    if meta is None:
+        meta = read_store_meta(directory)
+
+    # rows to read
+    if annotation is not None:
+        rows = meta['annotations'][annotation]
+    start, stop = rows if rows is not None else (0, meta['rows'])
+
+    # columns to read
+    if participants is None:
+        participants = meta['participants']
+    columns = [meta['participants'].index(id) for id in participants]
+
+    # open as memory maps, then copy out just the needed block
+    hxb2_axis = np.load(f'{directory}/hxb2.npy', mmap_mode = 'r')
+    matrix = np.load(f'{directory}/{meta["values"][value]}', mmap_mode = 'r')
+
+    return pd.DataFrame(np.array(matrix[start:stop, columns]), index = np.array(hxb2_axis[start:stop]), columns = list(participants))
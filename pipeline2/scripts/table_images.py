@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""Functions to render the per-annotation selection tables of create_dNdS_tables.py as images (png, drawn with matplotlib's
+non-interactive Agg backend) or as lightweight html tables that stay small with hundreds of participant columns.
+Tables are rendered across a process pool, and a table whose contents have not changed since its file was written is not rendered again"""
+
+import os
+import sys
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline1', 'scripts'))
+from file_utils import atomic_writer
+from manifest import Manifest, text_digest
+
+
+# formats tables can be rendered to
+TABLE_FORMATS = ['png', 'html']
+
+
+def get_table_filename(directory, annotation, suffix, format):
+    """Function to get the file name of a rendered table, / characters are replaced in the annotation name"""
+
+    return f'{directory}/{annotation.replace("/", "_")}{suffix}_table.{format}'
+
+
+def dataframe_to_table_image(table_df, annotation, outfile):
+    """Function takes as input a table of values for an annotation; saves the table as a png image titled with the annotation"""
+
+    # draw without a display, as in a batch job
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    # create a table from dataframe
+    fig, ax = plt.subplots(figsize=(45, 20))  # Adjust the figure size as needed
+    ax.axis('off')  # Remove axis
+    ax.set_title(annotation)
+
+    # replace NaN cells in table with whitespace
+    table_df = table_df.astype(object).where(table_df.notna(), '')
+
+    table = pd.plotting.table(ax, table_df, loc='center', cellLoc='center')
+
+    # Adjust the font size of the table
+    table.auto_set_font_size(False)
+    table.set_fontsize(8)  # Adjust the font size as needed
+
+    # Adjust the cell size
+    table.scale(1.5, 2)  # Increase the cell size by a factor of 1.5 (adjust as needed)
+
+    with atomic_writer(outfile, 'wb') as image:
+        fig.savefig(image, format = 'png', bbox_inches = "tight")
+    plt.close(fig)
+
+
+def dataframe_to_table_html(table_df, annotation, outfile):
+    """Function takes as input a table of values for an annotation; saves the table as an html page titled with the annotation"""
+
+    title = annotation.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    # HXB2 positions without trailing zeros
+    table_df = table_df.set_axis([f'{pos:g}' for pos in table_df.index])
+
+    with atomic_writer(outfile) as page:
+        page.write(f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{title}</title>\n'
+                   '<style>table {border-collapse: collapse; font: 12px sans-serif} td, th {border: 1px solid #ccc; padding: 2px 6px; text-align: center}</style>\n'
+                   f'</head>\n<body>\n<h3>{title}</h3>\n')
+        page.write(table_df.to_html(na_rep = '', float_format = '{:g}'.format))
+        page.write('\n</body>\n</html>\n')
+
+
+def render_table(table_df, annotation, outfile, format):
+    """Function to render one table to outfile in format (png or html)"""
+
+    if format == 'png':
+        dataframe_to_table_image(table_df, annotation, outfile)
+    else:
+        dataframe_to_table_html(table_df, annotation, outfile)
+
+
+def render_tables(tables, directory, formats=('png',), jobs=1, force=False):
+    """Function to render every table in formats across jobs processes, tables are (dataframe, annotation, suffix);
+    a table is skipped if its file exists and the table has not changed since the file was written, unless force is set"""
+
+    # load record of tables already rendered
+    manifest = Manifest(directory, 'table_images', force = force)
+
+    # one task per table and format that changed
+    tasks = []
+    for table_df, annotation, suffix in tables:
+        params = {'annotation': annotation, 'table': text_digest(table_df.to_csv())}
+        for format in formats:
+            outfile = get_table_filename(directory, annotation, suffix, format)
+            if not manifest.is_current(os.path.basename(outfile), [], params, [outfile]):
+                tasks.append((table_df, annotation, outfile, format, params))
+
+    # fan tables out to a process pool, or render in this process for a single job
+    if jobs > 1 and tasks:
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            list(executor.map(render_table, *list(zip(*tasks))[:4]))
+    else:
+        for table_df, annotation, outfile, format, params in tasks:
+            render_table(table_df, annotation, outfile, format)
+
+    # record rendered tables
+    for table_df, annotation, outfile, format, params in tasks:
+        manifest.record(os.path.basename(outfile), [], params, [outfile])
+    manifest.save()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""Script to split one participant's sequences into subpopulations by clustering their translated alignment on Hamming distance,
+over every column or only over selected HXB2 codons (e.g. the rows of common_codons_5.csv, found in the alignment as haplotype_linkage.py does).
+Distance is the fraction of compared columns (residue in both sequences) that differ. Identical sequences are collapsed first and weighted
+by their number of copies. Cluster centers are picked far apart (each new center is the sequence farthest from the centers so far, until there are
+-k centers or every sequence is within --radius of one), then refined by assigning sequences to the nearest center and replacing each center
+with its cluster's consensus; clusters of fewer than --min-size sequences (often outliers picked as centers) are dissolved into the others.
+Distances are only ever computed from sequences to centers, a block of sequences at a time, so no sequence by sequence distance matrix
+is held in memory. Outputs the cluster of every sequence and the consensus of every cluster"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline1', 'scripts'))
+from catalog import get_alignment_id
+from file_utils import atomic_writer, iter_fasta
+from haplotype_linkage import MISSING, find_alignment_columns, read_consensus_positions, read_residues
+
+
+# residues compared at once when computing distances to centers
+BLOCK_RESIDUES = 1 << 24
+
+# code of a center column without a residue
+GAP = ord('-')
+
+
+def main():
+    # get command line arguments
+    args = get_args()
+
+    id = args.id or get_alignment_id(args.alignment)
+
+    # residues of every sequence, over the selected sites if any
+    headers = [header.split()[0] for header, sequence in iter_fasta(args.alignment)]
+    residues = read_residues(args.alignment)
+    if args.codons or args.sites:
+        if not args.annotations and not args.position_index:
+            sys.exit('Selecting sites needs the consensus annotations (-m) or the position index (-p)')
+        hxb2_sites = np.array(args.sites, dtype = float) if args.sites else pd.read_csv(args.codons, index_col = 0).index.to_numpy(dtype = float)
+        columns, hxb2_sites = find_alignment_columns(hxb2_sites, read_consensus_positions(id, args.annotations, args.position_index), residues.shape[1])
+        residues = residues[:, columns]
+
+    # collapse identical sequences
+    unique, inverse, weights = np.unique(residues, axis = 0, return_inverse = True, return_counts = True)
+    inverse = inverse.ravel()
+
+    labels, centers, distances = cluster_sequences(unique, weights, args.clusters, args.radius, args.max_clusters, args.iterations, args.min_size)
+
+    # number clusters from 1, largest first
+    sizes = np.bincount(labels, weights = weights, minlength = len(centers))
+    order = np.argsort(-sizes, kind = 'stable')
+    rank = np.empty(len(order), dtype = int)
+    rank[order] = np.arange(1, len(order) + 1)
+
+    # save cluster of every sequence and consensus of every cluster
+    os.makedirs(args.outdir, exist_ok = True)
+    clusters_df = pd.DataFrame({'sequence': headers, 'cluster': rank[labels[inverse]], 'distance': distances[inverse]})
+    with atomic_writer(f'{args.outdir}/{id}_clusters.csv') as outfile:
+        clusters_df.to_csv(outfile, index = False)
+
+    with atomic_writer(f'{args.outdir}/{id}_cluster_consensus.fa') as outfile:
+        for cluster in order:
+            outfile.write(f'>{id}_cluster_{rank[cluster]} size={int(sizes[cluster])}\n{centers[cluster].tobytes().decode("ascii")}\n')
+
+
+def get_args():
+    """Get command line arguments"""
+    parser = argparse.ArgumentParser(description='Cluster the sequences of one participant into subpopulations by Hamming distance')
+
+    parser.add_argument('-a', '--alignment', type = str, dest = 'alignment', required = True, help = 'Translated (protein) alignment of the participant')
+
+    parser.add_argument('-m', '--annotations', type = str, dest = 'annotations', help = 'Consensus annotations of the participant ([id]_consensus_annotations.csv), to select sites')
+
+    parser.add_argument('-p', '--position-index', type = str, dest = 'position_index', help = 'Binary position index of the cohort (path without extension, from get_position_mappings.py), to select sites instead of the consensus annotations')
+
+    parser.add_argument('-c', '--codons', type = str, dest = 'codons', help = 'Table with HXB2 codon positions as rows (e.g. common_codons_5.csv), to cluster on those sites only')
+
+    parser.add_argument('-s', '--sites', nargs = '+', type = float, dest = 'sites', help = 'HXB2 codon positions to cluster on, instead of a table')
+
+    parser.add_argument('-k', '--clusters', type = int, dest = 'clusters', default = 0, help = 'Number of clusters (0 to add clusters until every sequence is within --radius of a center)')
+
+    parser.add_argument('-r', '--radius', type = float, dest = 'radius', default = 0.05, help = 'Largest distance (fraction of compared sites) from a sequence to its center when the number of clusters is not given')
+
+    parser.add_argument('--max-clusters', type = int, dest = 'max_clusters', default = 20, help = 'Largest number of clusters when the number of clusters is not given')
+
+    parser.add_argument('--min-size', type = int, dest = 'min_size', default = 2, help = 'Dissolve clusters of fewer sequences into the nearest other clusters')
+
+    parser.add_argument('--iterations', type = int, dest = 'iterations', default = 20, help = 'Largest number of refinement rounds')
+
+    parser.add_argument('-o', '--outdir', type = str, dest = 'outdir', default = 'results/clusters', help = 'Directory to write tables')
+
+    parser.add_argument('--id', type = str, dest = 'id', help = 'Participant ID used to name outputs (default from the alignment file name)')
+
+    args = parser.parse_args()
+    return args
+
+
+def get_distances(residues, center):
+    """Function to get the distance from every sequence (rows of a residue matrix) to every center (rows of a residue matrix),
+    the fraction of columns with a residue in both that differ (0 where none are compared); computed a block of sequences at a time"""
+
+    missing_codes = np.frombuffer(MISSING, dtype = np.uint8)
+    center_present = ~np.isin(center, missing_codes)
+
+    distances = np.zeros((len(residues), len(center)))
+    block = max(1, BLOCK_RESIDUES // max(center.size, 1))
+
+    for start in range(0, len(residues), block):
+        rows = residues[start:start + block]
+
+        compared = ~np.isin(rows, missing_codes)[:, None, :] & center_present[None, :, :]
+        differ = (rows[:, None, :] != center[None, :, :]) & compared
+
+        n_compared = compared.sum(axis = 2)
+        distances[start:start + block] = differ.sum(axis = 2) / np.maximum(n_compared, 1)
+
+    return distances
+
+
+def pick_centers(residues, weights, clusters=0, radius=0.05, max_clusters=20):
+    """Function to pick centers far apart: the most common sequence first, then the sequence farthest from every center so far,
+    until there are clusters centers, or (clusters 0) every sequence is within radius of a center or there are max_clusters; returns center rows"""
+
+    target = clusters if clusters > 0 else max_clusters
+    centers = [int(np.argmax(weights))]
+    nearest = get_distances(residues, residues[centers])[:, 0]
+
+    while len(centers) < min(target, len(residues)):
+        farthest = int(np.argmax(nearest))
+        if clusters <= 0 and nearest[farthest] <= radius:
+            break
+        if nearest[farthest] == 0:
+            break
+        centers.append(farthest)
+        nearest = np.minimum(nearest, get_distances(residues, residues[[farthest]])[:, 0])
+
+    return np.array(centers, dtype = int)
+
+
+def get_consensus(residues, weights, labels, n_clusters):
+    """Function to get the consensus of every cluster, the most common residue (by weight) of every column among the cluster's sequences;
+    a column with no residue in a cluster is a gap; returns a clusters by columns residue matrix"""
+
+    n_columns = residues.shape[1]
+    present = ~np.isin(residues, np.frombuffer(MISSING, dtype = np.uint8))
+
+    # weight of every residue of every column of every cluster
+    rows, columns = np.nonzero(present)
+    cells = (labels[rows] * n_columns + columns) * 256 + residues[rows, columns]
+    counts = np.bincount(cells, weights = weights[rows], minlength = n_clusters * n_columns * 256).reshape(n_clusters, n_columns, 256)
+
+    consensus = counts.argmax(axis = 2).astype(np.uint8)
+
+    return np.where(counts.max(axis = 2) > 0, consensus, GAP).astype(np.uint8)
+
+
+def cluster_sequences(residues, weights, clusters=0, radius=0.05, max_clusters=20, iterations=20, min_size=2):
+    """Function to cluster sequences (rows of a residue matrix, each weighted by its number of copies): pick centers far apart,
+    then assign every sequence to its nearest center and replace centers with cluster consensus sequences until assignments do not change;
+    centers with fewer than min_size sequences are dropped (unless every center is that small) and their sequences go to the nearest other center;
+    returns (cluster of every sequence, consensus of every cluster, distance of every sequence to its cluster's consensus)"""
+
+    centers = residues[pick_centers(residues, weights, clusters, radius, max_clusters)]
+    labels = None
+
+    for iteration in range(max(iterations, 1)):
+        distances = get_distances(residues, centers)
+        new_labels = distances.argmin(axis = 1)
+
+        # drop small clusters, then assign again
+        small = np.bincount(new_labels, weights = weights, minlength = len(centers)) < min_size
+        if small.any() and not small.all():
+            centers = centers[~small]
+            labels = None
+            continue
+
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+
+        # drop clusters that lost every sequence, number the rest from 0
+        kept, labels = np.unique(labels, return_inverse = True)
+        labels = labels.ravel()
+        centers = get_consensus(residues, weights, labels, len(kept))
+
+    distances = get_distances(residues, centers)
+    labels = distances.argmin(axis = 1)
+
+    # leave out centers no sequence is nearest to
+    kept, labels = np.unique(labels, return_inverse = True)
+
+    return labels.ravel(), centers[kept], distances[:, kept][np.arange(len(residues)), labels.ravel()]
+
+
+if __name__ == "__main__":
+    main()
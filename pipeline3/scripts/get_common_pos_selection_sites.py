@@ -1,51 +1,278 @@
 #!/usr/bin/env python
 
-"""Script to go through table of P(dS<dN) values for entire gene, extract rows (codon positions) where 
-given number of participants or more had significant dN/dS"""
+"""Script to go through table of P(dS<dN) values for entire gene, extract rows (codon positions) where
+given number of participants or more had significant dN/dS.
+In sweep mode (-d), every combination of probability cutoffs (-c) and participant thresholds (-t) is extracted from one pass over the table,
+each to its own file, along with a summary matrix of the number of codons extracted for each combination.
+The table is read a chunk of rows at a time, so memory stays flat for tables of many genes and hundreds of participants.
+With -p, significance is tested by permuting each participant's column independently: every codon gets an empirical p-value
+(how often a permutation has as many participants at or above the cutoff at that codon) and a Benjamini-Hochberg FDR,
+and every threshold gets the number of common codons expected by chance"""
 
 
 # imports
+import os
+import sys
 import argparse
+import contextlib
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline1', 'scripts'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline2', 'scripts'))
+from file_utils import atomic_writer
+from selection_store import load_selection_table, read_store_meta
 
 
 def main():
     # get CLI arguments
     args = get_args()
-    
-    # open file as dataframe
-    df = pd.read_csv(args.infile, index_col = 0)
-        
-    # create a boolean mask where values are True if they are greater than or equal to 0.9
-    mask = df >= 0.9
-        
-    # Sum the boolean values across columns (patients) for each row
-    row_sums = mask.sum(axis=1)
-        
-    # define the minimum number of patients that should exceed 0.9
-    min_patients = args.threshold
-        
-    # filter dataframe by rows where [threshold] columns or more have P(dS<dN) > 0.9
-    filtered_df = df[row_sums >= min_patients]
-    
-    # save filtered dataframe as table
-    filtered_df.to_csv(args.outfile)
-    
+
+    # in sweep mode every combination gets a file in the output directory, otherwise the one combination goes to outfile
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok = True)
+        outfiles = {(cutoff, threshold): get_sweep_filename(args.outdir, cutoff, threshold) for cutoff in args.cutoffs for threshold in args.thresholds}
+    else:
+        outfiles = {(args.cutoffs[0], args.thresholds[0]): args.outfile}
+
+    # keep which participants are at or above each cutoff at every codon while reading the table, for the permutation test
+    chunks = iter_table_chunks(args.infile, args.store, args.chunk_size)
+    exceedances = []
+    if args.permutations:
+        chunks = record_exceedances(chunks, args.cutoffs, exceedances)
+
+    # extract common sites of every combination, one chunk of the table at a time
+    summary_df = sweep_common_sites(chunks, args.cutoffs, args.thresholds, outfiles)
+
+    # save number of codons extracted for every combination, the first header names both axes (cutoffs as rows, thresholds as columns)
+    if args.outdir:
+        with atomic_writer(f'{args.outdir}/common_codons_summary.csv') as outfile:
+            summary_df.to_csv(outfile, index_label = f'{summary_df.index.name}/{summary_df.columns.name}')
+
+    if args.permutations:
+
+        # p-values of codons and expected number of common codons, for every cutoff
+        index = np.concatenate([chunk_index for chunk_index, exceeded in exceedances])
+        exceeded = np.concatenate([exceeded for chunk_index, exceeded in exceedances])
+        significance_df, null_df = permutation_test_common_sites(index, exceeded, args.cutoffs, args.thresholds, args.permutations,
+                                                                 args.batch_size, args.seed, args.jobs)
+
+        # save p-values of codons where at least the smallest threshold of participants are at or above the cutoff
+        prefix = f'{args.outdir}/common_codons' if args.outdir else os.path.splitext(args.outfile)[0]
+        with atomic_writer(f'{prefix}_significance.csv') as outfile:
+            significance_df[significance_df['participants'] >= min(args.thresholds)].to_csv(outfile, index = False)
+        with atomic_writer(f'{prefix}_null.csv') as outfile:
+            null_df.to_csv(outfile, index = False)
+
 
 def get_args():
     """parse CLI arguments"""
-    
+
     parser = argparse.ArgumentParser(description='Create table of common significant positive selection sites')
-    
+
     parser.add_argument('-i', '--infile', dest='infile', help='File containing P(dS<dN) values for gene')
-    parser.add_argument('-t', '--threshold', dest='threshold', help='Threshold for how many participants need significance for codon to be extracted', type=int, default=5)
+    parser.add_argument('-s', '--store', dest='store', help='Selection store directory written by create_dNdS_tables.py, read instead of infile')
+    parser.add_argument('-t', '--threshold', dest='thresholds', nargs='+', help='Threshold for how many participants need significance for codon to be extracted (several in sweep mode)', type=int, default=[5])
+    parser.add_argument('-c', '--cutoff', dest='cutoffs', nargs='+', help='P(dS<dN) cutoff for a participant to have significance at a codon (several in sweep mode)', type=float, default=[0.9])
     parser.add_argument('-o', '--outfile', dest='outfile', help='File to write results')
-    
+    parser.add_argument('-d', '--outdir', dest='outdir', help='Sweep mode: directory to write the results of every cutoff and threshold, and a summary matrix')
+    parser.add_argument('--chunk-size', dest='chunk_size', help='Number of rows (codon positions) of the table to read at a time', type=int, default=10000)
+    parser.add_argument('-p', '--permutations', dest='permutations', help='Number of permutations to test significance with (0 to skip), writes [outfile]_significance.csv and [outfile]_null.csv', type=int, default=0)
+    parser.add_argument('--batch-size', dest='batch_size', help='Number of permutations computed at once in one process', type=int, default=100)
+    parser.add_argument('--seed', dest='seed', help='Seed of the random permutations', type=int, default=0)
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of processes to run permutation batches in', type=int, default=1)
+
     args = parser.parse_args()
-    
+
+    if not args.infile and not args.store:
+        parser.error('one of -i/--infile or -s/--store is required')
+
+    if not args.outdir and not args.outfile:
+        parser.error('one of -o/--outfile or -d/--outdir is required')
+
+    if not args.outdir and (len(args.cutoffs) > 1 or len(args.thresholds) > 1):
+        parser.error('several cutoffs or thresholds need -d/--outdir')
+
     return args
-    
+
+
+def get_sweep_filename(outdir, cutoff, threshold):
+    """Function to get the file name of the results of one cutoff and threshold in sweep mode"""
+
+    return f'{outdir}/common_codons_{threshold}_cutoff_{cutoff:g}.csv'
+
+
+def iter_table_chunks(infile=None, store=None, chunk_size=10000):
+    """Function to read the table of P(dS<dN) values (codon positions as rows, participants as columns) chunk_size rows at a time,
+    from a csv file or from a selection store; returns a generator of dataframes"""
+
+    if store:
+        rows = read_store_meta(store)['rows']
+        for start in range(0, max(rows, 1), chunk_size):
+            yield load_selection_table(store, 'P(dS<dN)', rows = (start, min(start + chunk_size, rows)))
+    else:
+        yield from pd.read_csv(infile, index_col = 0, chunksize = chunk_size)
+
+
+def count_exceedances(values, cutoffs):
+    """Function to count, for every row of a matrix of P(dS<dN) values, the participants with a value greater than or equal to each cutoff;
+    returns a matrix of counts (rows by cutoffs)"""
+
+    # NaN is never greater than or equal to a cutoff
+    with np.errstate(invalid = 'ignore'):
+        return (values[:, :, None] >= np.asarray(cutoffs)[None, None, :]).sum(axis = 1)
+
+
+def sweep_common_sites(chunks, cutoffs, thresholds, outfiles):
+    """Function to extract the rows where threshold or more participants have P(dS<dN) >= cutoff from every chunk of the table,
+    for every combination of cutoffs and thresholds, writing the rows of each combination in outfiles ({(cutoff, threshold): file}) as they are found;
+    returns the number of rows extracted for every combination (cutoffs as rows, thresholds as columns)"""
+
+    summary = np.zeros((len(cutoffs), len(thresholds)), dtype = int)
+
+    with contextlib.ExitStack() as stack:
+
+        # open every output file, each replaced only once the whole table has been read
+        handles = {combination: stack.enter_context(atomic_writer(outfile)) for combination, outfile in outfiles.items()}
+
+        header = True
+
+        for df in chunks:
+
+            # number of participants with P(dS<dN) >= cutoff, for every row and cutoff
+            counts = count_exceedances(df.to_numpy(dtype = float), cutoffs)
+
+            for c, cutoff in enumerate(cutoffs):
+                for t, threshold in enumerate(thresholds):
+
+                    # filter chunk by rows where [threshold] columns or more have P(dS<dN) >= cutoff
+                    keep = counts[:, c] >= threshold
+                    summary[c, t] += keep.sum()
+
+                    if (cutoff, threshold) in handles:
+                        df[keep].to_csv(handles[(cutoff, threshold)], header = header)
+
+            header = False
+
+    return pd.DataFrame(summary, index = pd.Index(cutoffs, name = 'cutoff'), columns = pd.Index(thresholds, name = 'threshold'))
+
+
+def record_exceedances(chunks, cutoffs, exceedances):
+    """Function to pass chunks of the table through unchanged while appending (index, rows by participants by cutoffs matrix of P(dS<dN) >= cutoff)
+    of every chunk to exceedances"""
+
+    for df in chunks:
+        with np.errstate(invalid = 'ignore'):
+            exceedances.append((df.index.to_numpy(), df.to_numpy(dtype = float)[:, :, None] >= np.asarray(cutoffs)[None, None, :]))
+        yield df
+
+
+def permute_counts(exceeded, observed, thresholds, size, batch_size, seed):
+    """Function to run size permutations of a rows by participants matrix of exceedances (every participant's column shuffled independently),
+    batch_size at a time; returns (number of permutations where each row has at least its observed count,
+    number of rows with a count of at least each threshold in every permutation (permutations by thresholds))"""
+
+    rng = np.random.default_rng(seed)
+    n_rows = exceeded.shape[0]
+
+    # a shuffled column only matters through where its exceedances land: the first k places of a shuffled order of rows,
+    # so only k steps of a Fisher-Yates shuffle are drawn (participants sorted by k, so the ones still drawing come first)
+    k = np.sort(exceeded.sum(axis = 0))[::-1]
+    landing = np.arange(n_rows) < k[:, None]
+    thresholds = np.asarray(thresholds)
+
+    at_least_observed = np.zeros(n_rows, dtype = np.int64)
+    null_common = []
+
+    for start in range(0, size, batch_size):
+        batch = min(batch_size, size - start)
+
+        # order of rows of every participant of every permutation
+        order = np.broadcast_to(np.arange(n_rows, dtype = np.int32), (batch, len(k), n_rows)).copy()
+        batches = np.arange(batch)[:, None]
+
+        for i in range(k.max(initial = 0)):
+
+            # swap place i with a random place from i on, for participants with more than i exceedances
+            active = np.arange(np.searchsorted(-k, -i, side = 'left'))
+            swap = i + rng.integers(0, n_rows - i, size = (batch, len(active)))
+            chosen = order[batches, active, swap]
+            order[batches, active, swap] = order[:, active, i]
+            order[:, active, i] = chosen
+
+        # count participants at each row of every permutation
+        rows = order[:, landing] + batches * n_rows
+        counts = np.bincount(rows.ravel(), minlength = batch * n_rows).reshape(batch, n_rows)
+
+        at_least_observed += (counts >= observed).sum(axis = 0)
+        null_common.append((counts[:, :, None] >= thresholds).sum(axis = 1))
+
+    return at_least_observed, np.concatenate(null_common)
+
+
+def benjamini_hochberg(p_values):
+    """Function to get Benjamini-Hochberg adjusted p-values (FDR) of an array of p-values"""
+
+    p_values = np.asarray(p_values, dtype = float)
+    n = len(p_values)
+    if not n:
+        return p_values
+
+    order = np.argsort(p_values)
+    adjusted = p_values[order] * n / np.arange(1, n + 1)
+
+    # adjusted p-values cannot decrease with rank, and are at most 1
+    adjusted = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], 1)
+
+    fdr = np.empty(n)
+    fdr[order] = adjusted
+
+    return fdr
+
+
+def permutation_test_common_sites(index, exceeded, cutoffs, thresholds, permutations, batch_size=100, seed=0, jobs=1):
+    """Function to test common sites against permutations of every participant's column, for every cutoff;
+    index is the codon positions, exceeded the rows by participants by cutoffs matrix of P(dS<dN) >= cutoff;
+    returns (table of codon, cutoff, participants, p_value and fdr of every codon and cutoff,
+    table of cutoff, threshold, observed and expected (mean, 95th percentile) number of common codons and p_value)"""
+
+    # permutations are run in batches, each with its own random stream, so results do not depend on the number of jobs
+    sizes = [min(batch_size, permutations - start) for start in range(0, permutations, batch_size)]
+
+    codon_tables = []
+    null_rows = []
+
+    for c, cutoff in enumerate(cutoffs):
+
+        observed = exceeded[:, :, c].sum(axis = 1)
+        seeds = np.random.SeedSequence([seed, c]).spawn(len(sizes))
+        tasks = [(exceeded[:, :, c], observed, thresholds, size, size, batch_seed) for size, batch_seed in zip(sizes, seeds)]
+
+        # spread batches over a process pool, or run in this process for a single job
+        if jobs > 1 and tasks:
+            with ProcessPoolExecutor(max_workers = jobs) as executor:
+                results = list(executor.map(permute_counts, *zip(*tasks)))
+        else:
+            results = [permute_counts(*task) for task in tasks]
+
+        at_least_observed = sum(result[0] for result in results)
+        null_common = np.concatenate([result[1] for result in results])
+
+        # empirical p-values, counting the observed table as one of the permutations
+        p_values = (at_least_observed + 1) / (permutations + 1)
+        codon_tables.append(pd.DataFrame({'codon': index, 'cutoff': cutoff, 'participants': observed,
+                                          'p_value': p_values, 'fdr': benjamini_hochberg(p_values)}))
+
+        for t, threshold in enumerate(thresholds):
+            observed_common = int((observed >= threshold).sum())
+            null_rows.append({'cutoff': cutoff, 'threshold': threshold, 'observed': observed_common,
+                              'expected': null_common[:, t].mean(), 'expected_95': np.percentile(null_common[:, t], 95),
+                              'p_value': ((null_common[:, t] >= observed_common).sum() + 1) / (permutations + 1)})
+
+    return pd.concat(codon_tables, ignore_index = True), pd.DataFrame(null_rows)
+
 
 if __name__ == "__main__":
     main()
-    
+
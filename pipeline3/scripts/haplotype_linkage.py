@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""Script to measure linkage between positively selected sites of one participant from their translated alignment.
+Sites are HXB2 codon positions (e.g. the rows of common_codons_5.csv), found in the alignment through the participant's
+consensus annotations or the cohort's binary position index (the same liftover create_dNdS_tables.py uses to place sites on HXB2).
+Every residue at every site is encoded as a bitset over sequences (packed 64 sequences to a word), so the number of sequences
+sharing two residues is the popcount of two bitsets ANDed together. Outputs, for every pair of sites, the co-occurrence count,
+D, D' and r squared of every pair of residues, matrices of r squared and D' between the most common residues of every site,
+and the frequency of every haplotype (combination of residues at all sites, named like the WEBPSSM groups, e.g. 304K_320I)"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline1', 'scripts'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pipeline2', 'scripts'))
+from catalog import get_alignment_id
+from file_utils import atomic_writer, iter_fasta
+from create_dNdS_tables import liftover_sites
+from get_position_mappings import get_position_frame, load_position_index
+
+
+# residues that are not a state of a site (gaps, unknown amino acids, positions past the end of a sequence)
+MISSING = b'-X?.'
+
+# number of set bits of every byte, for numpy versions without bitwise_count
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype = np.uint8)
+
+# words of bitsets ANDed at once when counting co-occurrences
+BLOCK_WORDS = 1 << 23
+
+
+def main():
+    # get command line arguments
+    args = get_args()
+
+    id = args.id or get_alignment_id(args.alignment)
+
+    # HXB2 codon positions to look at
+    if args.sites:
+        hxb2_sites = np.array(args.sites, dtype = float)
+    else:
+        hxb2_sites = pd.read_csv(args.codons, index_col = 0).index.to_numpy(dtype = float)
+
+    # residues of every sequence at every site found in the participant's alignment
+    residues = read_residues(args.alignment)
+    columns, hxb2_sites = find_alignment_columns(hxb2_sites, read_consensus_positions(id, args.annotations, args.position_index), residues.shape[1])
+    labels = [f'{site:g}' for site in hxb2_sites]
+
+    # bitsets of every residue of every site
+    sites, states, bits, valid = encode_sites(residues[:, columns])
+
+    cooccurrence = count_cooccurrence(bits)
+    cooccurrence_df, r2_df, Dprime_df = get_linkage(labels, sites, states, cooccurrence, valid, args.min_count)
+    haplotypes_df = get_haplotype_frequencies(labels, sites, states, bits, valid, args.min_count)
+
+    # save every table
+    os.makedirs(args.outdir, exist_ok = True)
+    for name, table_df, index in [('cooccurrence', cooccurrence_df, False), ('r2', r2_df, True), ('Dprime', Dprime_df, True), ('haplotypes', haplotypes_df, False)]:
+        with atomic_writer(f'{args.outdir}/{id}_{name}.csv') as outfile:
+            table_df.to_csv(outfile, index = index)
+
+
+def get_args():
+    """Get command line arguments"""
+    parser = argparse.ArgumentParser(description='Co-occurrence, linkage and haplotype frequencies of selected sites of one participant')
+
+    parser.add_argument('-a', '--alignment', type = str, dest = 'alignment', required = True, help = 'Translated (protein) alignment of the participant')
+
+    parser.add_argument('-m', '--annotations', type = str, dest = 'annotations', help = 'Consensus annotations of the participant ([id]_consensus_annotations.csv)')
+
+    parser.add_argument('-p', '--position-index', type = str, dest = 'position_index', help = 'Binary position index of the cohort (path without extension, from get_position_mappings.py), instead of the consensus annotations')
+
+    parser.add_argument('-c', '--codons', type = str, dest = 'codons', help = 'Table with HXB2 codon positions as rows (e.g. common_codons_5.csv)')
+
+    parser.add_argument('-s', '--sites', nargs = '+', type = float, dest = 'sites', help = 'HXB2 codon positions, instead of a table')
+
+    parser.add_argument('-o', '--outdir', type = str, dest = 'outdir', default = 'results/linkage', help = 'Directory to write tables')
+
+    parser.add_argument('--id', type = str, dest = 'id', help = 'Participant ID used to name tables (default from the alignment file name)')
+
+    parser.add_argument('--min-count', type = int, dest = 'min_count', default = 1, help = 'Leave out haplotypes and pairs of residues carried by fewer sequences')
+
+    args = parser.parse_args()
+
+    if not args.codons and not args.sites:
+        parser.error('one of -c/--codons or -s/--sites is required')
+
+    if not args.annotations and not args.position_index:
+        parser.error('one of -m/--annotations or -p/--position-index is required')
+
+    return args
+
+
+def read_residues(filename):
+    """Function to read a translated alignment as a matrix of residues (sequences as rows, uppercase characters as bytes);
+    sequences shorter than the longest are padded with gaps"""
+
+    sequences = [sequence.upper().encode('ascii') for header, sequence in iter_fasta(filename)]
+
+    length = max((len(sequence) for sequence in sequences), default = 0)
+    residues = np.full((len(sequences), length), ord('-'), dtype = np.uint8)
+    for row, sequence in enumerate(sequences):
+        residues[row, :len(sequence)] = np.frombuffer(sequence, dtype = np.uint8)
+
+    return residues
+
+
+def read_consensus_positions(id, annotations=None, position_index=None):
+    """Function to get the position columns of a participant's consensus annotations, from the memory-mapped binary position index
+    if one is given (only the participant's rows are read) or from the consensus annotations csv"""
+
+    if position_index:
+        positions = load_position_index(position_index)
+        if id not in positions:
+            sys.exit(f'{id} is not in the position index {position_index}')
+        return get_position_frame(positions[id])
+
+    return pd.read_csv(annotations)
+
+
+def find_alignment_columns(hxb2_sites, consensus_annotations, length):
+    """Function to find the alignment column (from 0) of every HXB2 codon position, by placing every alignment site on HXB2;
+    positions that are not in the participant's alignment are reported and left out; returns (columns, HXB2 positions found)"""
+
+    # change index to start from 1, as sites are numbered
+    consensus_annotations = consensus_annotations.set_axis(consensus_annotations.index + 1)
+
+    # HXB2 position of every alignment site
+    sites = np.arange(1, min(length, len(consensus_annotations)) + 1)
+    positions = liftover_sites(sites, consensus_annotations)
+
+    columns = []
+    found = []
+    for hxb2_site in hxb2_sites:
+        matches = np.flatnonzero(positions == hxb2_site)
+        if len(matches):
+            columns.append(sites[matches[0]] - 1)
+            found.append(hxb2_site)
+        else:
+            print(f'HXB2 position {hxb2_site:g} is not in the alignment, left out', file = sys.stderr)
+
+    return np.array(columns, dtype = int), np.array(found, dtype = float)
+
+
+def pack_bits(masks):
+    """Function to pack boolean masks (rows of sequences) into bitsets of 64 bit words"""
+
+    packed = np.packbits(masks, axis = 1)
+
+    # pad every row to whole words
+    padded = np.zeros((packed.shape[0], -(-packed.shape[1] // 8) * 8), dtype = np.uint8)
+    padded[:, :packed.shape[1]] = packed
+
+    return padded.view(np.uint64)
+
+
+def encode_sites(residues):
+    """Function to encode the residues at every site (sequences by sites matrix) as bitsets over sequences, the states of a site next to each other;
+    returns (site of every state, residue of every state, bitsets of every state (states by words), bitsets of sequences with a residue at every site)"""
+
+    missing = np.isin(residues, np.frombuffer(MISSING, dtype = np.uint8))
+
+    sites = []
+    states = []
+    masks = []
+
+    for site in range(residues.shape[1]):
+        for residue in np.unique(residues[~missing[:, site], site]):
+            sites.append(site)
+            states.append(chr(residue))
+            masks.append(residues[:, site] == residue)
+
+    bits = pack_bits(np.array(masks, dtype = bool).reshape(len(masks), residues.shape[0]))
+    valid = pack_bits(~missing.T)
+
+    return np.array(sites, dtype = int), np.array(states), bits, valid
+
+
+def popcount(bits):
+    """Function to count the set bits of bitsets along the last axis"""
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bits).sum(axis = -1, dtype = np.int64)
+
+    return POPCOUNT[bits.view(np.uint8)].sum(axis = -1, dtype = np.int64)
+
+
+def count_cooccurrence(bits):
+    """Function to count the sequences sharing every pair of states, the popcount of their bitsets ANDed together;
+    rows of states are ANDed against every state a block at a time, to bound memory; returns a states by states matrix of counts"""
+
+    n_states, n_words = bits.shape
+    counts = np.zeros((n_states, n_states), dtype = np.int32)
+
+    block = max(1, BLOCK_WORDS // max(n_states * n_words, 1))
+    for start in range(0, n_states, block):
+        counts[start:start + block] = popcount(bits[start:start + block, None, :] & bits[None, :, :])
+
+    return counts
+
+
+def get_linkage(labels, sites, states, cooccurrence, valid, min_count=1):
+    """Function to get linkage of every pair of sites from co-occurrence counts, using the sequences with a residue at both sites;
+    returns (table of site_1, residue_1, site_2, residue_2, count, frequency, D, Dprime, r2 of every pair of residues of every pair of sites
+    shared by at least min_count sequences, r squared matrix and D' matrix between the most common residues of every pair of sites)"""
+
+    n_sites = len(labels)
+
+    # sequences with a residue at both sites of every pair
+    both = popcount(valid[:, None, :] & valid[None, :, :])
+
+    # for every state and site, sequences with the state that have a residue at the site (states of a site are next to each other)
+    site_starts = np.searchsorted(sites, np.arange(n_sites))
+    has_states = np.bincount(sites, minlength = n_sites) > 0
+    state_by_site = np.zeros((len(sites), n_sites), dtype = np.int64)
+    if len(sites):
+        state_by_site[:, has_states] = np.add.reduceat(cooccurrence, site_starts[has_states], axis = 1)
+
+    # most common state of every site
+    totals = np.diag(cooccurrence)
+    major = np.array([start + np.argmax(totals[sites == site]) if present else -1 for site, start, present in zip(range(n_sites), site_starts, has_states)], dtype = int)
+
+    # every pair of states at different sites shared by at least min_count sequences, and every pair of most common states
+    # (for the matrices, even if they never occur together), first site before second
+    is_major_state = np.zeros(len(sites), dtype = bool)
+    is_major_state[major[major >= 0]] = True
+    shared = cooccurrence >= max(min_count, 1)
+    first, second = np.nonzero((sites[:, None] < sites[None, :]) & (shared | (is_major_state[:, None] & is_major_state[None, :])))
+    n = both[sites[first], sites[second]].astype(float)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        p_ab = cooccurrence[first, second] / n
+        p_a = state_by_site[first, sites[second]] / n
+        p_b = state_by_site[second, sites[first]] / n
+
+        D = p_ab - p_a * p_b
+        D_max = np.where(D < 0, np.minimum(p_a * p_b, (1 - p_a) * (1 - p_b)), np.minimum(p_a * (1 - p_b), (1 - p_a) * p_b))
+        Dprime = np.where(D_max > 0, D / D_max, np.nan)
+        r2 = np.where(p_a * (1 - p_a) * p_b * (1 - p_b) > 0, D ** 2 / (p_a * (1 - p_a) * p_b * (1 - p_b)), np.nan)
+
+    # table of pairs shared by at least min_count sequences
+    keep = shared[first, second]
+    cooccurrence_df = pd.DataFrame({'site_1': np.array(labels, dtype = object)[sites[first][keep]], 'residue_1': states[first][keep],
+                                    'site_2': np.array(labels, dtype = object)[sites[second][keep]], 'residue_2': states[second][keep],
+                                    'count': cooccurrence[first, second][keep], 'frequency': p_ab[keep], 'D': D[keep], 'Dprime': Dprime[keep], 'r2': r2[keep]})
+
+    # matrices between most common states, symmetric with NaN on the diagonal
+    r2_matrix = np.full((n_sites, n_sites), np.nan)
+    Dprime_matrix = np.full((n_sites, n_sites), np.nan)
+    is_major = (major[sites[first]] == first) & (major[sites[second]] == second)
+    for i, j, r, d in zip(sites[first][is_major], sites[second][is_major], r2[is_major], Dprime[is_major]):
+        r2_matrix[i, j] = r2_matrix[j, i] = r
+        Dprime_matrix[i, j] = Dprime_matrix[j, i] = d
+
+    return (cooccurrence_df,
+            pd.DataFrame(r2_matrix, index = labels, columns = labels),
+            pd.DataFrame(Dprime_matrix, index = labels, columns = labels))
+
+
+def get_haplotype_frequencies(labels, sites, states, bits, valid, min_count=1):
+    """Function to get the frequency of every haplotype over all sites among sequences with a residue at every site;
+    haplotypes are built one site at a time, splitting the bitset of every haplotype so far by ANDing it with every state of the next site
+    and keeping those carried by at least min_count sequences; returns a table of haplotype, count and frequency, most common first"""
+
+    # sequences with a residue at every site
+    complete = np.bitwise_and.reduce(valid, axis = 0) if len(valid) else np.zeros(0, dtype = np.uint64)
+    total = popcount(complete)
+
+    names = ['']
+    haplotypes = complete[None, :]
+
+    for site, label in enumerate(labels):
+
+        site_states = np.flatnonzero(sites == site)
+
+        # every haplotype so far with every state of the site
+        split = haplotypes[:, None, :] & bits[site_states][None, :, :]
+        counts = popcount(split)
+        keep_haplotype, keep_state = np.nonzero(counts >= max(min_count, 1))
+
+        names = [f'{names[h]}_{label}{states[site_states[s]]}'.lstrip('_') for h, s in zip(keep_haplotype, keep_state)]
+        haplotypes = split[keep_haplotype, keep_state]
+
+    counts = popcount(haplotypes) if labels else np.zeros(0, dtype = np.int64)
+    if not labels:
+        names = []
+
+    haplotypes_df = pd.DataFrame({'haplotype': names, 'count': counts, 'frequency': counts / total if total else np.nan})
+
+    return haplotypes_df.sort_values(['count', 'haplotype'], ascending = [False, True], ignore_index = True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""Script that runs pipeline1 and pipeline2 on this machine in place of the UGE job scripts
+(VRC601_selection_analysis.job, VRC607_selection_analysis.job, mexico_selection_analysis.job, tables_and_heatmaps.job).
+Every stage is declared with the files it reads and writes; a stage runs as soon as the stages producing its inputs have finished,
+so the cohorts run side by side on a pool of workers. Finished stages are recorded in .manifest_pipelines.json,
+so after a failure a rerun resumes with the stages that did not finish (or whose inputs have changed since).
+
+Run with 'python3 run_pipelines.py -j [workers]', use '--tool mafft=[path]' to run a different executable (e.g. a stub) for a tool"""
+
+import os
+import sys
+import shutil
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f'{ROOT}/pipeline1/scripts')
+
+from catalog import open_catalog
+from file_utils import atomic_writer, strip_compression_suffix
+from manifest import Manifest
+
+
+# cohorts of pipeline1: how their alignments are named and which consensus script they use
+COHORTS = {'VRC601': {'alignment': '_rev2miss.aln', 'mexico': False},
+           'VRC607': {'alignment': '_rev2miss.aln', 'mexico': False},
+           'mexico': {'alignment': '.aln', 'mexico': True}}
+
+# executables run for each tool name, external tools can be swapped with --tool
+DEFAULT_TOOLS = {'python3': sys.executable, 'mafft': 'mafft', 'Rscript': 'Rscript'}
+
+# tools that run outside of Python, limited by --tool-jobs
+EXTERNAL_TOOLS = ['mafft', 'Rscript']
+
+
+class Task:
+    """One stage of a pipeline: either a command (run from cwd, first word is a tool name) or a Python function,
+    with the files it reads and writes (paths relative to cwd)"""
+
+    def __init__(self, name, cwd, inputs, outputs, command=None, function=None, stdout=None):
+        self.name = name
+        self.cwd = cwd
+        self.inputs = [f'{cwd}/{f}' for f in inputs]
+        self.outputs = [f'{cwd}/{f}' for f in outputs]
+        self.command = command
+        self.function = function
+        self.stdout = f'{cwd}/{stdout}' if stdout else None
+
+    def params(self):
+        """Parameters recorded in the manifest, a stage reruns if they change"""
+
+        return {'command': self.command or [self.function[0].__name__] + [str(a) for a in self.function[1]]}
+
+
+class ToolRunner:
+    """Runs commands as subprocesses, with a bounded number of external tools (MAFFT, Rscript) running at once"""
+
+    def __init__(self, paths, tool_jobs):
+        self.paths = paths
+        self.limits = {tool: threading.Semaphore(tool_jobs) for tool in EXTERNAL_TOOLS}
+
+    def run(self, command, cwd, stdout=None):
+        """Runs command from cwd, writing its standard output to stdout (replaced only if the command succeeds)"""
+
+        tool = command[0]
+        argv = [self.paths.get(tool, tool)] + command[1:]
+        limit = self.limits.get(tool)
+
+        if limit:
+            limit.acquire()
+        try:
+            if stdout:
+                with atomic_writer(stdout) as outfile:
+                    subprocess.run(argv, cwd = cwd, stdout = outfile, check = True)
+            else:
+                subprocess.run(argv, cwd = cwd, check = True)
+        finally:
+            if limit:
+                limit.release()
+
+
+def main():
+    # get command line arguments
+    args = get_args()
+
+    # executables for each tool
+    tools = dict(DEFAULT_TOOLS)
+    for tool in args.tools:
+        name, path = tool.split('=', 1)
+        tools[name] = path
+
+    # cohorts without a data directory have nothing to run
+    cohorts = [cohort for cohort in args.cohorts if os.path.isdir(f'{args.root}/pipeline1/data/{cohort}')]
+    for cohort in set(args.cohorts) - set(cohorts):
+        print(f'Skipping {cohort}, no pipeline1/data/{cohort} directory')
+
+    # declare every stage
+    tasks = []
+    for cohort in cohorts:
+        tasks += get_pipeline1_tasks(args.root, cohort, args.stage_jobs, args.screen)
+    if not args.skip_pipeline2:
+        tasks += get_pipeline2_tasks(args.root, cohorts, args.stage_jobs, args.tajimas_d, args.screen)
+
+    # load record of stages already finished
+    manifest = Manifest(args.root, 'pipelines', force = args.force)
+
+    if args.dry_run:
+        for task in tasks:
+            print(task.name, ' '.join(task.command) if task.command else task.function[0].__name__)
+        return
+
+    failed = run_tasks(tasks, manifest, ToolRunner(tools, args.tool_jobs), args.jobs)
+
+    if failed:
+        sys.exit(f'Failed stages: {", ".join(failed)} (rerun to resume)')
+
+    print('All done!')
+
+
+def get_args():
+    """Get command line arguments"""
+    parser = argparse.ArgumentParser(description='Run pipeline1 and pipeline2 locally, resuming after the last finished stage')
+
+    parser.add_argument('-j', '--jobs', type = int, dest = 'jobs', default = 1, help = 'Number of stages to run at once')
+
+    parser.add_argument('--stage-jobs', type = int, dest = 'stage_jobs', default = 1, help = 'Number of processes each stage that processes participants in parallel may use (up to jobs x stage-jobs processes in total)')
+
+    parser.add_argument('--tool-jobs', type = int, dest = 'tool_jobs', default = 1, help = 'Number of each external tool (MAFFT, Rscript) to run at once')
+
+    parser.add_argument('--tool', action = 'append', dest = 'tools', default = [], metavar = 'NAME=PATH', help = 'Executable to run for a tool (python3, mafft, Rscript), can be given more than once')
+
+    parser.add_argument('-c', '--cohorts', nargs = '+', dest = 'cohorts', default = list(COHORTS), choices = list(COHORTS), help = 'Cohorts to run pipeline1 on')
+
+    parser.add_argument('--skip-pipeline2', action = 'store_true', dest = 'skip_pipeline2', help = 'Only run pipeline1')
+
+    parser.add_argument('--tajimas-d', action = 'store_true', dest = 'tajimas_d', help = "Compute Tajima's D from the cohort alignments instead of reading the DnaSP workbooks")
+
+    parser.add_argument('--screen', action = 'store_true', dest = 'screen', help = 'Also run the Nei-Gojobori dN/dS screen of every alignment and make its tables in pipeline2/results/screen')
+
+    parser.add_argument('-r', '--root', type = str, dest = 'root', default = ROOT, help = 'Directory holding pipeline1 and pipeline2')
+
+    parser.add_argument('-n', '--dry-run', action = 'store_true', dest = 'dry_run', help = 'List the stages without running them')
+
+    parser.add_argument('-f', '--force', action = 'store_true', dest = 'force', help = 'Run every stage, even if it finished before and its inputs have not changed')
+
+    args = parser.parse_args()
+    return args
+
+
+def get_pipeline1_tasks(root, cohort, stage_jobs, screen=False):
+    """Declares the stages of pipeline1 for one cohort (what each cohort's .job script runs); with screen,
+    the counting-method dN/dS screen (screen_dnds.py) is run on the alignments and its site tables are gathered as well"""
+
+    cwd = f'{root}/pipeline1'
+    data = f'data/{cohort}'
+    results = f'results/{cohort}'
+    alignment = COHORTS[cohort]['alignment']
+
+    # input files present before the pipeline runs
+    catalog = open_catalog(f'{cwd}/{data}')
+    fubar_files = [f'{data}/{f}' for f in catalog.list_files('.json')]
+    aln_files = [f'{data}/{f}' for f in catalog.list_files(alignment)]
+
+    # participant IDs, as the consensus scripts get them from the alignment file names
+    if COHORTS[cohort]['mexico']:
+        ids = [os.path.basename(f).split('.')[0] for f in aln_files]
+    else:
+        ids = [os.path.basename(strip_compression_suffix(f)).replace(alignment, '') for f in aln_files]
+
+    consensus = f'{data}/{cohort}_consensus_seqs.fa'
+    consensus_hxb2 = f'{data}/{cohort}_consensus_seqs_hxb2.fa'
+    hxb2_aln = f'{results}/{cohort}_hxb2_aln.fa'
+    simple_files = [strip_compression_suffix(f).replace('.json', '_simple.txt') for f in fubar_files]
+    annotation_files = [f'{results}/{id}_consensus_annotations.csv' for id in ids]
+    screen_files = [f'{data}/{os.path.basename(strip_compression_suffix(f))}.NG_simple.txt' for f in aln_files]
+
+    if COHORTS[cohort]['mexico']:
+        consensus_command = ['python3', 'scripts/create_aa_consensus_mexico.py', '--codon', '-o', os.path.basename(consensus), '-d', data, '-j', str(stage_jobs)]
+    else:
+        consensus_command = ['python3', 'scripts/create_aa_consensus.py', '--nucleotide', '--no-alignment-consensus', '-o', os.path.basename(consensus), '-d', data, '-j', str(stage_jobs)]
+
+    tasks = [
+        Task(f'{cohort}:simplify_fubar', cwd, fubar_files, simple_files,
+             command = ['python3', 'scripts/simplify_fubar_data.py', '-d', data, '-j', str(stage_jobs)]),
+        Task(f'{cohort}:consensus', cwd, aln_files, [consensus],
+             command = consensus_command),
+        Task(f'{cohort}:add_hxb2', cwd, [consensus, 'data/hxb2_aa.fa'], [consensus_hxb2],
+             function = (concatenate_files, [f'{cwd}/{consensus_hxb2}', f'{cwd}/{consensus}', f'{cwd}/data/hxb2_aa.fa'])),
+        Task(f'{cohort}:mafft', cwd, [consensus_hxb2], [hxb2_aln],
+             command = ['mafft', consensus_hxb2], stdout = hxb2_aln),
+        Task(f'{cohort}:position_mappings', cwd, [consensus, hxb2_aln], [f'{results}/{id}_position_mappings.csv' for id in ids],
+             command = ['python3', 'scripts/get_position_mappings.py', '-c', consensus, '-a', hxb2_aln, '-d', f'{results}/']),
+        Task(f'{cohort}:annotation', cwd, [f'{results}/{id}_position_mappings.csv' for id in ids] + ['data/Env_features[8422].xlsx'], annotation_files,
+             command = ['Rscript', 'scripts/get_annotation_for_consensus.R', '--args', 'data/', f'{results}/']),
+        Task(f'{cohort}:gather', cwd, simple_files + annotation_files, [f'../pipeline2/data/{os.path.basename(f)}' for f in simple_files + annotation_files],
+             function = (copy_files, [[f'{cwd}/{f}' for f in simple_files + annotation_files], f'{root}/pipeline2/data'])),
+    ]
+
+    if screen:
+        tasks += [
+            Task(f'{cohort}:screen_dnds', cwd, aln_files, screen_files,
+                 command = ['python3', 'scripts/screen_dnds.py', '-d', data, '-s', alignment, '-j', str(stage_jobs)]),
+            Task(f'{cohort}:gather_screen', cwd, screen_files, [f'../pipeline2/data/{os.path.basename(f)}' for f in screen_files],
+                 function = (copy_files, [[f'{cwd}/{f}' for f in screen_files], f'{root}/pipeline2/data'])),
+        ]
+
+    return tasks
+
+
+def get_pipeline2_tasks(root, cohorts, stage_jobs, tajimas_d=False, screen=False):
+    """Declares the stages of pipeline2 (what tables_and_heatmaps.job runs), reading the files gathered from the pipeline1 cohorts;
+    with tajimas_d, significant midpoints are computed from the cohort alignments rather than read from the DnaSP workbooks;
+    with screen, tables of the counting-method screen are made as well, in results/screen"""
+
+    cwd = f'{root}/pipeline2'
+
+    # files gathered from pipeline1
+    pipeline1 = {task.name: task for cohort in cohorts for task in get_pipeline1_tasks(root, cohort, 1, screen)}
+    gathered = [f'data/{os.path.basename(f)}' for cohort in cohorts for f in pipeline1[f'{cohort}:gather'].outputs]
+
+    tables = ['results/tables/pos_selection_sites_dNdS.csv', 'results/tables/pos_selection_sites_probability.csv']
+
+    if tajimas_d:
+        # nucleotide alignments of every cohort
+        data = [f'../pipeline1/data/{cohort}' for cohort in cohorts]
+        aln_files = [f'{d}/{f}' for d, cohort in zip(data, cohorts) for f in open_catalog(f'{cwd}/{d}').list_files(COHORTS[cohort]['alignment'])]
+        midpoints = Task('tables:midpoints', cwd, aln_files, ['results/sig_midpoints.json'],
+                         command = ['python3', 'scripts/compute_tajimas_d.py', '-d'] + data + ['-j', str(stage_jobs)])
+    else:
+        workbooks = ['data/VRC601_TajimasD_1.xlsx', 'data/TajimasD.xlsx', 'data/mexico_TajimasD.xlsx']
+        midpoints = Task('tables:midpoints', cwd, workbooks, ['results/sig_midpoints.json'],
+                         command = ['Rscript', 'scripts/get_significant_midpoints.R'])
+
+    tasks = [
+        midpoints,
+        Task('tables:tables', cwd, gathered + ['results/sig_midpoints.json'], tables + ['results/selection_store/meta.json'],
+             command = ['python3', 'scripts/create_dNdS_tables.py', '-j', str(stage_jobs)]),
+        Task('tables:heatmaps', cwd, tables, ['results/plots/env_gene_heatmap.png'],
+             command = ['Rscript', 'scripts/make_dNdS_heatmaps.R']),
+    ]
+
+    if screen:
+        # the screen's site tables, with the annotation files gathered for the FUBAR tables
+        gathered_screen = [f'data/{os.path.basename(f)}' for cohort in cohorts for f in pipeline1[f'{cohort}:gather_screen'].outputs]
+        annotations = [f for f in gathered if f.endswith('_consensus_annotations.csv')]
+        tasks.append(Task('tables:screen', cwd, gathered_screen + annotations + ['results/sig_midpoints.json'],
+                          ['results/screen/tables/pos_selection_sites_dNdS.csv', 'results/screen/selection_store/meta.json'],
+                          command = ['python3', 'scripts/create_dNdS_tables.py', '--screen', '-j', str(stage_jobs)]))
+
+    return tasks
+
+
+def get_dependencies(tasks):
+    """Returns {task name: set of names of the tasks writing its inputs}"""
+
+    producers = {os.path.normpath(f): task.name for task in tasks for f in task.outputs}
+
+    return {task.name: {producers[os.path.normpath(f)] for f in task.inputs if os.path.normpath(f) in producers} - {task.name} for task in tasks}
+
+
+def run_tasks(tasks, manifest, runner, jobs):
+    """Runs tasks on a pool of jobs workers, each as soon as the tasks it depends on have finished; tasks whose inputs,
+    parameters and outputs match the manifest are skipped; returns the names of tasks that failed or could not run"""
+
+    dependencies = get_dependencies(tasks)
+    pending = list(tasks)
+    running = {}
+    done = set()
+    failed = []
+
+    with ThreadPoolExecutor(max_workers = jobs) as executor:
+
+        while pending or running:
+
+            # start every task whose dependencies are done
+            started = len(pending)
+            for task in list(pending):
+                if dependencies[task.name] & set(failed):
+                    print(f'Skipping {task.name}, it depends on a failed stage')
+                    failed.append(task.name)
+                    pending.remove(task)
+                elif dependencies[task.name] <= done:
+                    pending.remove(task)
+                    missing = [f for f in task.inputs if not os.path.exists(f)]
+                    if missing:
+                        print(f'Cannot run {task.name}, missing {", ".join(missing)}')
+                        failed.append(task.name)
+                    elif manifest.is_current(task.name, task.inputs, task.params(), task.outputs):
+                        print(f'Skipping {task.name}, already done')
+                        done.add(task.name)
+                    else:
+                        print(f'Running {task.name}')
+                        running[executor.submit(run_task, task, runner)] = task
+
+            if not running:
+                # nothing running and nothing could start: the tasks left wait on each other (a dependency cycle)
+                if pending and len(pending) == started:
+                    for task in pending:
+                        print(f'Cannot run {task.name}, it waits on {", ".join(sorted(dependencies[task.name] - done))}')
+                        failed.append(task.name)
+                    break
+                continue
+
+            # wait for a task to finish, record it so a rerun can resume after it
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    print(f'{task.name} failed: {error}')
+                    failed.append(task.name)
+                else:
+                    done.add(task.name)
+                    manifest.record(task.name, task.inputs, task.params(), task.outputs)
+                    manifest.save()
+
+    return failed
+
+
+def run_task(task, runner):
+    """Runs one task, creating the directories of its outputs first"""
+
+    for f in task.outputs + ([task.stdout] if task.stdout else []):
+        os.makedirs(os.path.dirname(f), exist_ok = True)
+
+    if task.function:
+        function, args = task.function
+        function(*args)
+    else:
+        runner.run(task.command, task.cwd, task.stdout)
+
+    # a stage that succeeds without writing what it declares would break the stages after it
+    missing = [f for f in task.outputs if not os.path.exists(f)]
+    if missing:
+        raise RuntimeError(f'did not write {", ".join(missing)}')
+
+
+def concatenate_files(outfile, *infiles):
+    """Writes the contents of infiles one after the other to outfile, starting each file on a new line"""
+
+    with atomic_writer(outfile, 'wb') as out:
+        for f in infiles:
+            # the consensus files do not end with a newline, keep the next header on its own line
+            if out.tell() and not last.endswith(b'\n'):
+                out.write(b'\n')
+            with open(f, 'rb') as infile:
+                shutil.copyfileobj(infile, out)
+                infile.seek(max(infile.tell() - 1, 0))
+                last = infile.read()
+
+
+def copy_files(files, directory):
+    """Copies files into directory"""
+
+    for f in files:
+        with open(f, 'rb') as infile, atomic_writer(f'{directory}/{os.path.basename(f)}', 'wb') as out:
+            shutil.copyfileobj(infile, out)
+
+
+if __name__ == "__main__":
+    main()
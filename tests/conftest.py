@@ -0,0 +1,9 @@
+"""Puts the script directories of every pipeline on the import path, as the scripts import each other by module name"""
+
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+for directory in [ROOT, 'pipeline1/scripts', 'pipeline2/scripts', 'pipeline3/scripts', 'WEBPSSM_521.522_haplotypes/scripts']:
+    sys.path.append(os.path.normpath(os.path.join(ROOT, directory)))
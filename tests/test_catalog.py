@@ -0,0 +1,105 @@
+"""Tests of the file catalog and participant IDs of catalog.py"""
+
+import os
+import pytest
+from catalog import Catalog, get_alignment_id, open_catalog
+
+
+@pytest.mark.parametrize('filename, id', [('520_1_rev2miss.aln.translated', '520_1'),
+                                          ('data/VRC601/520_1_rev2miss.aln.translated.gz', '520_1'),
+                                          ('cell2_bc10xx.aln.translated', 'cell2_bc10xx'),
+                                          ('P1_rev2miss.aln', 'P1'),
+                                          ('MX01.v3.aln', 'MX01'),
+                                          ('P1.fa', 'P1')])
+def test_alignment_id(filename, id):
+    """Participant IDs keep underscores and only lose the known alignment suffixes"""
+
+    assert get_alignment_id(filename) == id
+
+
+def make_cohort(tmp_path):
+    """Cohort directory with the files of two participants, one of them in a subdirectory"""
+
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'P1_rev2miss.aln').write_text('>s1\nATG\n')
+    (tmp_path / 'P1_rev2miss.aln.FUBAR.json').write_text('{}')
+    (tmp_path / 'sub' / 'P2_1_consensus_annotations.csv').write_text('x\n')
+    (tmp_path / '.manifest_stage.json').write_text('{}')
+
+    return str(tmp_path)
+
+
+def test_files_sorted_into_roles(tmp_path):
+    """Files are listed by suffix and sorted into participant roles, hidden files are left out"""
+
+    catalog = open_catalog(make_cohort(tmp_path))
+
+    assert catalog.list_files('.aln') == ['P1_rev2miss.aln']
+    assert catalog.list_files('.json') == ['P1_rev2miss.aln.FUBAR.json']
+    assert catalog.ids('annotation') == ['P2_1']
+    assert catalog.find('fubar_json', 'P1') == f'{tmp_path}/P1_rev2miss.aln.FUBAR.json'
+    assert catalog.find('alignment', 'P2_1') is None
+
+
+def test_catalog_sees_added_and_edited_files(tmp_path):
+    """A reloaded catalog lists added files and the new size of files appended to in place"""
+
+    root = make_cohort(tmp_path)
+    open_catalog(root)
+
+    # appending does not change the directory's modification time
+    directory_mtime = os.stat(tmp_path / 'sub').st_mtime_ns
+    with open(tmp_path / 'sub' / 'P2_1_consensus_annotations.csv', 'a') as outfile:
+        outfile.write('more\n')
+    os.utime(tmp_path / 'sub', ns = (directory_mtime, directory_mtime))
+
+    (tmp_path / 'P3_rev2miss.aln').write_text('>s1\nATG\n')
+
+    catalog = Catalog(root)
+
+    assert catalog.file_info('sub/P2_1_consensus_annotations.csv')[0] == len('x\nmore\n')
+    assert catalog.ids('alignment') == ['P1', 'P3']
+
+
+def test_catalog_forgets_removed_files(tmp_path):
+    """Removed files leave the catalog even if their directory looks unchanged"""
+
+    root = make_cohort(tmp_path)
+    open_catalog(root)
+
+    directory_mtime = os.stat(tmp_path / 'sub').st_mtime_ns
+    (tmp_path / 'sub' / 'P2_1_consensus_annotations.csv').unlink()
+    os.utime(tmp_path / 'sub', ns = (directory_mtime, directory_mtime))
+
+    assert Catalog(root).ids('annotation') == []
+
+
+def test_ambiguous_participants_are_reported(tmp_path, capsys):
+    """Several files for one role of a participant are reported, the first one is used"""
+
+    root = make_cohort(tmp_path)
+    (tmp_path / 'P1.v2.aln').write_text('>s1\nATG\n')
+
+    catalog = open_catalog(root)
+
+    assert catalog.find('alignment', 'P1') == f'{root}/P1.v2.aln'
+    assert 'Warning: 2 alignment files match P1' in capsys.readouterr().err
+
+
+def test_compressed_files_and_saved_catalog(tmp_path):
+    """Compressed files match their uncompressed suffix and role, and the saved catalog reloads the same files"""
+
+    root = make_cohort(tmp_path)
+    (tmp_path / 'P4_rev2miss.aln.gz').write_bytes(b'')
+
+    catalog = open_catalog(root)
+
+    assert catalog.list_files('.aln') == ['P1_rev2miss.aln', 'P4_rev2miss.aln.gz']
+    assert catalog.ids('alignment') == ['P1', 'P4']
+    assert catalog.ambiguous() == []
+    assert not [name for name in os.listdir(root) if name.startswith('.catalog.json') and name != '.catalog.json']
+
+    reloaded = Catalog(root)
+
+    assert reloaded.participants == catalog.participants
+    assert reloaded.list_files(directory = 'sub') == catalog.list_files(directory = 'sub')
@@ -0,0 +1,84 @@
+"""Tests of the Hamming distance clustering of cluster_subpopulations.py"""
+
+import numpy as np
+import pytest
+from cluster_subpopulations import cluster_sequences, get_consensus, get_distances, pick_centers
+
+
+def make_subpopulations(rng, sizes, length=200, divergence=0.3, noise=0.01):
+    """Sequences from subpopulations of the given sizes, each a noisy copy of its own ancestor; returns (residues, true labels)"""
+
+    alphabet = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype = np.uint8)
+    root = rng.choice(alphabet, size = length)
+
+    residues = []
+    for size in sizes:
+        ancestor = np.where(rng.random(length) < divergence, rng.choice(alphabet, size = length), root)
+        copies = np.tile(ancestor, (size, 1))
+        mutated = rng.random(copies.shape) < noise
+        copies[mutated] = rng.choice(alphabet, size = mutated.sum())
+        residues.append(copies)
+
+    return np.concatenate(residues), np.repeat(np.arange(len(sizes)), sizes)
+
+
+def test_distances_skip_missing_columns():
+    """Distance is the fraction of columns with a residue in both sequences that differ"""
+
+    residues = np.frombuffer(b'AAAA' b'AB-C' b'----', dtype = np.uint8).reshape(3, 4)
+
+    np.testing.assert_allclose(get_distances(residues, residues[:1]), [[0], [2 / 3], [0]])
+    np.testing.assert_allclose(get_distances(residues, residues[1:2])[:, 0], [2 / 3, 0, 0])
+
+
+def test_consensus_is_weighted_and_gaps_empty_columns():
+    """The consensus takes the most common residue by weight, and a gap where no sequence of the cluster has a residue"""
+
+    residues = np.frombuffer(b'AC-' b'DC-' b'DE-', dtype = np.uint8).reshape(3, 3)
+
+    consensus = get_consensus(residues, np.array([5, 1, 1]), np.zeros(3, dtype = int), 1)
+
+    assert consensus.tobytes() == b'AC-'
+
+
+def test_clusters_recover_subpopulations():
+    """Clusters are the subpopulations the sequences came from, whichever way the clusters are numbered"""
+
+    rng = np.random.default_rng(0)
+    residues, truth = make_subpopulations(rng, [300, 150, 60, 20])
+
+    unique, inverse, weights = np.unique(residues, axis = 0, return_inverse = True, return_counts = True)
+    labels, centers, distances = cluster_sequences(unique, weights, radius = 0.1)
+    labels = labels[inverse.ravel()]
+
+    assert len(centers) == 4
+    pairs = set(zip(truth.tolist(), labels.tolist()))
+    assert len(pairs) == 4
+
+
+def test_given_number_of_clusters():
+    """With -k, exactly that many centers are picked, the first the most common sequence"""
+
+    rng = np.random.default_rng(1)
+    residues, truth = make_subpopulations(rng, [50, 50, 50])
+    weights = np.ones(len(residues), dtype = int)
+    weights[7] = 10
+
+    centers = pick_centers(residues, weights, clusters = 2)
+
+    assert len(centers) == 2 and centers[0] == 7
+    assert len(cluster_sequences(residues, weights, clusters = 2)[1]) == 2
+
+
+def test_small_clusters_are_dissolved():
+    """An outlier sequence does not keep a cluster of its own below min_size"""
+
+    rng = np.random.default_rng(2)
+    residues, truth = make_subpopulations(rng, [100, 1])
+    weights = np.ones(len(residues), dtype = int)
+
+    assert len(cluster_sequences(residues, weights, radius = 0.1, min_size = 1)[1]) == 2
+    labels, centers, distances = cluster_sequences(residues, weights, radius = 0.1, min_size = 2)
+
+    assert len(centers) == 1 and (labels == 0).all()
+    assert distances[-1] == pytest.approx(get_distances(residues[-1:], centers)[0, 0])
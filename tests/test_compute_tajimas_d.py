@@ -0,0 +1,74 @@
+"""Tests of the sliding-window Tajima's D of compute_tajimas_d.py"""
+
+import itertools
+import numpy as np
+from compute_tajimas_d import BASE_LOOKUP, compute_windows, get_sig_midpoints
+
+
+def brute_force_d(sequences):
+    """Tajima's D of aligned sequences without missing bases, counted pair by pair from the textbook formulas"""
+
+    n = len(sequences)
+    S = sum(len(set(column)) > 1 for column in zip(*sequences))
+    pairs = list(itertools.combinations(sequences, 2))
+    pi = sum(sum(a != b for a, b in zip(first, second)) for first, second in pairs) / len(pairs)
+
+    a1 = sum(1 / i for i in range(1, n))
+    a2 = sum(1 / i ** 2 for i in range(1, n))
+    b1 = (n + 1) / (3 * (n - 1))
+    b2 = 2 * (n ** 2 + n + 3) / (9 * n * (n - 1))
+    c1 = b1 - 1 / a1
+    c2 = b2 - (n + 2) / (a1 * n) + a2 / a1 ** 2
+    e1 = c1 / a1
+    e2 = c2 / (a1 ** 2 + a2)
+
+    return (pi - S / a1) / np.sqrt(e1 * S + e2 * S * (S - 1))
+
+
+def to_bases(sequences):
+    return np.array([BASE_LOOKUP[np.frombuffer(sequence.encode(), dtype = np.uint8)] for sequence in sequences])
+
+
+def test_windows_match_brute_force_over_kept_sites():
+    """Windows hold `window` columns without gaps, D matches the pairwise count over those columns"""
+
+    rng = np.random.default_rng(1)
+    sequences = [''.join(rng.choice(list('ACGT'), p = [0.7, 0.1, 0.1, 0.1], size = 60)) for _ in range(7)]
+    # gaps and an ambiguous base in a few columns of single sequences
+    sequences[2] = sequences[2][:10] + '---' + sequences[2][13:]
+    sequences[5] = sequences[5][:40] + 'N' + sequences[5][41:]
+    missing = {10, 11, 12, 40}
+    kept = [column for column in range(60) if column not in missing]
+
+    windows = compute_windows(to_bases(sequences), window = 20, step = 5)
+
+    assert len(windows) == (len(kept) - 20) // 5 + 1
+    assert (windows['sites'] == 20).all()
+
+    for row, first in zip(windows.itertuples(), range(0, len(kept), 5)):
+        columns = kept[first:first + 20]
+        assert (row.start, row.stop) == (columns[0] + 1, columns[-1] + 1)
+        assert row.midpoint == (columns[0] + columns[-1] + 2) // 2
+
+        expected = brute_force_d([''.join(sequence[column] for column in columns) for sequence in sequences])
+        assert np.isclose(row.D, expected, equal_nan = True)
+
+
+def test_windows_without_segregating_sites_and_short_alignments():
+    """D is NaN without segregating sites, and an alignment with fewer kept sites than a window has no windows"""
+
+    windows = compute_windows(to_bases(['ACGTACGT'] * 4), window = 4, step = 2)
+
+    assert list(windows['start']) == [1, 3, 5]
+    assert windows['D'].isna().all()
+    assert compute_windows(to_bases(['ACG-T', 'ACGTT', 'ACGTA']), window = 5, step = 1).empty
+
+
+def test_sig_midpoints():
+    """Midpoints of windows at or above the threshold, with an empty list for participants without any"""
+
+    windows = compute_windows(to_bases(['ACGTACGT'] * 4), window = 4, step = 2)
+    windows.insert(0, 'id', 'P1')
+    windows['D'] = [1.5, 0.2, 2.0]
+
+    assert get_sig_midpoints(windows, ['P1', 'P2'], threshold = 1.5) == {'P1': [2, 6], 'P2': []}
@@ -0,0 +1,42 @@
+"""Tests of the vectorized amino acid consensus of create_aa_consensus.py against the original count matrix"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from create_aa_consensus import AMINO_ACIDS, get_consensus, get_counts_matrix, get_counts_matrix_from_chunks
+
+
+def baseline_consensus(sequences):
+    """Consensus of the original create_aa_consensus.py: count matrix filled one character at a time,
+    every amino acid with the highest count joined in sorted order"""
+
+    counts = pd.DataFrame(np.zeros([22, len(sequences[0])], dtype = int), index = AMINO_ACIDS)
+    for seq in sequences:
+        for ind, aa in enumerate(seq):
+            counts.at[aa, ind] += 1
+
+    most_common = counts[counts == counts.max(axis=0)]
+
+    return ''.join(most_common.apply(lambda pos: ''.join(sorted(pos.dropna().index)), axis=0))
+
+
+@pytest.mark.parametrize('alphabet', ['ak-', 'acdefghiklmnpqrstvwyx-'])
+def test_consensus_matches_baseline(alphabet):
+    """The vectorized consensus, in one batch or in chunks, is the same string as the original's, ties included"""
+
+    rng = np.random.default_rng(1)
+
+    # few sequences over few amino acids, so many positions are tied
+    sequences = [''.join(rng.choice(list(alphabet), size = 200)) for _ in range(6)]
+
+    expected = baseline_consensus(sequences)
+
+    assert ''.join(get_consensus(get_counts_matrix(sequences))) == expected
+    assert ''.join(get_consensus(get_counts_matrix_from_chunks([sequences[:4], sequences[4:]], 'test'))) == expected
+
+
+def test_unexpected_character_is_an_error():
+    """Characters that are not amino acid options are reported"""
+
+    with pytest.raises(ValueError, match = 'Unexpected characters'):
+        get_counts_matrix(['ak-', 'a*-'])
@@ -0,0 +1,43 @@
+"""Tests of the codon consensus of create_aa_consensus_mexico.py against get_consensus_by_codon_mexico.pl"""
+
+import os
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from conftest import ROOT
+from create_aa_consensus_mexico import get_codon_consensus_from_file, pack_codons, unpack_codon
+
+
+def test_codon_consensus_matches_perl(tmp_path):
+    """The codon consensus of create_aa_consensus_mexico.py --codon is the same as get_consensus_by_codon_mexico.pl writes,
+    ties and mixed case included"""
+
+    if shutil.which('perl') is None:
+        pytest.skip('perl is not installed')
+
+    rng = np.random.default_rng(2)
+    codons = ['ATG', 'ATA', 'atg', 'GCT', 'GCC', '---']
+
+    # few sequences over few codons so many positions are tied, the last one shorter
+    sequences = [''.join(rng.choice(codons, size = 120)) for _ in range(7)]
+    sequences[-1] = sequences[-1][:150]
+
+    aln_file = tmp_path / 'P1.aln'
+    aln_file.write_text(''.join(f'>seq{i}\n{seq}\n' for i, seq in enumerate(sequences)))
+
+    subprocess.run(['perl', os.path.join(ROOT, 'pipeline1', 'scripts', 'get_consensus_by_codon_mexico.pl'), str(aln_file)],
+                   check = True, capture_output = True)
+    expected = (tmp_path / 'P1.aln.consensus').read_text().splitlines()[1]
+
+    assert ''.join(get_codon_consensus_from_file(str(aln_file), chunk_size = 3)) == expected
+
+
+def test_packed_codons_sort_like_codons():
+    """Packed codons are in the same order as the codons, and unpack to the same characters"""
+
+    codons = ['---', 'AAA', 'ATG', 'aTg', 'TA']
+    packed = pack_codons([''.join(codons)])[0]
+
+    assert [unpack_codon(c) for c in packed] == codons
+    assert np.argsort(packed, kind = 'stable').tolist() == sorted(range(len(codons)), key = lambda i: codons[i])
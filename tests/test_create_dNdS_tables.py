@@ -0,0 +1,123 @@
+"""Tests of the vectorized HXB2 liftover and selection tables of create_dNdS_tables.py against the original site-by-site lookup"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from create_dNdS_tables import get_participant_selection, liftover_sites, pivot_selection_data, SELECTION_VALUES
+
+
+def make_consensus_annotations(rng, length):
+    """Random consensus annotations (index from 0, as read from csv), with gaps in every position column;
+    the original consensus starts with a real codon, which the original lookup needs"""
+
+    def positions(mask):
+        numbers = np.cumsum(mask).astype(float)
+        numbers[~mask] = np.nan
+        return numbers
+
+    hxb2 = rng.random(length) < 0.8
+    aligned = rng.random(length) < 0.9
+    aligned[0] = True
+    original = aligned & (rng.random(length) < 0.9)
+    original[0] = True
+
+    # gaps at both ends of HXB2
+    hxb2[:3] = False
+    hxb2[-3:] = False
+
+    return pd.DataFrame({'HXB2.Position': positions(hxb2),
+                         'Consensus.Aligned.to.HXB2.Position': positions(aligned),
+                         'Original.Consensus.Position': np.where(original, positions(aligned), np.nan)})
+
+
+def baseline_liftover(site, consensus_annotations):
+    """HXB2 position of one site with the original get_site_index and get_hxb2_position (index from 1)"""
+
+    og_consensus_pos = consensus_annotations.at[site, 'Original.Consensus.Position']
+
+    if np.isnan(og_consensus_pos):
+        lower = consensus_annotations.loc[:site, 'Original.Consensus.Position'].last_valid_index()
+        upper = consensus_annotations.loc[site:, 'Original.Consensus.Position'].first_valid_index()
+        if upper is None:
+            og_consensus_decimal = 0.5
+        else:
+            og_consensus_decimal = ((upper - lower) - (upper - site)) / (upper - lower)
+        og_consensus_pos = consensus_annotations.at[lower, 'Original.Consensus.Position']
+    else:
+        og_consensus_decimal = 0
+
+    site_index = consensus_annotations.index[consensus_annotations['Consensus.Aligned.to.HXB2.Position'] == og_consensus_pos][0]
+
+    hxb2_pos = consensus_annotations.at[site_index, 'HXB2.Position']
+    if not np.isnan(hxb2_pos):
+        return hxb2_pos + og_consensus_decimal
+
+    lower = consensus_annotations.loc[:site_index, 'HXB2.Position'].last_valid_index()
+    upper = consensus_annotations.loc[site_index:, 'HXB2.Position'].first_valid_index()
+    if lower is None:
+        return consensus_annotations.at[upper, 'HXB2.Position'] - 0.5
+    if upper is None:
+        return consensus_annotations.at[lower, 'HXB2.Position'] + 0.5
+
+    return consensus_annotations.at[lower, 'HXB2.Position'] + ((upper - lower) - (upper - site_index)) / (upper - lower)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_liftover_matches_baseline(seed):
+    """Every site lifts over to the same HXB2 position as with the original site-by-site lookup"""
+
+    rng = np.random.default_rng(seed)
+    consensus_annotations = make_consensus_annotations(rng, int(rng.integers(50, 300)))
+    consensus_annotations.index = consensus_annotations.index + 1
+
+    sites = consensus_annotations.index.to_numpy()
+    expected = [baseline_liftover(site, consensus_annotations) for site in sites]
+
+    np.testing.assert_array_equal(liftover_sites(sites, consensus_annotations), expected)
+
+
+def test_selection_tables_match_baseline():
+    """Tables pivoted from the long table of every participant are the same as the original tables filled one site at a time"""
+
+    rng = np.random.default_rng(5)
+    ids = ['P1', 'P2', 'P3']
+
+    selection_data = []
+    expected = pd.DataFrame(columns = ids)
+
+    for id in ids:
+        consensus_annotations = make_consensus_annotations(rng, int(rng.integers(50, 200)))
+        fubar_data = pd.DataFrame({'site': np.arange(1, len(consensus_annotations) + 1)})
+        for value in SELECTION_VALUES:
+            fubar_data[value] = rng.random(len(fubar_data))
+
+        selection_data.append(get_participant_selection(id, consensus_annotations, fubar_data))
+
+        # original fill_selection_df, later sites at the same HXB2 position overwrite earlier ones
+        consensus_annotations.index = consensus_annotations.index + 1
+        for site, value in zip(fubar_data['site'], fubar_data['P(dS<dN)']):
+            expected.at[baseline_liftover(site, consensus_annotations), id] = value
+
+    table = pivot_selection_data(pd.concat(selection_data, ignore_index = True), ids, value = 'P(dS<dN)')
+
+    pd.testing.assert_frame_equal(table, expected.sort_index().astype(float), check_index_type = False)
+
+
+def test_gap_before_original_consensus():
+    """A site before the first original consensus codon (where the original lookup failed) is half a codon before it"""
+
+    consensus_annotations = pd.DataFrame({'HXB2.Position': [np.nan, 10.0, 11.0, 12.0],
+                                          'Consensus.Aligned.to.HXB2.Position': [1.0, 2.0, 3.0, 4.0],
+                                          'Original.Consensus.Position': [np.nan, 2.0, 3.0, np.nan]}, index = [1, 2, 3, 4])
+
+    np.testing.assert_array_equal(liftover_sites(np.array([1, 2, 3, 4]), consensus_annotations), [9.5, 10, 11, 11.5])
+
+
+def test_unknown_site_is_an_error():
+    """Sites past the end of the consensus annotations are reported"""
+
+    consensus_annotations = pd.DataFrame({'HXB2.Position': [1.0], 'Consensus.Aligned.to.HXB2.Position': [1.0],
+                                          'Original.Consensus.Position': [1.0]}, index = [1])
+
+    with pytest.raises(KeyError):
+        liftover_sites(np.array([1, 2]), consensus_annotations)
@@ -0,0 +1,78 @@
+"""Tests of the cutoff sweep, permutation test and Benjamini-Hochberg FDR of get_common_pos_selection_sites.py"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from get_common_pos_selection_sites import benjamini_hochberg, permutation_test_common_sites, permute_counts, sweep_common_sites
+
+
+def brute_force_bh(p_values):
+    """Benjamini-Hochberg FDR of every p-value: the smallest p_(j) * n / j over ranks j at or above its own rank"""
+
+    n = len(p_values)
+    ranked = sorted(p_values)
+    return [min(1, min(ranked[j] * n / (j + 1) for j in range(sorted(p_values).index(p), n))) for p in p_values]
+
+
+def test_benjamini_hochberg():
+    """Adjusted p-values match a manual computation, keep the input order and are capped at 1"""
+
+    assert benjamini_hochberg([0.01, 0.04, 0.03, 0.2]) == pytest.approx([0.04, 0.16 / 3, 0.16 / 3, 0.2])
+
+    p_values = np.random.default_rng(2).random(30) ** 2
+    assert benjamini_hochberg(p_values) == pytest.approx(brute_force_bh(list(p_values)))
+    assert benjamini_hochberg([0.9, 0.95]).max() <= 1
+    assert len(benjamini_hochberg([])) == 0
+
+
+def test_permutations_keep_each_participant_count_and_land_uniformly():
+    """Every shuffled column keeps its number of exceedances, and each row gets an exceedance with probability k / rows"""
+
+    n_rows, size = 10, 20000
+    exceeded = np.zeros((n_rows, 2), dtype = bool)
+    exceeded[:3, 0] = True
+    exceeded[5:9, 1] = True
+
+    # with an observed count of 1 at every row, at_least_observed counts the permutations where a row has any exceedance
+    at_least_observed, null_common = permute_counts(exceeded, np.ones(n_rows, dtype = int), [0, 2], size, 1000, 0)
+
+    assert (null_common[:, 0] == n_rows).all()
+    # P(row has none) = (1 - 3/10)(1 - 4/10), rows with both are hypergeometric: 3 * 4 / 10 expected
+    assert at_least_observed / size == pytest.approx(np.full(n_rows, 1 - 0.7 * 0.6), abs = 0.015)
+    assert null_common[:, 1].mean() == pytest.approx(1.2, abs = 0.03)
+
+
+def test_permutation_p_values():
+    """A codon where every participant exceeds gets a small p-value, results do not depend on the number of jobs"""
+
+    rng = np.random.default_rng(3)
+    n_rows, participants = 50, 6
+    exceeded = rng.random((n_rows, participants, 1)) < 0.1
+    exceeded[7, :, 0] = True
+    index = np.arange(1, n_rows + 1, dtype = float)
+
+    codons, null = permutation_test_common_sites(index, exceeded, [0.9], [2, 6], 999, batch_size = 250, seed = 1)
+
+    assert list(codons['participants']) == list(exceeded[:, :, 0].sum(axis = 1))
+    assert codons.loc[7, 'p_value'] == pytest.approx(1 / 1000)
+    assert (codons['p_value'] > 0).all() and (codons['p_value'] <= 1).all()
+    assert codons['fdr'].to_numpy() == pytest.approx(benjamini_hochberg(codons['p_value']))
+    assert null.loc[null['threshold'] == 6, 'observed'].item() == 1
+    assert null.loc[null['threshold'] == 6, 'p_value'].item() < 0.01
+
+    jobs_codons, jobs_null = permutation_test_common_sites(index, exceeded, [0.9], [2, 6], 999, batch_size = 250, seed = 1, jobs = 2)
+    pd.testing.assert_frame_equal(codons, jobs_codons)
+    pd.testing.assert_frame_equal(null, jobs_null)
+
+
+def test_sweep_common_sites(tmp_path):
+    """Rows with threshold or more participants at or above the cutoff are written for every combination, across chunks"""
+
+    table = pd.DataFrame([[0.96, 0.91, np.nan], [0.5, 0.97, 0.99], [0.99, 0.95, 0.9]], index = [10.0, 11.0, 12.0], columns = ['P1', 'P2', 'P3'])
+    outfiles = {(0.9, 2): str(tmp_path / 'a.csv'), (0.95, 2): str(tmp_path / 'b.csv')}
+
+    summary = sweep_common_sites([table.iloc[:2], table.iloc[2:]], [0.9, 0.95], [2, 3], outfiles)
+
+    assert summary.to_numpy().tolist() == [[3, 1], [2, 0]]
+    assert list(pd.read_csv(outfiles[(0.9, 2)], index_col = 0).index) == [10.0, 11.0, 12.0]
+    assert list(pd.read_csv(outfiles[(0.95, 2)], index_col = 0).index) == [11.0, 12.0]
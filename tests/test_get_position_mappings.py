@@ -0,0 +1,65 @@
+"""Tests of the vectorized position mappings and the binary position index of get_position_mappings.py"""
+
+import numpy as np
+import pandas as pd
+from get_position_mappings import create_pos_mapping_df, get_position_frame, get_seq_positions, load_position_index, write_position_index
+from haplotype_linkage import find_alignment_columns
+
+
+def baseline_positions(seq):
+    """Positions of the original get_seq_positions, one character at a time"""
+
+    positions = []
+    count = 0
+    for aa in str(seq).upper():
+        if aa in 'ACDEFGHIKLMNPQRSTVWYXBZJ':
+            count += 1
+            positions.append(count)
+        else:
+            positions.append(np.nan)
+
+    return positions
+
+
+def test_seq_positions_match_baseline():
+    """Gaps are NaN, every amino acid gets its position in the ungapped sequence"""
+
+    seq = '--MkV-x*T--b'
+
+    np.testing.assert_array_equal(get_seq_positions(seq), baseline_positions(seq))
+
+
+def test_position_index_round_trip(tmp_path):
+    """The memory-mapped index gives back every individual's mapping, with the consensus annotation columns"""
+
+    mappings = {'P1': create_pos_mapping_df('MK-VT', 'MKAV-', 'MKAV'),
+                'P2_1': create_pos_mapping_df('M-KV', 'MAKV', 'MAKV')}
+
+    write_position_index(str(tmp_path / 'position_index'), mappings)
+    positions = load_position_index(str(tmp_path / 'position_index'))
+
+    assert list(positions) == ['P1', 'P2_1']
+    for id, mapping in mappings.items():
+        frame = get_position_frame(positions[id])
+        np.testing.assert_array_equal(frame.to_numpy(), mapping.to_numpy())
+        assert list(frame.columns) == ['HXB2.Position', 'Consensus.Aligned.to.HXB2.Position', 'Original.Consensus.Position']
+
+
+def test_index_finds_the_same_alignment_columns(tmp_path):
+    """Sites are found in the same alignment columns from the index as from the csv the annotations are made of"""
+
+    mapping = create_pos_mapping_df('MKV--TLLS', 'MK-AGTL-S', 'MKAGTLS')
+    mapping.to_csv(tmp_path / 'P1_position_mappings.csv')
+    write_position_index(str(tmp_path / 'position_index'), {'P1': mapping})
+
+    # R reads the csv with dots in the column names, as in the consensus annotations
+    annotations = pd.read_csv(tmp_path / 'P1_position_mappings.csv', index_col = 0)
+    annotations.columns = [column.replace(' ', '.') for column in annotations.columns]
+    annotations = annotations.reset_index(drop = True)
+
+    hxb2_sites = np.array([1, 2, 4, 5, 6, 7])
+    from_csv = find_alignment_columns(hxb2_sites, annotations, 7)
+    from_index = find_alignment_columns(hxb2_sites, get_position_frame(load_position_index(str(tmp_path / 'position_index'))['P1']), 7)
+
+    np.testing.assert_array_equal(from_csv[0], from_index[0])
+    np.testing.assert_array_equal(from_csv[1], from_index[1])
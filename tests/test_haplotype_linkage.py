@@ -0,0 +1,97 @@
+"""Tests of the bit-packed co-occurrence, linkage and haplotype frequencies of haplotype_linkage.py against direct counts"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import haplotype_linkage
+from haplotype_linkage import count_cooccurrence, encode_sites, get_haplotype_frequencies, get_linkage, popcount
+
+
+def make_residues(rng, n_sequences, n_sites):
+    """Random residues (sequences by sites) over a few amino acids and gaps"""
+
+    return rng.choice(np.frombuffer(b'KKRRI-', dtype = np.uint8), size = (n_sequences, n_sites))
+
+
+def test_cooccurrence_matches_direct_count():
+    """Co-occurrence counts of bitsets are the number of sequences with both residues, past a 64 sequence word"""
+
+    rng = np.random.default_rng(0)
+    residues = make_residues(rng, 150, 4)
+
+    sites, states, bits, valid = encode_sites(residues)
+    masks = np.array([residues[:, site] == ord(state) for site, state in zip(sites, states)])
+
+    np.testing.assert_array_equal(count_cooccurrence(bits), masks.astype(int) @ masks.T.astype(int))
+
+
+def test_popcount_fallback(monkeypatch):
+    """The byte table popcount counts the same as bitwise_count"""
+
+    bits = np.random.default_rng(1).integers(0, 2 ** 63, size = (5, 3), dtype = np.uint64)
+    expected = popcount(bits)
+
+    monkeypatch.delattr(np, 'bitwise_count', raising = False)
+    np.testing.assert_array_equal(haplotype_linkage.popcount(bits), expected)
+    assert expected.tolist() == [sum(bin(int(word)).count('1') for word in row) for row in bits]
+
+
+def test_linkage_matches_direct_calculation():
+    """D, D' and r squared of every pair of residues match the textbook formulas over sequences with a residue at both sites"""
+
+    rng = np.random.default_rng(2)
+    residues = make_residues(rng, 200, 3)
+    labels = ['304', '320', '440']
+
+    sites, states, bits, valid = encode_sites(residues)
+    cooccurrence_df, r2_df, Dprime_df = get_linkage(labels, sites, states, count_cooccurrence(bits), valid)
+
+    for row in cooccurrence_df.itertuples():
+        i, j = labels.index(row.site_1), labels.index(row.site_2)
+        both = (residues[:, i] != ord('-')) & (residues[:, j] != ord('-'))
+        a = residues[both, i] == ord(row.residue_1)
+        b = residues[both, j] == ord(row.residue_2)
+
+        p_a, p_b, p_ab = a.mean(), b.mean(), (a & b).mean()
+        D = p_ab - p_a * p_b
+        D_max = min(p_a * p_b, (1 - p_a) * (1 - p_b)) if D < 0 else min(p_a * (1 - p_b), (1 - p_a) * p_b)
+
+        assert row.count == (a & b).sum()
+        assert row.D == pytest.approx(D)
+        assert row.Dprime == pytest.approx(D / D_max)
+        assert row.r2 == pytest.approx(D ** 2 / (p_a * (1 - p_a) * p_b * (1 - p_b)))
+
+    # matrices are symmetric with nothing on the diagonal
+    assert np.isnan(np.diag(r2_df)).all()
+    np.testing.assert_array_equal(r2_df.to_numpy(), r2_df.to_numpy().T)
+
+
+def test_perfect_linkage():
+    """Two sites whose residues always go together have r squared 1 and D' of 1 or -1 between the most common residues,
+    even when those never occur together (ties go to the first residue, I and R here)"""
+
+    residues = np.array([list(b'KR'), list(b'KR'), list(b'IT'), list(b'IT')], dtype = np.uint8)
+
+    sites, states, bits, valid = encode_sites(residues)
+    cooccurrence_df, r2_df, Dprime_df = get_linkage(['1', '2'], sites, states, count_cooccurrence(bits), valid)
+
+    assert r2_df.loc['1', '2'] == pytest.approx(1)
+    assert Dprime_df.loc['1', '2'] == pytest.approx(-1)
+
+
+def test_haplotype_frequencies_match_value_counts():
+    """Haplotype counts are the counts of every combination of residues among sequences with a residue at every site"""
+
+    rng = np.random.default_rng(3)
+    residues = make_residues(rng, 300, 3)
+    labels = ['304', '320', '440']
+
+    sites, states, bits, valid = encode_sites(residues)
+    haplotypes_df = get_haplotype_frequencies(labels, sites, states, bits, valid, min_count = 2)
+
+    complete = residues[(residues != ord('-')).all(axis = 1)]
+    names = pd.Series(['_'.join(f'{label}{chr(r)}' for label, r in zip(labels, row)) for row in complete]).value_counts()
+    names = names[names >= 2]
+
+    assert dict(zip(haplotypes_df['haplotype'], haplotypes_df['count'])) == names.to_dict()
+    assert haplotypes_df['frequency'].tolist() == pytest.approx((haplotypes_df['count'] / len(complete)).tolist())
@@ -0,0 +1,84 @@
+"""Tests of the batch Kruskal-Wallis tests of kw_test_batch.py"""
+
+import math
+import numpy as np
+import pandas as pd
+import pytest
+from kw_test_batch import adjust_p_values, chi2_sf, get_groupings, kruskal_wallis, kruskal_wallis_participant, parse_haplotypes, rank_scores
+
+
+def brute_force_h(scores, groups):
+    """Tie-corrected Kruskal-Wallis H from its definition over average ranks:
+    (n - 1) * sum of n_i (mean rank of group i - mean rank)^2 / sum of (rank - mean rank)^2"""
+
+    ordered = sorted(scores)
+    ranks = np.array([np.mean([i + 1 for i, value in enumerate(ordered) if value == score]) for score in scores])
+    mean = ranks.mean()
+    between = sum(len(ranks[groups == g]) * (ranks[groups == g].mean() - mean) ** 2 for g in set(groups))
+
+    return (len(ranks) - 1) * between / ((ranks - mean) ** 2).sum()
+
+
+@pytest.mark.parametrize('x, df, expected', [(3.841458820694124, 1, 0.05),
+                                             (7.814727903251178, 3, 0.05),
+                                             (11.070497693516351, 5, 0.05),
+                                             (6.634896601021214, 1, 0.01),
+                                             (1.7, 2, math.exp(-0.85)),
+                                             (9.487729036781154, 4, 0.05),
+                                             (0, 3, 1.0)])
+def test_chi2_sf(x, df, expected):
+    """Upper tail of the chi squared distribution against known critical values, exp(-x/2) for 2 degrees of freedom"""
+
+    assert chi2_sf(x, df) == pytest.approx(expected)
+
+
+def test_chi2_sf_undefined():
+    """NaN statistics and groupings without degrees of freedom have no p-value"""
+
+    assert np.isnan(chi2_sf(np.nan, 2))
+    assert np.isnan(chi2_sf(1.0, 0))
+
+
+def test_kruskal_wallis_matches_definition_with_ties():
+    """H of every grouping, computed at once from shared ranks, matches H computed from its definition, ties included"""
+
+    scores = np.array([3.1, 0.0, 0.0, 5.2, 3.1, 8.0, 0.0, 7.7, 3.1, 9.9])
+    groups = ['304K_320I', '304K_320I', '304R_320I', '304R_320T', '304K_320T',
+              '304R_320T', '304K_320I', '304R_320I', '304K_320T', '304R_320T']
+
+    ranks, ties = rank_scores(scores)
+    sites, haplotypes = parse_haplotypes(groups)
+    groupings = get_groupings(sites, haplotypes)
+
+    assert list(ranks[:3]) == [5, 2, 2]
+    assert [grouping[0] for grouping in groupings] == ['304', '320', '304_320']
+
+    H = kruskal_wallis(ranks, ties, groupings)
+    for h, (grouping_sites, codes, n_groups) in zip(H, groupings):
+        assert h == pytest.approx(brute_force_h(scores, codes))
+
+
+def test_kruskal_wallis_participant():
+    """One row per grouping with its degrees of freedom, p-value from chi2_sf and eta squared"""
+
+    data_df = pd.DataFrame({'group': ['304K', '304K', '304K', '304R', '304R', '304R', None],
+                            'x4.pct': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]})
+
+    results = kruskal_wallis_participant('521', data_df)
+
+    # ranks 1-3 against 4-6: H = 12 / 42 * (36 + 225) / 3 - 21
+    H = 12 / 42 * (36 + 225) / 3 - 21
+    assert results[['participant', 'sites', 'n', 'groups', 'df']].values.tolist() == [['521', '304', 6, 2, 1]]
+    assert results['H'].item() == pytest.approx(H)
+    assert results['p_value'].item() == pytest.approx(chi2_sf(H, 1))
+    assert results['eta2'].item() == pytest.approx((H - 1) / 4)
+
+
+def test_adjust_p_values():
+    """Benjamini-Hochberg and Bonferroni adjustments, NaN p-values left out of the number of tests"""
+
+    p_values = np.array([0.01, np.nan, 0.04, 0.03, 0.2])
+
+    assert np.allclose(adjust_p_values(p_values, 'fdr'), [0.04, np.nan, 0.16 / 3, 0.16 / 3, 0.2], equal_nan = True)
+    assert np.allclose(adjust_p_values(p_values, 'bonferroni'), [0.04, np.nan, 0.16, 0.12, 0.8], equal_nan = True)
+    assert adjust_p_values(np.array([0.5, 0.6]), 'bonferroni').tolist() == [1, 1]
@@ -0,0 +1,79 @@
+"""Tests of the per-stage manifest of manifest.py"""
+
+import os
+from manifest import Manifest
+
+
+def make_input(tmp_path, text='ATG'):
+    """Writes an input file and returns its name"""
+
+    path = tmp_path / 'P1_rev2miss.aln'
+    path.write_text(text)
+
+    return str(path)
+
+
+def test_unchanged_participant_is_current(tmp_path):
+    """A participant recorded with the same inputs, parameters and outputs is current, also after saving and loading"""
+
+    infile = make_input(tmp_path)
+    outfile = tmp_path / 'out.txt'
+    outfile.write_text('done')
+
+    manifest = Manifest(str(tmp_path), 'stage')
+    assert not manifest.is_current('P1', [infile], {'k': 1}, [str(outfile)])
+
+    manifest.record('P1', [infile], {'k': 1}, [str(outfile)], result = ['P1', 'MK'])
+    manifest.save()
+
+    manifest = Manifest(str(tmp_path), 'stage')
+    assert manifest.is_current('P1', [infile], {'k': 1}, [str(outfile)])
+    assert manifest.result('P1') == ['P1', 'MK']
+
+    # force treats everything as out of date
+    assert not Manifest(str(tmp_path), 'stage', force = True).is_current('P1', [infile], {'k': 1}, [str(outfile)])
+
+
+def test_changed_inputs_or_parameters_are_not_current(tmp_path):
+    """Changed input contents or parameters make a participant out of date"""
+
+    infile = make_input(tmp_path)
+
+    manifest = Manifest(str(tmp_path), 'stage')
+    manifest.record('P1', [infile], {'k': 1})
+
+    assert not manifest.is_current('P1', [infile], {'k': 2})
+
+    # same size, different contents and modification time
+    make_input(tmp_path, 'ATC')
+    os.utime(infile, ns = (1, 1))
+    assert not manifest.is_current('P1', [infile], {'k': 1})
+
+
+def test_missing_outputs_are_not_current(tmp_path):
+    """A participant is out of date if a recorded output, or an output expected now, does not exist"""
+
+    infile = make_input(tmp_path)
+    old = tmp_path / 'old.txt'
+    old.write_text('done')
+
+    manifest = Manifest(str(tmp_path), 'stage')
+    manifest.record('P1', [infile], outputs = [str(old)])
+
+    assert manifest.is_current('P1', [infile], outputs = [str(old)])
+    assert not manifest.is_current('P1', [infile], outputs = [str(tmp_path / 'renamed.txt')])
+
+    old.unlink()
+    assert not manifest.is_current('P1', [infile])
+
+
+def test_unchanged_files_are_not_hashed_again(tmp_path, monkeypatch):
+    """The hash of a file with the same size and modification time is taken from the cache"""
+
+    infile = make_input(tmp_path)
+
+    manifest = Manifest(str(tmp_path), 'stage')
+    digest = manifest.file_digest(infile)
+
+    monkeypatch.setattr('builtins.open', None)
+    assert manifest.file_digest(infile) == digest
@@ -0,0 +1,101 @@
+"""Tests of the stage scheduling, resuming and tool running of run_pipelines.py"""
+
+import os
+import sys
+import threading
+from manifest import Manifest
+from run_pipelines import Task, ToolRunner, get_dependencies, get_pipeline1_tasks, get_pipeline2_tasks, run_tasks
+
+
+# paths written by task functions, kept out of the task arguments since those are recorded in the manifest
+LOG = []
+
+
+def write_file(path, text):
+    """Task function: writes text to path, noting the path in LOG"""
+
+    LOG.append(path)
+    with open(path, 'w') as outfile:
+        outfile.write(text)
+
+
+def fail():
+    """Task function that fails"""
+
+    raise RuntimeError('stage failed')
+
+
+def make_chain(tmp_path):
+    """Two independent stages and a third reading both of their outputs"""
+
+    cwd = str(tmp_path)
+    return [Task('c', cwd, ['a.txt', 'b.txt'], ['c.txt'], function = (write_file, [f'{cwd}/c.txt', 'c'])),
+            Task('a', cwd, [], ['a.txt'], function = (write_file, [f'{cwd}/a.txt', 'a'])),
+            Task('b', cwd, [], ['b.txt'], function = (write_file, [f'{cwd}/b.txt', 'b']))]
+
+
+def test_stages_run_after_their_inputs_and_resume(tmp_path):
+    """A stage runs once the stages writing its inputs are done, and finished stages are skipped on the next run"""
+
+    LOG.clear()
+    manifest = Manifest(str(tmp_path), 'pipelines')
+
+    assert run_tasks(make_chain(tmp_path), manifest, ToolRunner({}, 1), 2) == []
+    assert LOG[-1].endswith('c.txt') and len(LOG) == 3
+
+    LOG.clear()
+    assert run_tasks(make_chain(tmp_path), Manifest(str(tmp_path), 'pipelines'), ToolRunner({}, 1), 2) == []
+    assert LOG == []
+
+
+def test_failed_stage_skips_its_dependents(tmp_path):
+    """Stages depending on a failed stage do not run, and every one is reported"""
+
+    LOG.clear()
+    tasks = make_chain(tmp_path)
+    tasks[1] = Task('a', str(tmp_path), [], ['a.txt'], function = (fail, []))
+
+    assert sorted(run_tasks(tasks, Manifest(str(tmp_path), 'pipelines'), ToolRunner({}, 1), 1)) == ['a', 'c']
+    assert [path[-5:] for path in LOG] == ['b.txt']
+
+
+def test_dependency_cycle_is_reported(tmp_path):
+    """Stages that wait on each other are reported as failed instead of waiting forever"""
+
+    cwd = str(tmp_path)
+    tasks = [Task('x', cwd, ['y.txt'], ['x.txt'], function = (write_file, [f'{cwd}/x.txt', 'x'])),
+             Task('y', cwd, ['x.txt'], ['y.txt'], function = (write_file, [f'{cwd}/y.txt', 'y']))]
+
+    result = []
+    thread = threading.Thread(target = lambda: result.append(run_tasks(tasks, Manifest(cwd, 'pipelines'), ToolRunner({}, 1), 1)), daemon = True)
+    thread.start()
+    thread.join(timeout = 10)
+
+    assert not thread.is_alive()
+    assert sorted(result[0]) == ['x', 'y']
+
+
+def test_tools_can_be_swapped_for_stubs(tmp_path):
+    """A tool name runs the executable it is mapped to, and its standard output is written to the stage's stdout file"""
+
+    runner = ToolRunner({'mafft': sys.executable}, 1)
+    runner.run(['mafft', '-c', 'print(">hxb2")'], str(tmp_path), str(tmp_path / 'aln.fa'))
+
+    assert (tmp_path / 'aln.fa').read_text() == '>hxb2\n'
+
+
+def test_screen_tables_read_gathered_screen_files(tmp_path):
+    """With the screen, its site tables are gathered into pipeline2/data and its tables are made from them, apart from the FUBAR tables"""
+
+    (tmp_path / 'pipeline1' / 'data' / 'VRC601').mkdir(parents = True)
+    (tmp_path / 'pipeline1' / 'data' / 'VRC601' / 'P1_rev2miss.aln').write_text('>s1\nATG\n')
+    root = str(tmp_path)
+
+    tasks = get_pipeline1_tasks(root, 'VRC601', 1, screen = True) + get_pipeline2_tasks(root, ['VRC601'], 1, screen = True)
+    outputs = {task.name: task.outputs for task in tasks}
+    dependencies = get_dependencies(tasks)
+
+    assert [os.path.normpath(f) for f in outputs['VRC601:gather_screen']] == [f'{root}/pipeline2/data/P1_rev2miss.aln.NG_simple.txt']
+    assert dependencies['tables:screen'] == {'VRC601:gather', 'VRC601:gather_screen', 'tables:midpoints'}
+    assert 'VRC601:gather_screen' not in dependencies['tables:tables']
+    assert all(f.startswith(f'{root}/pipeline2/results/screen/') for f in outputs['tables:screen'])
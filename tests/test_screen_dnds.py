@@ -0,0 +1,59 @@
+"""Tests of the Nei-Gojobori counting of screen_dnds.py"""
+
+import numpy as np
+import pytest
+from screen_dnds import INVALID, count_differences, count_sites, estimate_sites, jukes_cantor, read_codons
+
+
+@pytest.mark.parametrize('codon, synonymous', [('ATG', 0), ('TGG', 0), ('TTT', 1 / 3), ('ATA', 2 / 3), ('GGG', 1), ('CTG', 4 / 3)])
+def test_count_sites(codon, synonymous):
+    """Synonymous sites are the fraction of single base changes keeping the amino acid, the rest are nonsynonymous"""
+
+    assert count_sites(codon) == pytest.approx((synonymous, 3 - synonymous))
+
+
+@pytest.mark.parametrize('codon1, codon2, differences', [('TTT', 'TTT', (0, 0)),
+                                                         ('TTT', 'TTC', (1, 0)),
+                                                         ('ATG', 'ATA', (0, 1)),
+                                                         # both orders go through a leucine codon
+                                                         ('TTA', 'CTG', (2, 0)),
+                                                         # TGG -> TAG -> TAT passes a stop codon, only TGG -> TGT -> TAT counts
+                                                         ('TGG', 'TAT', (0, 2)),
+                                                         # GTT -> GTA -> CTA and GTT -> CTT -> CTA both have one synonymous and one nonsynonymous change
+                                                         ('GTT', 'CTA', (1, 1)),
+                                                         # TTA -> CTA -> CTT is two synonymous changes, TTA -> TTT -> CTT two nonsynonymous ones
+                                                         ('TTA', 'CTT', (1, 1))])
+def test_count_differences(codon1, codon2, differences):
+    """Differences are averaged over the orders of changing the differing positions, leaving out paths through a stop codon"""
+
+    assert count_differences(codon1, codon2) == pytest.approx(differences)
+
+
+def test_jukes_cantor():
+    """The Jukes-Cantor distance is 0 without differences and NaN from 0.75 up"""
+
+    assert np.array_equal(jukes_cantor([0, 0.75, 0.9]), [0, np.nan, np.nan], equal_nan = True)
+    assert jukes_cantor(0.1) == pytest.approx(-0.75 * np.log(1 - 0.4 / 3))
+
+
+def test_estimate_sites(tmp_path):
+    """dS and dN of every codon site, summed over sequences against the consensus codon; gaps and stop codons are left out"""
+
+    alignment = tmp_path / 'P1_rev2miss.aln'
+    alignment.write_text('>s1\nATGTTTGGGTAA\n>s2\nATGTTCGGATAA\n>s3\nATATTT---TAA\n')
+
+    codons = read_codons(str(alignment))
+    dS, dN = estimate_sites(codons)
+
+    assert (codons[:, 3] == INVALID).all()
+    # ATA against ATG: 1/3 synonymous site (the average of 2/3 and 0), one nonsynonymous difference
+    assert dS[0] == 0
+    assert dN[0] == pytest.approx(jukes_cantor(3 / 26))
+    # TTC against TTT: one synonymous difference over one synonymous site, too many to correct
+    assert np.isnan(dS[1])
+    assert dN[1] == 0
+    # GGG against GGA (the consensus on a tie, the lower codon index), the gapped sequence left out
+    assert dS[2] == pytest.approx(jukes_cantor(0.5))
+    assert dN[2] == 0
+    # a site without any sense codon
+    assert np.isnan(dS[3]) and np.isnan(dN[3])
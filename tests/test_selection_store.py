@@ -0,0 +1,50 @@
+"""Tests of the binary selection store of selection_store.py"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from selection_store import load_selection_table, read_store_meta, write_selection_store
+
+
+def make_tables():
+    """dN/dS and P(dS<dN) tables of three participants over five HXB2 positions, with missing values"""
+
+    hxb2_axis = [10.0, 11.0, 11.5, 12.0, 20.0]
+    rng = np.random.default_rng(0)
+    tables = {}
+    for value in ['dN/dS', 'P(dS<dN)']:
+        table = pd.DataFrame(rng.random((5, 3)), index = hxb2_axis, columns = ['P1', 'P2_1', 'P3'])
+        table.iloc[1, 2] = np.nan
+        tables[value] = table
+
+    return tables
+
+
+def test_store_round_trip(tmp_path):
+    """Tables, participant subsets and annotation rows load back as the same values as selecting them from the tables"""
+
+    tables = make_tables()
+    write_selection_store(str(tmp_path), tables, {'V3': [11, 12]})
+
+    for value, table in tables.items():
+        pd.testing.assert_frame_equal(load_selection_table(str(tmp_path), value), table)
+
+    annotation = load_selection_table(str(tmp_path), 'dN/dS', participants = ['P3', 'P1'], annotation = 'V3')
+    expected = tables['dN/dS'].loc[(tables['dN/dS'].index >= 11) & (tables['dN/dS'].index <= 12), ['P3', 'P1']]
+
+    pd.testing.assert_frame_equal(annotation, expected)
+    assert read_store_meta(str(tmp_path))['annotations'] == {'V3': [1, 4]}
+
+
+def test_failed_write_leaves_no_meta(tmp_path):
+    """A write that fails part way removes the earlier meta data, and loading then fails instead of reading mixed matrices"""
+
+    write_selection_store(str(tmp_path), make_tables())
+
+    tables = make_tables()
+    tables['unknown'] = tables['dN/dS']
+    with pytest.raises(KeyError):
+        write_selection_store(str(tmp_path), tables)
+
+    with pytest.raises(FileNotFoundError, match = 'meta.json is missing'):
+        load_selection_table(str(tmp_path), 'dN/dS')
@@ -0,0 +1,57 @@
+"""Tests of the FUBAR json simplification of simplify_fubar_data.py"""
+
+import gzip
+import json
+import numpy as np
+import pytest
+from simplify_fubar_data import compute_dn_ds, iter_mle_rows, load_json_data, load_site_table, simplify_file
+
+
+def make_fubar_json(rows):
+    """FUBAR-like json text with the MLE rows after and before other keys"""
+
+    return json.dumps({'analysis': {'info': 'x' * 500},
+                       'MLE': {'headers': [['alpha', ''], ['beta', '']], 'content': {'0': rows}},
+                       'grid': [[0.1, 0.2]] * 50})
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 64, 1 << 16])
+def test_streamed_rows_match_json_load(tmp_path, block_size):
+    """The streaming parser gives the same rows as loading the whole file, however the file is cut into blocks"""
+
+    rng = np.random.default_rng(0)
+    rows = rng.random((40, 6)).round(8).tolist()
+    rows[3][0] = 1e-300
+
+    path = tmp_path / 'P1.FUBAR.json'
+    path.write_text(make_fubar_json(rows))
+
+    assert list(iter_mle_rows(str(path), block_size)) == load_json_data(str(path))['MLE']['content']['0']
+
+
+def test_dn_ds_where_ds_is_zero():
+    """dN/dS is inf where dS is 0 and dN is not, and NaN where both are 0"""
+
+    np.testing.assert_array_equal(compute_dn_ds([0.5, 0, 0], [1.0, 0.3, 0]), [2.0, np.inf, np.nan])
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_simplify_compressed_file(tmp_path, stream):
+    """A gzipped json gives the same tables as a plain one, named after the uncompressed name"""
+
+    rows = [[0.5, 1.0, 0, 0, 0.7, 0], [0, 0.3, 0, 0, 0.9, 0], [0, 0, 0, 0, 0.1, 0]]
+
+    (tmp_path / 'A.FUBAR.json').write_text(make_fubar_json(rows))
+    with gzip.open(tmp_path / 'B.FUBAR.json.gz', 'wt') as outfile:
+        outfile.write(make_fubar_json(rows))
+
+    simplify_file('A.FUBAR.json', str(tmp_path), stream)
+    simplify_file('B.FUBAR.json.gz', str(tmp_path), stream)
+
+    text = (tmp_path / 'A.FUBAR_simple.txt').read_text()
+    assert text == (tmp_path / 'B.FUBAR_simple.txt').read_text()
+    assert text.splitlines() == ['site\tdS\tdN\tP(dS<dN)\tdN/dS', '1\t0.5\t1.0\t0.7\t2.0', '2\t0\t0.3\t0.9\tinf', '3\t0\t0\t0.1\tnan']
+
+    table = load_site_table(str(tmp_path / 'B.FUBAR_simple.npz'))
+    np.testing.assert_array_equal(table['site'], [1, 2, 3])
+    np.testing.assert_array_equal(table['dNdS'], [2.0, np.inf, np.nan])
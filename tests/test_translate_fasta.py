@@ -0,0 +1,69 @@
+"""Tests of the codon lookup translation of translate_fasta.py against Biopython"""
+
+import itertools
+import warnings
+import numpy as np
+import pytest
+from translate_fasta import translate_file, translate_sequences
+
+
+# every IUPAC code, X and gap, in upper and lower case
+NUCLEOTIDES = 'ACGTURYSWKMBDHVNX-' + 'acgturyswkmbdhvnx'
+
+
+def test_codon_table_matches_biopython():
+    """Every codon translates like Bio.Seq.translate, and codons Biopython cannot translate are errors"""
+
+    Seq = pytest.importorskip('Bio.Seq').Seq
+    TranslationError = pytest.importorskip('Bio.Data.CodonTable').TranslationError
+
+    for codon in map(''.join, itertools.product(NUCLEOTIDES, repeat = 3)):
+
+        try:
+            expected = str(Seq(codon).translate(gap = '-'))
+        except TranslationError:
+            with pytest.raises(ValueError):
+                translate_sequences([codon])
+            continue
+
+        assert translate_sequences([codon]) == [expected], codon
+
+
+def test_translation_of_alignment_matches_biopython():
+    """Sequences of different lengths, with a trailing partial codon, translate like Bio.Seq.translate"""
+
+    Seq = pytest.importorskip('Bio.Seq').Seq
+
+    rng = np.random.default_rng(0)
+
+    # whole codons (gaps come in whole codons in an alignment), cut at any length
+    codons = [''.join(codon) for codon in itertools.product('ACGT', repeat = 3)] + ['---', 'NNN', 'GCN', 'TAR', 'ATH']
+    sequences = [''.join(rng.choice(codons, size = 100))[:length] for length in rng.integers(0, 300, size = 50)]
+
+    # Biopython warns about partial codons, the rewrite drops them silently
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = [str(Seq(seq).translate(gap = '-')) for seq in sequences]
+
+    assert translate_sequences(sequences) == expected
+
+
+def test_partial_gap_codon_is_an_error():
+    """A codon that is partly gap cannot be translated, and the error names the sequence"""
+
+    with pytest.raises(ValueError, match = 'seq2'):
+        translate_sequences(['ATGAAA', 'ATGA-A'], ['seq1', 'seq2'])
+
+
+def test_translate_file_writes_ids_and_rejects_duplicates(tmp_path):
+    """Translated files keep just the ID of every header, and duplicate IDs are an error"""
+
+    infile = tmp_path / 'P1_rev2miss.aln'
+    infile.write_text('>s1 first\nATGAAA\n>s2\nATG---\n')
+
+    translate_file(str(infile), str(tmp_path / 'out.fa'), chunk_size = 1)
+    assert (tmp_path / 'out.fa').read_text() == '>s1\nMK\n>s2\nM-\n'
+
+    infile.write_text('>s1\nATG\n>s1\nATG\n')
+    with pytest.raises(ValueError, match = 'Duplicate'):
+        translate_file(str(infile), str(tmp_path / 'out.fa'))